@@ -0,0 +1,255 @@
+"""
+Benchmarks of the execution engine on synthetic flows built with riverbox_builder.Flow.
+
+    python -m benchmarks.engine                      # every benchmark, a table on stdout
+    python -m benchmarks.engine map fan-out --scale 0.1 --output run.json
+    python -m benchmarks.engine --baseline run.json  # exits 1 if anything regressed
+
+Every benchmark runs in a process of its own, so that its peak RSS is its own, and reports
+cubes per second, wall seconds per cube execution (the cubes do next to nothing, so that is
+the engine's overhead per cube), peak RSS and the bytes of checkpoints written.
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import resource
+import tempfile
+import subprocess
+from uuid import uuid4
+from riverbox_builder import Flow
+from core.run import main
+
+# Lower is better for all of them but cubes-per-second
+METRICS = ["cubes-per-second", "seconds-per-cube", "wall-seconds", "peak-rss-bytes", "checkpoint-bytes"]
+HIGHER_IS_BETTER = {"cubes-per-second"}
+
+def chain_flow(size):
+    """`size` cubes, each taking the output of the one before"""
+    flow = Flow(name="Chain", language="python", version="3.12")
+    previous = flow.add_cube({"kind": "REGULAR", "name": "Cube 0", "code": "rbxm.output = 0"})
+    for i in range(1, size):
+        cube = flow.add_cube({"kind": "REGULAR", "name": f"Cube {i}", "code": "rbxm.output = x + 1"})
+        previous.add_edge_to(cube, end_arg_key="x")
+        previous = cube
+    result = flow.add_cube({"kind": "RESULT", "name": "Result", "arg-key": "last"})
+    previous.add_edge_to(result)
+    return flow
+
+def fan_out_flow(size):
+    """One cube feeding `size` independent cubes, all joined by a last one"""
+    flow = Flow(name="Fan out", language="python", version="3.12")
+    source = flow.add_cube({"kind": "REGULAR", "name": "Source", "code": "rbxm.output = 1"})
+    join = flow.add_cube({"kind": "REGULAR", "name": "Join", "code": "rbxm.output = " + " + ".join(f"x{i}" for i in range(size))})
+    for i in range(size):
+        cube = flow.add_cube({"kind": "REGULAR", "name": f"Branch {i}", "code": "rbxm.output = x"})
+        source.add_edge_to(cube, end_arg_key="x")
+        cube.add_edge_to(join, end_arg_key=f"x{i}")
+    result = flow.add_cube({"kind": "RESULT", "name": "Result", "arg-key": "total"})
+    join.add_edge_to(result)
+    return flow
+
+def map_flow(size):
+    """A MAP edge over `size` items"""
+    flow = Flow(name="Map", language="python", version="3.12")
+    count = flow.add_cube({"kind": "PARAM", "name": "Count", "arg-key": "count", "default-value": str(size)})
+    double = flow.add_cube({"kind": "REGULAR", "name": "Double", "code": "@rbxm.main_handler\ndef double(i):\n  return i * 2"})
+    result = flow.add_cube({"kind": "RESULT", "name": "Result", "arg-key": "doubled"})
+    # An int on a MAP edge maps over range(int)
+    count.add_edge_to(double, end_arg_key="i", kind="MAP")
+    double.add_edge_to(result)
+    return flow
+
+def nested_flow(size, depth=3):
+    """A MAP over `size` items into run-on-same subflows nested `depth` deep"""
+    inner = None
+    for level in range(depth):
+        sub = Flow(name=f"Level {level}", run_on_same=True, language="python", version="3.12", tags=[f"level-{level}"])
+        x = sub.add_cube({"kind": "PARAM", "name": "X", "arg-key": "x", "default-value": "0"})
+        body = sub.add_cube(inner) if inner is not None else sub.add_cube({"kind": "REGULAR", "name": "Inc", "code": "rbxm.output = x + 1"})
+        result = sub.add_cube({"kind": "RESULT", "name": "Result", "arg-key": "y"})
+        x.add_edge_to(body, end_arg_key="x")
+        body.add_edge_to(result)
+        inner = sub
+
+    flow = Flow(name="Nested", language="python", version="3.12")
+    count = flow.add_cube({"kind": "PARAM", "name": "Count", "arg-key": "count", "default-value": str(size)})
+    call = flow.add_cube(inner)
+    result = flow.add_cube({"kind": "RESULT", "name": "Result", "arg-key": "results"})
+    count.add_edge_to(call, end_arg_key="x", kind="MAP")
+    call.add_edge_to(result)
+    return flow
+
+def cycle_flow(size):
+    """A counter going round a check -> decrement cycle `size` times"""
+    flow = Flow(name="Cycle", language="python", version="3.12")
+    start = flow.add_cube({"kind": "PARAM", "name": "Start", "arg-key": "start", "default-value": str(size)})
+    check = flow.add_cube({"kind": "REGULAR", "name": "Check", "code": (
+        "rbxm.output = {'done': counter, 'again': None} if counter == 0 else {'done': None, 'again': counter}")})
+    decrement = flow.add_cube({"kind": "REGULAR", "name": "Decrement", "code": "rbxm.output = counter - 1"})
+    result = flow.add_cube({"kind": "RESULT", "name": "Result", "arg-key": "done"})
+    start.add_edge_to(check, end_arg_key="counter")
+    check.add_edge_to(result, start_arg_key="done")
+    check.add_edge_to(decrement, end_arg_key="counter", start_arg_key="again")
+    decrement.add_edge_to(check, end_arg_key="counter")
+    return flow
+
+def large_globals_flow(size, cubes=8):
+    """A chain of `cubes` cubes that together bind `size` MB of globals"""
+    flow = Flow(name="Large globals", language="python", version="3.12")
+    previous = None
+    for i in range(cubes):
+        cube = flow.add_cube({"kind": "REGULAR", "name": f"Allocate {i}",
+                              "code": f"block_{i} = bytearray({size * 1024 * 1024 // cubes})\nrbxm.output = {i}"})
+        if previous is not None:
+            previous.add_edge_to(cube, end_arg_key="previous")
+        previous = cube
+    return flow
+
+# name -> (build function, default size, whether it writes checkpoints)
+BENCHMARKS = {
+    "chain": (chain_flow, 1000, False),
+    "fan-out": (fan_out_flow, 1000, False),
+    "map": (map_flow, 10000, False),
+    "nested": (nested_flow, 200, False),
+    "cycle": (cycle_flow, 500, True),
+    "large-globals": (large_globals_flow, 64, True),
+}
+
+def _peak_rss_bytes():
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Kilobytes on Linux, bytes on macOS
+    return peak if sys.platform == "darwin" else peak * 1024
+
+def run_benchmark(name, size=None, repeat=3, checkpoints=None):
+    """
+    Run benchmark `name` `repeat` times in this process and return the figures of the fastest run.
+    checkpoints: write checkpoints (to a temporary folder), by default as the benchmark says
+    """
+    build, default_size, default_checkpoints = BENCHMARKS[name]
+    size = size or default_size
+    checkpoints = default_checkpoints if checkpoints is None else checkpoints
+    riverbox_flow = build(size).to_json(-1)
+
+    best = None
+    for _ in range(repeat):
+        counts = {"cubes": 0, "errors": 0, "checkpoint-bytes": 0}
+        def callback(message):
+            if message["type"] in ("SUCCESSFUL_CUBE_EXECUTION", "CACHED_CUBE_EXECUTION"):
+                counts["cubes"] += 1
+            elif message["type"] == "CUBE_EXECUTION_ERROR":
+                counts["errors"] += 1
+            elif message["type"] == "CHECKPOINT_WRITTEN":
+                counts["checkpoint-bytes"] += message["bytes"]
+
+        metadata = {"execution-id": str(uuid4()), "flow-id": str(uuid4()), "invocation-id": str(uuid4())}
+        with tempfile.TemporaryDirectory() as folder:
+            started = time.perf_counter()
+            main(riverbox_flow, metadata, callback, "FULL", return_results=True, dump_state_folder=folder if checkpoints else None)
+            wall = time.perf_counter() - started
+
+        if counts["errors"]:
+            raise RuntimeError(f"Benchmark {name}: {counts['errors']} cube executions failed")
+        if best is None or wall < best["wall-seconds"]:
+            best = {
+                "benchmark": name,
+                "size": size,
+                "cube-executions": counts["cubes"],
+                "wall-seconds": wall,
+                "cubes-per-second": counts["cubes"] / wall,
+                "seconds-per-cube": wall / max(counts["cubes"], 1),
+                "checkpoint-bytes": counts["checkpoint-bytes"],
+            }
+    best["peak-rss-bytes"] = _peak_rss_bytes()
+    return best
+
+def run_isolated(name, size=None, repeat=3, checkpoints=None):
+    """run_benchmark in a process of its own"""
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    with tempfile.TemporaryDirectory() as folder:
+        result_file = os.path.join(folder, "result.json")
+        command = [sys.executable, "-m", "benchmarks.engine", "--child", result_file, "--repeat", str(repeat), name]
+        if size is not None:
+            command += ["--size", str(size)]
+        if checkpoints is not None:
+            command += ["--checkpoints" if checkpoints else "--no-checkpoints"]
+        # The engine prints as it goes, only the result file matters
+        subprocess.run(command, cwd=root, check=True, stdout=subprocess.DEVNULL)
+        with open(result_file) as f:
+            return json.load(f)
+
+def compare(results, baseline, threshold=0.1):
+    """
+    Changes against a baseline run, one entry per benchmark and metric both have. An entry is a
+    regression if the metric got worse by more than `threshold` (0.1 is 10%).
+    """
+    baseline = {r["benchmark"]: r for r in baseline["results"]}
+    changes = []
+    for result in results["results"]:
+        before = baseline.get(result["benchmark"])
+        if before is None or before["size"] != result["size"]:
+            continue
+        for metric in METRICS:
+            if not before.get(metric):
+                continue
+            change = (result[metric] - before[metric]) / before[metric]
+            worse = -change if metric in HIGHER_IS_BETTER else change
+            changes.append({"benchmark": result["benchmark"], "metric": metric, "baseline": before[metric],
+                            "value": result[metric], "change": change, "regression": worse > threshold})
+    return changes
+
+def _print_results(results):
+    print(f"{'benchmark':<15}{'size':>8}{'cubes':>9}{'cubes/s':>11}{'ms/cube':>10}{'peak RSS MB':>13}{'ckpt MB':>10}")
+    for r in results["results"]:
+        print(f"{r['benchmark']:<15}{r['size']:>8}{r['cube-executions']:>9}{r['cubes-per-second']:>11.0f}"
+              f"{r['seconds-per-cube'] * 1000:>10.3f}{r['peak-rss-bytes'] / 2**20:>13.1f}{r['checkpoint-bytes'] / 2**20:>10.2f}")
+
+def _print_changes(changes):
+    for c in changes:
+        flag = "REGRESSION" if c["regression"] else ""
+        print(f"{c['benchmark']:<15}{c['metric']:<18}{c['baseline']:>14.4g}{c['value']:>14.4g}{c['change']:>+9.1%}  {flag}")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the riverbox execution engine")
+    parser.add_argument("benchmarks", nargs="*", help=f"any of {', '.join(BENCHMARKS)}, all of them by default")
+    parser.add_argument("--size", type=int, help="size of every benchmark run, instead of its default")
+    parser.add_argument("--scale", type=float, default=1.0, help="multiplies the default sizes")
+    parser.add_argument("--repeat", type=int, default=3, help="runs per benchmark, the fastest counts")
+    parser.add_argument("--checkpoints", action=argparse.BooleanOptionalAction, default=None,
+                        help="write checkpoints in every benchmark, or in none")
+    parser.add_argument("--output", help="write the results as JSON to this file")
+    parser.add_argument("--baseline", help="compare with the results JSON of an earlier run")
+    parser.add_argument("--threshold", type=float, default=0.1, help="relative change counted as a regression")
+    parser.add_argument("--child", help=argparse.SUPPRESS)
+    arguments = parser.parse_args()
+    unknown = set(arguments.benchmarks) - set(BENCHMARKS)
+    if unknown:
+        parser.error(f"unknown benchmarks {', '.join(sorted(unknown))}, choose from {', '.join(BENCHMARKS)}")
+
+    if arguments.child:
+        [name] = arguments.benchmarks
+        result = run_benchmark(name, arguments.size, arguments.repeat, arguments.checkpoints)
+        with open(arguments.child, "w") as f:
+            json.dump(result, f)
+        sys.exit(0)
+
+    results = {"python": sys.version, "platform": sys.platform, "time": time.time(), "results": []}
+    for name in arguments.benchmarks or BENCHMARKS:
+        size = arguments.size or max(1, int(BENCHMARKS[name][1] * arguments.scale))
+        results["results"].append(run_isolated(name, size, arguments.repeat, arguments.checkpoints))
+    _print_results(results)
+
+    if arguments.output:
+        with open(arguments.output, "w") as f:
+            json.dump(results, f, indent=2)
+
+    if arguments.baseline:
+        with open(arguments.baseline) as f:
+            changes = compare(results, json.load(f), arguments.threshold)
+        print()
+        if not changes:
+            print("Nothing to compare, the baseline has none of these benchmarks at the same sizes")
+        _print_changes(changes)
+        if any(c["regression"] for c in changes):
+            sys.exit(1)
@@ -0,0 +1,161 @@
+import os
+import re
+import json
+import time
+import bisect
+import threading
+
+class CheckpointManifest:
+    """
+    Index of the checkpoints of one (flow id, execution id) in a dump folder, kept in memory
+    and saved next to the dumps as <prefix>_manifest.json. Counts are kept sorted, so the
+    nearest checkpoint at or below a count is a bisect instead of a stat per count.
+
+    Retention, both optional and combined: keep_last keeps the newest N checkpoints, keep_every
+    keeps the ones whose count is a multiple of k. Checkpoints the kept deltas replay from are
+    kept as well, so pruning never breaks a chain. With neither set everything is kept.
+    """
+    def __init__(self, folder, prefix, keep_last=None, keep_every=None):
+        self.folder = folder
+        self.prefix = prefix
+        self.keep_last = keep_last
+        self.keep_every = keep_every
+        self.lock = threading.Lock()
+        self.loaded = False
+        self.counts = []
+        self.entries = {} # count -> {"count", "kind", "base", "file", "buffers", "bytes", "time"}
+
+    def __getstate__(self):
+        return {"folder": self.folder, "prefix": self.prefix, "keep_last": self.keep_last, "keep_every": self.keep_every}
+
+    def __setstate__(self, state):
+        self.__init__(**state)
+
+    def file_name(self, counter, kind):
+        return f"{self.prefix}_{'delta' if kind == 'delta' else 'global_vars'}_after_{counter}.dill"
+
+    def path(self, name):
+        return os.path.join(self.folder, name)
+
+    def manifest_path(self):
+        return self.path(f"{self.prefix}_manifest.json")
+
+    def _load(self):
+        # Called with self.lock held, reads the saved manifest or indexes the folder once
+        if self.loaded:
+            return
+        self.loaded = True
+        os.makedirs(self.folder, exist_ok=True)
+        try:
+            with open(self.manifest_path()) as f:
+                entries = json.load(f)["checkpoints"]
+        except (OSError, ValueError, KeyError):
+            entries = self._scan()
+        for entry in entries:
+            self.entries[entry["count"]] = entry
+        self.counts = sorted(self.entries)
+
+    def _scan(self):
+        # Dumps written before there was a manifest. A delta's base is the checkpoint before it
+        pattern = re.compile(re.escape(self.prefix) + r"_(global_vars|delta)_after_(-?\d+)\.dill$")
+        found = []
+        names = os.listdir(self.folder)
+        for name in names:
+            match = pattern.match(name)
+            if match:
+                found.append((int(match.group(2)), "full" if match.group(1) == "global_vars" else "delta", name))
+        entries = []
+        previous = None
+        for count, kind, name in sorted(found):
+            buffers = sorted(n for n in names if n.startswith(name + ".") and n.endswith(".buf"))
+            entries.append({"count": count, "kind": kind, "base": previous if kind == "delta" else None,
+                            "file": name, "buffers": buffers,
+                            "bytes": sum(os.path.getsize(self.path(n)) for n in [name] + buffers), "time": None})
+            previous = count
+        return entries
+
+    def _save(self):
+        tmp = self.manifest_path() + ".tmp"
+        with open(tmp, "w") as f:
+            json.dump({"checkpoints": [self.entries[c] for c in self.counts]}, f)
+        os.replace(tmp, self.manifest_path())
+
+    def prepare(self):
+        """Create the dump folder and load the manifest, once"""
+        with self.lock:
+            self._load()
+
+    def add(self, counter, kind, base, size, buffers=()):
+        """
+        Record a checkpoint whose files are on disk, replacing any other one at the same count,
+        then prune by the retention policy and save the manifest.
+        buffers: names of the checkpoint's out of band buffer files
+        Returns the files that were pruned.
+        """
+        with self.lock:
+            self._load()
+            if counter not in self.entries:
+                bisect.insort(self.counts, counter)
+                pruned = []
+            else:
+                # Buffer names are unique per checkpoint, the replaced one's are garbage
+                pruned = self.entries[counter].get("buffers", [])
+            self.entries[counter] = {"count": counter, "kind": kind, "base": base,
+                                     "file": self.file_name(counter, kind), "buffers": list(buffers),
+                                     "bytes": size, "time": time.time()}
+            pruned = pruned + self._prune()
+            self._save()
+
+        for name in pruned:
+            try:
+                os.remove(self.path(name))
+            except OSError:
+                pass
+        return pruned
+
+    def _prune(self):
+        if self.keep_last is None and self.keep_every is None:
+            return []
+
+        keep = set()
+        if self.keep_last is not None:
+            keep.update(self.counts[-self.keep_last:] if self.keep_last > 0 else [])
+        if self.keep_every is not None:
+            keep.update(c for c in self.counts if c % self.keep_every == 0)
+
+        # Everything a kept delta replays from down to its full snapshot
+        for counter in list(keep):
+            entry = self.entries[counter]
+            while entry["kind"] == "delta" and entry["base"] in self.entries:
+                entry = self.entries[entry["base"]]
+                keep.add(entry["count"])
+
+        pruned = []
+        for c in self.counts:
+            if c not in keep:
+                entry = self.entries.pop(c)
+                pruned += [entry["file"]] + entry.get("buffers", [])
+        self.counts = [c for c in self.counts if c in keep]
+        return pruned
+
+    def nearest(self, counter, allow_closest_lower=True):
+        """The entry at `counter`, or at the highest count below it, None if there is none"""
+        with self.lock:
+            self._load()
+            if counter in self.entries:
+                return self.entries[counter]
+            if not allow_closest_lower:
+                return None
+            i = bisect.bisect_right(self.counts, counter)
+            return self.entries[self.counts[i - 1]] if i > 0 else None
+
+    def get(self, counter):
+        with self.lock:
+            self._load()
+            return self.entries.get(counter)
+
+    def list(self):
+        """Entries of every checkpoint, oldest count first"""
+        with self.lock:
+            self._load()
+            return [dict(self.entries[c]) for c in self.counts]
@@ -0,0 +1,108 @@
+import os
+import time
+import queue
+import threading
+from .oob_buffers import write_buffers, fsync_files
+
+class CheckpointWriter:
+    """
+    Writes checkpoint blobs to disk on its own thread, so the scheduler only pays for taking the
+    snapshot. Blobs are written to a temp file, fsynced and renamed into place, in the order they
+    were submitted. At most max_queued blobs wait at a time, submit blocks when the queue is full
+    so a slow disk slows checkpointing down instead of piling snapshots up in memory.
+
+    update_manager: called with a CHECKPOINT_WRITTEN message per checkpoint, from the writer thread
+    """
+    def __init__(self, update_manager, max_queued=4):
+        self.update_manager = update_manager
+        self.max_queued = max_queued
+        # A slot per queued blob, taken before the blob is queued so the wait for one is known
+        self.slots = threading.BoundedSemaphore(max_queued)
+        self.queue = queue.Queue()
+        self.thread = None
+        self.lock = threading.Lock()
+        self.error = None
+
+    def __getstate__(self):
+        return {"update_manager": self.update_manager, "max_queued": self.max_queued}
+
+    def __setstate__(self, state):
+        self.__init__(state["update_manager"], state["max_queued"])
+
+    def submit(self, path, blob, metrics, stale_path=None, on_written=None, buffer_names=(), buffers=()):
+        """
+        Queue `blob` to be written to `path`, blocking while the queue is full.
+        metrics: fields for the CHECKPOINT_WRITTEN message, e.g. the count and the snapshot time
+        stale_path: file to remove once `path` is written
+        on_written: called with the number of bytes written, on the writer thread, once `path` is in place
+        buffer_names, buffers: out of band buffers `blob` refers to (see oob_buffers), written next
+                               to `path` and fsynced before it. They must not change once submitted.
+                               None for buffers already written to their files, they are only fsynced
+        """
+        with self.lock:
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._work, name="riverbox-checkpoint-writer", daemon=True)
+                self.thread.start()
+        waited = time.perf_counter()
+        self.slots.acquire()
+        # The writer thread gets a dict of its own, with the wait already in it
+        metrics = {**metrics, "backpressure-seconds": time.perf_counter() - waited}
+        self.queue.put((path, blob, metrics, stale_path, on_written, buffer_names, buffers, time.perf_counter()))
+
+    def _work(self):
+        while True:
+            job = self.queue.get()
+            try:
+                if job is None:
+                    return
+                self.slots.release()
+                self._write(*job)
+            except Exception as e:
+                if self.error is None:
+                    self.error = e
+            finally:
+                self.queue.task_done()
+
+    def _write(self, path, blob, metrics, stale_path, on_written, buffer_names, buffers, queued):
+        started = time.perf_counter()
+        if buffers is not None:
+            write_buffers(path, buffer_names, buffers)
+        folder = os.path.dirname(path)
+        fsync_files([os.path.join(folder, name) for name in buffer_names])
+        tmp = path + ".tmp"
+        with open(tmp, "wb") as f:
+            f.write(blob)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, path)
+        if stale_path is not None and os.path.exists(stale_path):
+            os.remove(stale_path)
+        if on_written is not None:
+            on_written(len(blob))
+        done = time.perf_counter()
+
+        self.update_manager({
+            "type": "CHECKPOINT_WRITTEN",
+            **metrics,
+            "bytes": len(blob),
+            "queued-seconds": started - queued,
+            "write-seconds": done - started,
+            # From the start of the snapshot to the checkpoint being durable
+            "latency-seconds": metrics.get("snapshot-seconds", 0) + done - queued,
+            "time": time.time()
+        })
+
+    def flush(self):
+        """Wait for every checkpoint submitted so far, then raise the first error writing one raised"""
+        self.queue.join()
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise error
+
+    def close(self):
+        with self.lock:
+            thread, self.thread = self.thread, None
+        if thread is not None:
+            self.queue.put(None)
+            thread.join()
+        self.flush()
@@ -0,0 +1,61 @@
+import hashlib
+import threading
+from collections import OrderedDict
+
+class CompiledCodeCache:
+    """
+    Process-wide LRU cache of compiled cube code, keyed by (code hash, language, filename).
+    Compiling is done outside the lock, so two threads missing on the same code at the
+    same time may both compile it, the second result simply replaces the first.
+    """
+    def __init__(self, max_size=512):
+        self.max_size = max_size
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def key(code, language, filename):
+        return (hashlib.sha256(code.encode("utf-8")).hexdigest(), language, filename)
+
+    def get(self, code, language, filename="<string>", tree=None):
+        """
+        Return the code object for `code`, compiling it on a miss.
+        tree: optional already parsed ast.Module of `code`, saves parsing again on a miss
+        Raises SyntaxError like compile() does, nothing is cached in that case.
+        """
+        key = CompiledCodeCache.key(code, language, filename)
+        with self.lock:
+            compiled = self.entries.get(key)
+            if compiled is not None:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return compiled
+            self.misses += 1
+
+        compiled = compile(tree if tree is not None else code, filename, "exec")
+
+        with self.lock:
+            self.entries[key] = compiled
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+        return compiled
+
+    def resize(self, max_size):
+        with self.lock:
+            self.max_size = max_size
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+compiled_code_cache = CompiledCodeCache()
@@ -0,0 +1,244 @@
+import time
+import threading
+import weakref
+from collections import deque
+
+# Open streams, checked every TICK_SECONDS by one ticker thread. The ticker hands the due ones
+# to the emitter of their group (their flow), chunks are only emitted from there (and from close),
+# never from inside write: a callback running on the layer's thread that prints would otherwise
+# call back into update_manager while holding its lock
+_open_streams = weakref.WeakSet()
+_open_streams_lock = threading.Lock()
+_ticker = None
+TICK_SECONDS = 0.1
+# An emitter thread with nothing to emit for that long exits, the next due stream starts another
+EMITTER_IDLE_SECONDS = 1.0
+
+class _Emitter:
+    """
+    Emits the due streams of one group on a thread of its own, so a slow callback only holds up
+    the output of its own flow, not the ticker and every other flow's
+    """
+    def __init__(self):
+        self.cond = threading.Condition()
+        self.due = deque()
+        self.queued = set()
+        self.thread = None
+
+    def submit(self, stream):
+        with self.cond:
+            if stream in self.queued:
+                return
+            self.queued.add(stream)
+            self.due.append(stream)
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._run, name="riverbox-console-emitter", daemon=True)
+                self.thread.start()
+            self.cond.notify()
+
+    def _run(self):
+        while True:
+            with self.cond:
+                if not self.due:
+                    self.cond.wait(EMITTER_IDLE_SECONDS)
+                    if not self.due:
+                        self.thread = None
+                        return
+                stream = self.due.popleft()
+            try:
+                stream._flush_if_due()
+            finally:
+                with self.cond:
+                    self.queued.discard(stream)
+
+_emitters = weakref.WeakKeyDictionary() # group -> _Emitter
+_shared_emitter = _Emitter() # streams without a group
+
+def _emitter(group):
+    if group is None:
+        return _shared_emitter
+    with _open_streams_lock:
+        emitter = _emitters.get(group)
+        if emitter is None:
+            emitter = _emitters[group] = _Emitter()
+        return emitter
+
+def _tick():
+    while True:
+        time.sleep(TICK_SECONDS)
+        with _open_streams_lock:
+            streams = list(_open_streams)
+        for stream in streams:
+            if stream._is_due():
+                _emitter(stream.group).submit(stream)
+
+def _register(stream):
+    global _ticker
+    with _open_streams_lock:
+        _open_streams.add(stream)
+        if _ticker is None:
+            _ticker = threading.Thread(target=_tick, name="riverbox-console-ticker", daemon=True)
+            _ticker.start()
+
+def _unregister(stream):
+    with _open_streams_lock:
+        _open_streams.discard(stream)
+
+class ConsoleStream:
+    """
+    Console output of one layer, the stream ThreadStdoutRedirect points the layer's stdout at.
+
+    Output is handed to `emit(chunk, sequence)` in chunks of at most chunk_size characters, once
+    chunk_size characters are pending or the oldest pending output is flush_interval seconds
+    old (checked every TICK_SECONDS). A layer whose output never crosses either threshold
+    emits nothing, its output only goes out with the layer's final message like before.
+
+    Only the last tail_size characters are kept for getvalue, so a chatty layer holds a bounded
+    amount of text whatever it prints.
+
+    Pending output is capped at max_pending_chunks * chunk_size characters. A write past the cap
+    asks for a flush straight away and waits for it, for at most block_seconds, so a layer
+    printing faster than `emit` keeps up slows down to its pace. Past that the oldest pending
+    output is dropped, it is still in the tail, and the next chunk says how much was not streamed.
+    Emitting happens on the emitter thread of `group` (the flow), so a slow `emit` holds up
+    only the streams of its group.
+    """
+    def __init__(self, emit, chunk_size=64 * 1024, flush_interval=1.0, tail_size=1024 * 1024,
+                 max_pending_chunks=4, block_seconds=1.0, group=None):
+        self.emit = emit
+        self.chunk_size = chunk_size
+        self.flush_interval = flush_interval
+        self.tail_size = tail_size
+        self.max_pending = max_pending_chunks * chunk_size
+        self.block_seconds = block_seconds
+        self.group = group
+
+        self.lock = threading.Lock()
+        # Writers waiting for room in pending
+        self.drained = threading.Condition(self.lock)
+        # Held while chunks are taken and emitted so they go out in order
+        self.emit_lock = threading.Lock()
+        self.pending = deque()
+        self.pending_size = 0
+        self.pending_since = None
+        self.skipped = 0 # pending characters dropped since the last chunk
+        self.sequence = 0 # chunks emitted so far
+        self.tail = deque()
+        self.tail_length = 0
+        self.dropped = 0
+        self.closed = False
+        _register(self)
+
+    def writable(self):
+        return True
+
+    def write(self, text):
+        if not text:
+            return 0
+        with self.lock:
+            self.pending.append(text)
+            self.pending_size += len(text)
+            if self.pending_since is None:
+                self.pending_since = time.monotonic()
+            self._retain(text)
+            full = self.pending_size > self.max_pending
+            if full and self.closed:
+                # Nothing is emitted once closed
+                self._drop_excess()
+                full = False
+        if full:
+            _emitter(self.group).submit(self)
+            deadline = time.monotonic() + self.block_seconds
+            with self.lock:
+                while self.pending_size > self.max_pending and not self.closed:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self.drained.wait(remaining)
+                self._drop_excess()
+        return len(text)
+
+    def _drop_excess(self):
+        # Called with self.lock held, drops the oldest pending output past the cap
+        while self.pending_size > self.max_pending:
+            excess = self.pending_size - self.max_pending
+            first = self.pending[0]
+            if len(first) <= excess:
+                self.pending.popleft()
+                self.pending_size -= len(first)
+                self.skipped += len(first)
+            else:
+                self.pending[0] = first[excess:]
+                self.pending_size -= excess
+                self.skipped += excess
+
+    def flush(self):
+        # print(flush=True) and sys.stdout.flush() land here, chunks go out on the thresholds only
+        pass
+
+    def _retain(self, text):
+        # Called with self.lock held
+        self.tail.append(text)
+        self.tail_length += len(text)
+        while self.tail_length > self.tail_size:
+            excess = self.tail_length - self.tail_size
+            first = self.tail[0]
+            if len(first) <= excess:
+                self.tail.popleft()
+                self.tail_length -= len(first)
+                self.dropped += len(first)
+            else:
+                self.tail[0] = first[excess:]
+                self.tail_length -= excess
+                self.dropped += excess
+
+    def _is_due(self):
+        with self.lock:
+            return not self.closed and self.pending_since is not None and (
+                self.pending_size >= self.chunk_size or time.monotonic() - self.pending_since >= self.flush_interval)
+
+    def _flush_if_due(self):
+        with self.emit_lock:
+            if self._is_due():
+                self._emit_pending()
+
+    def _emit_pending(self):
+        # Called with self.emit_lock held
+        with self.lock:
+            text = "".join(self.pending)
+            if self.skipped:
+                text = f"[... {self.skipped} characters not streamed ...]\n" + text
+            self.pending = deque()
+            self.pending_size = 0
+            self.pending_since = None
+            self.skipped = 0
+            self.drained.notify_all()
+        for i in range(0, len(text), self.chunk_size):
+            self.sequence += 1
+            self.emit(text[i:i + self.chunk_size], self.sequence)
+
+    def getvalue(self):
+        """The retained tail of the output, noting how much was not kept"""
+        with self.lock:
+            text = "".join(self.tail)
+            self.tail = deque([text]) if text else deque()
+            if self.dropped:
+                return f"[... {self.dropped} characters of earlier output not kept ...]\n" + text
+            return text
+
+    def close(self):
+        _unregister(self)
+        with self.emit_lock:
+            if self.closed:
+                return
+            self.closed = True
+            if self.sequence > 0:
+                # Once anything was streamed, the stream gets the rest too
+                self._emit_pending()
+            else:
+                with self.lock:
+                    self.pending = deque()
+                    self.pending_size = 0
+                    self.pending_since = None
+                    self.skipped = 0
+                    self.drained.notify_all()
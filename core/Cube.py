@@ -1,54 +1,68 @@
-import ast
-import asyncio
 import uuid
 import time
 import json
-import traceback
-import threading
+import itertools
+from contextlib import ExitStack
 from .plain_python_exec import execute_code as plain_python_execute
 from .ipynb_exec import execute_code as ipynb_execute
+from .process_exec import execute_code as process_execute, ProcessLayerPool
 from .call_external_flow import call_external_flow
-
-class Edge:
-    def __init__(self, edge_body):
-        self.id = edge_body["id"]
-        self.end = edge_body["end"]
-        self.end_arg_key: str | int = edge_body["end-arg-key"]
-        self.kind = edge_body["kind"]
-        self.start_arg_key: str = edge_body["start-arg-key"]
-        self.fresh = False
-
-    def get_client_edge_metadata (self):
-        return {
-            "end": self.end,
-            "end-arg-key": self.end_arg_key,
-            "kind": self.kind,
-            "start-arg-key": self.start_arg_key
-        }
+from .SubflowDispatcher import RemoteSubflowError
+from .ResultCache import result_key
+from .PreparedFlow import PreparedCube
+from .ConsoleStream import ConsoleStream
+from .WorkerPool import TaskGroup
 
 class Arg:
-    def __init__ (self, map, value, keyword):
+    def __init__ (self, map, value, keyword, zip=False):
         self.map = map
         self.value = value
         self.keyword = keyword
+        # ZIP edges map too, but the zip args of a cube are paired element-wise instead of multiplied
+        self.zip = zip
 
-import io
+class ArgsError:
+    # Stands in for the args of a layer that can not run, the layer reports `message` as its
+    # error. Nothing is stored on the cube, the next execution of the cube starts clean
+    def __init__(self, message):
+        self.message = message
 
 class CubeExecutionLayer:
     def __init__(self, cube, args, layer):
         self.cube = cube
+        self.args_error = None
+        if isinstance(args, ArgsError):
+            self.args_error, args = args.message, {}
         self.args: Arg | dict[str, Arg] = args
         self.layer = layer
         self.errored = False
-        self.console_output = io.StringIO()
         self.execution_id = uuid.uuid4()
+        metadata = cube.flow.riverbox_metadata
+        self.console_output = ConsoleStream(self.emit_console_output,
+                                            chunk_size=metadata.get("console-chunk-size", 64 * 1024),
+                                            flush_interval=metadata.get("console-flush-interval", 1.0),
+                                            tail_size=metadata.get("console-tail-size", 1024 * 1024),
+                                            max_pending_chunks=metadata.get("console-max-pending-chunks", 4),
+                                            block_seconds=metadata.get("console-block-seconds", 1.0),
+                                            group=cube.flow)
         self.return_value = None
         self.next_function = None
 
+    def emit_console_output(self, chunk, sequence):
+        # Output of a layer that is still running, its final message has the retained tail
+        self.cube.flow.update_manager({
+            "type": "CUBE_CONSOLE_OUTPUT",
+            "cube-execution-id": str(self.execution_id),
+            "sequence": sequence,
+            "output": chunk,
+            "time": time.time()
+        })
+
     def get_client_box_metadata (self):
         return {
             "box": self.cube.get_client_box_metadata_for_flow(),
-            "layer": self.layer
+            "layer": self.layer,
+            "cube-execution-id": str(self.execution_id)
         }
 
     def print_override(self):
@@ -71,12 +85,24 @@ class CubeExecutionLayer:
         print("Error",message)
 
     def execute_code (self, global_vars, flow):
-        if flow.riverbox_metadata["language"] == "python":
+        if self.cube.process_pool is not None:
+            process_execute(self, global_vars, flow)
+        elif flow.riverbox_metadata["language"] == "python":
             plain_python_execute(self, global_vars, flow)
         elif flow.riverbox_metadata["language"] == "ipython":
-            plain_python_execute(self, global_vars, flow)
+            ipynb_execute(self, global_vars, flow)
 
     def execute(self, global_vars, flow):
+        with ExitStack() as measuring:
+            if flow.profile is not None:
+                measuring.enter_context(flow.profile.layer(self))
+            if flow.trace is not None:
+                measuring.enter_context(flow.trace.span(
+                    "layer", f"{self.cube.name} [{self.layer}]", flow.trace.cube_span_id(flow, self.cube),
+                    **{"cube-id": self.cube.id, "cube-execution-id": str(self.execution_id), "layer": self.layer}))
+            return self._execute(global_vars, flow)
+
+    def _execute(self, global_vars, flow):
         from .FlowExecution import FlowExecution
         # No local variables here
         # print("in cube execute, cube execution id and flow", self.execution_id, flow)
@@ -91,12 +117,27 @@ class CubeExecutionLayer:
             "time": time.time()
         })
         
-        if self.cube.pre_execution_error:
-            self.error(str(self.execution_id), flow, self.cube.pre_execution_error, "")
+        if self.cube.pre_execution_error or self.args_error:
+            self.error(str(self.execution_id), flow, self.cube.pre_execution_error or self.args_error, "")
             return None
         
         if self.cube.kind == "FLOW":
-            self.return_value = call_external_flow(*self.cube.sub_flow_args, self.args, self.cube.global_execution_count, self.layer, flow.env, self.execution_id)
+            # Subflows run here or through the subflow dispatcher report through this flow's update_manager,
+            # ones tracked by the cluster manager hand their result back through the callback
+            tracked = not self.cube.body["run-on-same"] and flow.subflow_dispatcher is None
+            callback = flow.callback_function if tracked else flow.update_manager
+            try:
+                # In process subflows run with the plan prepared alongside this flow's, not hashed per layer
+                prepared = flow.plan.cubes[flow.plan.index[self.cube.id]].subflow() if self.cube.body["run-on-same"] else None
+                self.return_value = call_external_flow(self.cube.body, flow.current_execution_metadata, callback, self.args,
+                                                       self.cube.global_execution_count, self.layer, flow.env, self.execution_id,
+                                                       flow_registry=flow.flow_registry, worker_pool=flow.worker_pool,
+                                                       dispatcher=flow.subflow_dispatcher, prepared=prepared)
+            except RemoteSubflowError as e:
+                self.errored = True
+                contents = self.console_output.getvalue()
+                self.console_output.close()
+                self.error(str(self.execution_id), flow, str(e), contents)
         
         elif self.cube.kind == "PARAM":
             if self.cube.arg_key and self.cube.arg_key in flow.args:
@@ -106,17 +147,40 @@ class CubeExecutionLayer:
             else:
                 self.return_value = self.cube.default_value
 
+        elif self.cube.deterministic:
+            cache_key = result_key(self.cube.code, flow.riverbox_metadata["language"], self.args, flow.env)
+            cached = flow.result_store.get(cache_key) if cache_key is not None else None
+            if cached is not None:
+                self.return_value, contents = cached
+                self.console_output.close()
+                flow.return_values.put(self.execution_id, self.return_value)
+                flow.update_manager({
+                    "type": "CACHED_CUBE_EXECUTION",
+                    "cube-execution-id": str(self.execution_id),
+                    "console-output": contents,
+                    **flow.preview_policy.fields(self.return_value, "return-value"),
+                    "cache-key": cache_key,
+                    "time": time.time()
+                })
+                return self.return_value
+
+            self.execute_code(global_vars, flow)
+            if cache_key is not None and not self.errored:
+                flow.result_store.put(cache_key, self.return_value, self.console_output.getvalue())
+
         else:
             self.execute_code(global_vars, flow)
 
         if not self.errored:
             contents = self.console_output.getvalue()
             self.console_output.close()
+            # Messages carry a preview, the full value is fetched with flow.get_return_value
+            flow.return_values.put(self.execution_id, self.return_value)
             flow.update_manager({
                 "type": "SUCCESSFUL_CUBE_EXECUTION",
                 "cube-execution-id": str(self.execution_id),
                 "console-output": contents,
-                "return-value": str(self.return_value),
+                **flow.preview_policy.fields(self.return_value, "return-value"),
                 "time": time.time()
             })
         
@@ -132,12 +196,21 @@ def has_same_underlying_cube (e1, e2):
             return False
     return True
 
+# Default number of map layers in flight per cube, "map-window" in cube or flow metadata overrides it
+DEFAULT_MAP_WINDOW = 256
+
 class CubeExecution:
     class NO_ARG_TYPE():
         pass
     NO_ARG = NO_ARG_TYPE()
     
-    def __init__(self, body, flow, global_execution_count = 0):
+    def __init__(self, body, flow, global_execution_count = 0, prepared: PreparedCube = None):
+        """
+        prepared: The PreparedCube of `body` from the flow's PreparedFlow. Without one the body
+                  is prepared here, with no edges until the FlowExecution sets the plan's
+        """
+        if prepared is None:
+            prepared = PreparedCube(body, flow.riverbox_metadata["language"])
         self.body = body
         self.flow = flow
 
@@ -145,7 +218,6 @@ class CubeExecution:
         self.kind = body["kind"]
         self.name = body["name"]
         self.global_execution_count = global_execution_count
-        self.executions = []
         
         if self.kind in ["PARAM", "RESULT"]:
             self.arg_key = body["arg-key"]
@@ -153,19 +225,14 @@ class CubeExecution:
         if self.kind == "REGULAR":
             self.code = body["code"]
         
-        if self.kind == "FLOW":
-            self.sub_flow_args = [body, flow.current_execution_metadata, flow.callback_function]
-
         if self.kind == "PARAM":
             try:
                 self.default_value = json.loads(body["default-value"])
             except:
                 self.default_value = body["default-value"]
         
-        if self.kind != "RESULT":
-            self.start_edges = [Edge(c) for c in body["start-edges"]]
-        else:
-            self.start_edges = []
+        # The plan's Edges, shared by every run. Their freshness is the flow's, see FlowExecution.edge_fresh
+        self.start_edges = prepared.start_edges
 
         # (Some of) these need to be set to a previous execution in case of debug mode
         # Look at `clone_for_new_execution` when changing
@@ -179,14 +246,16 @@ class CubeExecution:
         
         self.return_value = None
         self.map_type = False
-        
-        # Maximum 100 layers at the same time
-        self.layer_semaphore = threading.Semaphore(100)
 
-        try:
-            if self.kind == "REGULAR": self.ast_analyze(self.code)
-        except:
-            self.pre_execution_error = "\n\nERROR:\n" + traceback.format_exc() + "\n"
+        # Optional cap on layers of this cube running at once, the flow's pool bounds the rest
+        self.layer_limit = body.get("metadata", {}).get("max-concurrency")
+        # Deterministic cubes are pure functions of code, args and env, their layer results are cached
+        self.deterministic = self.kind == "REGULAR" and bool(body.get("metadata", {}).get("deterministic"))
+        self.process_pool = None
+
+        self.compiled_code = prepared.compiled_code
+        self.function_name = prepared.function_name
+        self.pre_execution_error = prepared.pre_execution_error
 
     def get_client_box_metadata_for_flow (self):
         return {
@@ -195,16 +264,17 @@ class CubeExecution:
             "edges-to": [e.get_client_edge_metadata() for e in self.start_edges]
         }
 
-    def clone_for_new_debug_execution (self, new_body, new_flow_obj):
+    def clone_for_new_debug_execution (self, new_body, new_flow_obj, prepared: PreparedCube = None):
         if has_same_underlying_cube(self.body, new_body):
             self.flow = new_flow_obj
             return self
-        c = CubeExecution(new_body, new_flow_obj, self.global_execution_count)
+        c = CubeExecution(new_body, new_flow_obj, self.global_execution_count, prepared=prepared)
 
         c.dont_run = self.dont_run
         c.started = self.started
         c.done = self.done
-        c.pre_execution_error = self.pre_execution_error
+        # A compile error in the new code wins over whatever the prior execution had
+        c.pre_execution_error = c.pre_execution_error or self.pre_execution_error
 
         c.num_layers = self.num_layers
         c.return_value = self.return_value
@@ -216,40 +286,40 @@ class CubeExecution:
     def __str__(self):
         return f"Cube {self.name} Execution"
 
-    def ast_analyze(self, code):
-        if self.flow.riverbox_metadata["language"] == "python":
-            module = ast.parse(code)
-            self.function_name = None
-            for expr in module.body:
-                if type(expr) == ast.FunctionDef:
-                    self.function_name = expr.name
-                    #self.args = [Arg(False, CubeExecution.NO_ARG, a.arg) for a in expr.args.args]
-                    break
-
-    async def thread_execute_layer(self, execution: CubeExecutionLayer, *args, **kwargs):
-        def execute_with_sema(execution, *args, **kwargs):
-            self.layer_semaphore.acquire()
-            #print("Started execution on layer", execution.layer)
-            rv = execution.execute(*args, **kwargs)
-            self.layer_semaphore.release()
-            return rv
-
-        return await asyncio.to_thread(execute_with_sema, execution, *args, **kwargs)
-
-    async def execute_multilayer(self, global_vars, layer_args, flow):
-        tasks = []
-        layer_num = 1
-        for layer in layer_args:
-            if layer_num > 1000:
-                # Maximum number of layers is 1000
-                break
-            execution = CubeExecutionLayer(self, layer, layer_num)
-            self.executions.append(execution)
-            tasks.append(asyncio.create_task(
-                self.thread_execute_layer(execution, global_vars, flow)))
-            layer_num += 1
-    
-        return [(await task) for task in tasks]
+    def execution_backend(self, flow):
+        # "thread" (default) or "process", cube metadata wins over flow metadata
+        return self.body.get("metadata", {}).get("execution-backend") or flow.riverbox_metadata.get("execution-backend", "thread")
+
+    def execute_multilayer(self, global_vars, layer_args, flow):
+        limit = self.layer_limit
+        if self.kind == "REGULAR" and self.execution_backend(flow) == "process":
+            # CPU bound layers run in worker processes, a layer task only waits on its process
+            self.process_pool = ProcessLayerPool(global_vars, flow.global_vars_lock, self.body.get("metadata", {}).get("max-processes"))
+            limit = min(limit or self.process_pool.max_workers, self.process_pool.max_workers)
+
+        # Layers are pulled from layer_args as the window frees up, so only `window` layers
+        # (their CubeExecutionLayer and console output) exist at any time, however many there are
+        window = self.body.get("metadata", {}).get("map-window") or flow.riverbox_metadata.get("map-window", DEFAULT_MAP_WINDOW)
+        results = []
+
+        def run_layer(index, layer):
+            results[index] = CubeExecutionLayer(self, layer, index + 1).execute(global_vars, flow)
+
+        try:
+            # Layers go on the flow's pool as their own task group, this thread runs layers too while it waits
+            group = TaskGroup(flow.worker_pool, limit)
+            for index, layer in enumerate(layer_args):
+                group.wait(lambda: group.outstanding() < window)
+                results.append(None)
+                group.submit(run_layer, index, layer)
+
+            group.join()
+        finally:
+            if self.process_pool is not None:
+                self.process_pool.shutdown()
+                self.process_pool = None
+
+        return results
 
     def propagate_return_value_along_edge (self, edge, next_function=None):
         # Based on return value of current Cube and the edge to the next cube, create
@@ -259,7 +329,7 @@ class CubeExecution:
         if next_function is None:
             next_function = self.flow.latest_cubes_lookup[edge.end]
 
-        edge.fresh = True
+        fresh = True
 
         if edge.start_arg_key is None:
             return_value_on_edge = self.return_value
@@ -275,16 +345,19 @@ class CubeExecution:
         elif isinstance(edge.start_arg_key, str) and edge.start_arg_key[0] == "-":
             return_value_on_edge = None
         else:
-            edge.fresh = False
+            fresh = False
             next_function.dont_run = True
 
-        if edge.end_arg_key is not None and edge.fresh:
-            next_arg = Arg(edge.kind == "MAP", return_value_on_edge, edge.end_arg_key)
+        if edge.end_arg_key is not None and fresh:
+            next_arg = Arg(edge.kind in ["MAP", "ZIP"], return_value_on_edge, edge.end_arg_key, edge.kind == "ZIP")
             if not isinstance(next_function.args, dict):
                 next_function.args = {}
             next_function.args[edge.end_arg_key] = next_arg
-        elif edge.fresh:
-            next_function.args = Arg(edge.kind == "MAP", return_value_on_edge, edge.end_arg_key)
+        elif fresh:
+            next_function.args = Arg(edge.kind in ["MAP", "ZIP"], return_value_on_edge, edge.end_arg_key, edge.kind == "ZIP")
+
+        # Marking the edge goes through the flow so the ready queue counters stay in sync
+        self.flow.set_edge_fresh(edge, fresh)
 
     def post_successful_execution (self, flow):
         if self.kind in ["REGULAR", "PARAM", "FLOW"]: # None of this needed for result
@@ -292,26 +365,31 @@ class CubeExecution:
                 next_function = flow.latest_cubes_lookup[edge.end]                
                 self.propagate_return_value_along_edge(edge, next_function)
 
-        for cube in flow.latest_cubes_lookup.values():
-            for edge in cube.start_edges:
-                if edge.end == self.id:
-                    edge.fresh = False
+        for edge in flow.incoming_edges.get(self.id, []):
+            flow.set_edge_fresh(edge, False)
 
         self.done = True
 
-    def get_args_layers (self):
-        layer_args = [dict()]
-        map_type = False
-        add_to_each = lambda arr, k,v: [{**kw, k:v} for kw in arr]
+    @staticmethod
+    def iswaiting (key):
+        # Negative numeric arg keys only order edges, they are never passed to the code
+        try:
+            return int(key) < 0
+        except ValueError:
+            return False
 
+    def get_args_layers (self):
+        """
+        Returns (map_type, layer args). Layer args is a lazy iterator, map layers are built one
+        at a time as the map executor pulls them, in the order of the nested loops: the later
+        map arg key varies slowest. ZIP args are paired element-wise and take the place of one
+        map arg, the first of them.
+        """
         #print("Getting args layers for cube", self.id, self.args, "flow is debug?", self.flow.is_debug())
         if self.flow.is_debug():
-            # try to find such an edge, if found, repropogate arguments
-            for cube in self.flow.latest_cubes_lookup.values():
-                for edge in cube.start_edges:
-                    if edge.end == self.id:
-                        # Match found, repropagate!
-                        cube.propagate_return_value_along_edge(edge)
+            # repropogate arguments along every edge ending here
+            for edge in self.flow.incoming_edges.get(self.id, []):
+                self.flow.latest_cubes_lookup[edge.start].propagate_return_value_along_edge(edge)
 
         if isinstance(self.args, Arg):
             if self.args.value is None:
@@ -319,36 +397,87 @@ class CubeExecution:
             elif not isinstance(self.args.value, dict):
                 # Args passed but not dict
                 self.pre_execution_error = f"ERROR in args, expected dict but is {type(self.args.value)}"
-                return False, [{}]
-
-            map_type = self.args.map
-            layer_args = [self.args.value] if not map_type else self.args.value
-
-        else:
-            for arg_key in self.args:
-                a = self.args[arg_key]
-                if not a.map and a.value is not CubeExecution.NO_ARG:
-                    layer_args = add_to_each(layer_args, a.keyword, a.value)
-                elif a.value is not CubeExecution.NO_ARG:
-                    map_type = True
-                    try:
-                        if isinstance(a.value, int):
-                            iterable = range(a.value)
-                        else:
-                            iterable = list(a.value)
-                    except TypeError:
-                        iterable = [a.value]
-                    layer_args = sum([add_to_each(layer_args, a.keyword, arg) for arg in iterable], [])
-
-        def iswaiting (s):
+                return False, iter([{}])
+
+            if not self.args.map:
+                return False, iter([self.remove_waiting_keys(self.args.value)])
+            return True, (self.remove_waiting_keys(args) for args in self.args.value)
+
+        # Static kwargs and waiting keys are worked out once per arg key, not once per layer
+        static_kwargs = {}
+        map_keys = []
+        map_iterables = []
+        zip_keys = []
+        zip_iterables = []
+        for arg_key in self.args:
+            a = self.args[arg_key]
+            if a.value is CubeExecution.NO_ARG:
+                continue
+            if not a.map:
+                if not CubeExecution.iswaiting(a.keyword):
+                    static_kwargs[a.keyword] = a.value
+                continue
             try:
-                return int(s) < 0
-            except ValueError:
-                return False
-
-        remove_numeric_keys = lambda d: {k: d[k] for k in d if not iswaiting(k)}
-        layer_args = [remove_numeric_keys(args) for args in layer_args]
-        return map_type, layer_args
+                if isinstance(a.value, int):
+                    iterable = range(a.value)
+                else:
+                    iterable = list(a.value)
+            except TypeError:
+                iterable = [a.value]
+            # A waiting key still multiplies the layers, its values are just not passed on
+            keyword = None if CubeExecution.iswaiting(a.keyword) else a.keyword
+            if keyword is not None:
+                # Placeholder, keeps the kwargs in arg order
+                static_kwargs[keyword] = None
+            if a.zip:
+                if not zip_keys:
+                    # All zip args share one slot of the product, where the first of them is
+                    map_keys.append(zip_keys)
+                    map_iterables.append(None)
+                zip_keys.append(keyword)
+                zip_iterables.append(iterable)
+            else:
+                map_keys.append(keyword)
+                map_iterables.append(iterable)
+
+        if not map_keys:
+            return False, iter([static_kwargs])
+
+        if zip_keys:
+            lengths = [len(iterable) for iterable in zip_iterables]
+            if len(set(lengths)) > 1:
+                return False, iter([ArgsError("ERROR in args, ZIP inputs must have the same length but got " +
+                                              ", ".join(f"{k}: {n}" for k, n in zip(zip_keys, lengths)))])
+            map_iterables[map_keys.index(zip_keys)] = zip(*zip_iterables)
+
+        # product varies its last iterable fastest, so reversing the keys makes the first map key fastest
+        map_keys.reverse()
+        map_iterables.reverse()
+
+        passed = [i for i, k in enumerate(map_keys) if k is not None and k is not zip_keys]
+        zipped = map_keys.index(zip_keys) if zip_keys else None
+
+        def layers():
+            for values in itertools.product(*map_iterables):
+                layer = static_kwargs.copy()
+                for i in passed:
+                    layer[map_keys[i]] = values[i]
+                if zipped is not None:
+                    for k, v in zip(zip_keys, values[zipped]):
+                        if k is not None:
+                            layer[k] = v
+                yield layer
+
+        return True, layers()
+
+    def remove_waiting_keys (self, args):
+        return {k: args[k] for k in args if not CubeExecution.iswaiting(k)}
+
+    def count_layers (self, layer_args):
+        self.num_layers = 0
+        for args in layer_args:
+            self.num_layers += 1
+            yield args
 
     def execute(self, flow: 'Flow'):
         self.started = True
@@ -358,14 +487,14 @@ class CubeExecution:
             layer_args = self.args.value
         else:
             self.map_type, layer_args = self.get_args_layers()
-            self.num_layers = len(layer_args)
+            layer_args = self.count_layers(layer_args)
 
         if self.kind == "RESULT":
             flow.add_result(self, layer_args)
             self.return_value = None
         elif not self.map_type:
-            self.return_value = CubeExecutionLayer(self, layer_args[0], 1).execute(flow.global_vars, flow)
+            self.return_value = CubeExecutionLayer(self, next(layer_args), 1).execute(flow.global_vars, flow)
         else:
-            self.return_value = asyncio.run(self.execute_multilayer(flow.global_vars, layer_args, flow))
+            self.return_value = self.execute_multilayer(flow.global_vars, layer_args, flow)
 
         self.post_successful_execution(flow)
@@ -0,0 +1,98 @@
+import time
+import queue
+import threading
+
+_STOP = object()
+
+class EventDispatcher:
+    """
+    Delivers update messages to the callback on a thread of its own, in the order they were
+    put, so cube threads never wait for a slow callback. A full queue (max_queued messages)
+    makes put block until the callback catches up.
+
+    If the callback has a `batch` attribute, that is called with lists of messages instead:
+    up to batch_size messages, or whatever arrived within flush_interval seconds of the first.
+
+    The first error the callback raises is kept and re-raised by flush/close, the messages
+    after it are still delivered.
+    """
+    def __init__(self, callback, max_queued=10000, flush_interval=0.05, batch_size=500):
+        self.callback = callback
+        self.batch_callback = getattr(callback, "batch", None)
+        self.max_queued = max_queued
+        self.flush_interval = flush_interval
+        self.batch_size = batch_size
+        self.queue = queue.Queue(max_queued)
+        self.thread = None
+        self.lock = threading.Lock()
+        self.error = None
+
+    def __getstate__(self):
+        return {"callback": self.callback, "max_queued": self.max_queued,
+                "flush_interval": self.flush_interval, "batch_size": self.batch_size}
+
+    def __setstate__(self, state):
+        self.__init__(**state)
+
+    def put(self, message):
+        with self.lock:
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._work, name="riverbox-event-dispatcher", daemon=True)
+                self.thread.start()
+        self.queue.put(message)
+
+    def _next_batch(self):
+        batch = [self.queue.get()]
+        if self.batch_callback is None or batch[0] is _STOP:
+            return batch
+        deadline = time.monotonic() + self.flush_interval
+        while len(batch) < self.batch_size and batch[-1] is not _STOP:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(self.queue.get(timeout=timeout))
+            except queue.Empty:
+                break
+        return batch
+
+    def _work(self):
+        while True:
+            batch = self._next_batch()
+            stop = batch[-1] is _STOP
+            messages = batch[:-1] if stop else batch
+            try:
+                if messages:
+                    self._deliver(messages)
+            finally:
+                for _ in batch:
+                    self.queue.task_done()
+            if stop:
+                return
+
+    def _deliver(self, messages):
+        if self.batch_callback is not None:
+            calls = [(self.batch_callback, messages)]
+        else:
+            calls = [(self.callback, m) for m in messages]
+        for fn, arg in calls:
+            try:
+                fn(arg)
+            except Exception as e:
+                if self.error is None:
+                    self.error = e
+
+    def flush(self):
+        """Wait until every message put so far is delivered, then raise the first callback error"""
+        self.queue.join()
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise error
+
+    def close(self):
+        with self.lock:
+            thread, self.thread = self.thread, None
+        if thread is not None:
+            self.queue.put(_STOP)
+            thread.join()
+        self.flush()
@@ -0,0 +1,172 @@
+import time
+import threading
+import tracemalloc
+from contextlib import contextmanager
+
+# Seconds summed per layer and per cube
+LAYER_FIELDS = ("wall-seconds", "cpu-seconds", "lock-wait-seconds", "callback-seconds")
+
+class TimedLock:
+    """A lock that adds the time spent waiting for it to the profile of whatever is running on the thread"""
+    def __init__(self, lock, profile):
+        self.lock = lock
+        self.profile = profile
+
+    def acquire(self, blocking=True, timeout=-1):
+        started = time.perf_counter()
+        acquired = self.lock.acquire(blocking, timeout)
+        self.profile.add("lock-wait-seconds", time.perf_counter() - started)
+        return acquired
+
+    def release(self):
+        self.lock.release()
+
+    def __enter__(self):
+        return self.acquire()
+
+    def __exit__(self, *exc_info):
+        self.release()
+
+class ExecutionProfile:
+    """
+    Where the time of one flow execution went, collected when flow metadata "profile" is set.
+
+    Per layer: wall and CPU time (time.thread_time, so CPU of process backend workers is not
+    in it), time waiting for global_vars_lock and time spent delivering update messages.
+    Per cube: the sums over its layers and runs, its own wall time and how long it waited
+    between becoming ready and starting (scheduler wait). Flow wide: the time spent finding
+    executable cubes.
+
+    memory: also track the tracemalloc peak per layer. tracemalloc is process wide, with layers
+            running at the same time a layer's peak includes what the others allocated
+    emit: optional function called with a PROFILE message at the end of every layer
+    """
+    def __init__(self, memory=False, emit=None):
+        self.memory = memory
+        self.emit = emit
+        self.lock = threading.Lock()
+        self.current = threading.local() # the record time on this thread is added to
+        self.cubes = {} # cube id -> record
+        self.ready_since = {} # cube id -> when it became ready
+        self.scheduler_seconds = 0.0
+        self.scheduler_calls = 0
+        self.started = None
+        self.finished = None
+        self.started_tracemalloc = False
+
+    def __getstate__(self):
+        # A restored execution starts a fresh profile
+        return {"memory": self.memory, "emit": self.emit}
+
+    def __setstate__(self, state):
+        self.__init__(**state)
+
+    def start(self):
+        self.started = time.perf_counter()
+        if self.memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+            self.started_tracemalloc = True
+
+    def stop(self):
+        self.finished = time.perf_counter()
+        if self.started_tracemalloc:
+            tracemalloc.stop()
+            self.started_tracemalloc = False
+
+    def add(self, field, seconds):
+        record = getattr(self.current, "record", None)
+        if record is not None:
+            record[field] += seconds
+
+    def cube_ready(self, cube_id):
+        # Called with the scheduler lock held
+        self.ready_since.setdefault(cube_id, time.perf_counter())
+
+    def scheduled(self, seconds):
+        with self.lock:
+            self.scheduler_seconds += seconds
+            self.scheduler_calls += 1
+
+    def _cube_record(self, cube):
+        with self.lock:
+            record = self.cubes.get(cube.id)
+            if record is None:
+                record = self.cubes[cube.id] = {
+                    "cube-id": cube.id, "name": cube.name, "runs": 0, "layers": 0, "scheduler-wait-seconds": 0.0,
+                    "cube-wall-seconds": 0.0, **dict.fromkeys(LAYER_FIELDS, 0.0), "peak-bytes": None}
+            return record
+
+    @contextmanager
+    def _measuring(self, record):
+        previous = getattr(self.current, "record", None)
+        self.current.record = record
+        try:
+            yield
+        finally:
+            self.current.record = previous
+
+    @contextmanager
+    def cube(self, cube):
+        """Measure one run of `cube`, from FlowExecution.run_cube"""
+        record = self._cube_record(cube)
+        started = time.perf_counter()
+        with self.lock:
+            record["runs"] += 1
+            record["scheduler-wait-seconds"] += started - self.ready_since.pop(cube.id, started)
+        # Time outside of the layers (propagating, results, ...) counts for the cube itself
+        own = dict.fromkeys(LAYER_FIELDS, 0.0)
+        try:
+            with self._measuring(own):
+                yield
+        finally:
+            with self.lock:
+                record["cube-wall-seconds"] += time.perf_counter() - started
+                record["lock-wait-seconds"] += own["lock-wait-seconds"]
+                record["callback-seconds"] += own["callback-seconds"]
+
+    @contextmanager
+    def layer(self, cube_execution_layer):
+        """Measure one CubeExecutionLayer.execute"""
+        record = dict.fromkeys(LAYER_FIELDS, 0.0)
+        if self.memory:
+            tracemalloc.reset_peak()
+        started, started_cpu = time.perf_counter(), time.thread_time()
+        try:
+            with self._measuring(record):
+                yield
+        finally:
+            record["wall-seconds"] = time.perf_counter() - started
+            record["cpu-seconds"] = time.thread_time() - started_cpu
+            peak = tracemalloc.get_traced_memory()[1] if self.memory and tracemalloc.is_tracing() else None
+
+            cube = cube_execution_layer.cube
+            cube_record = self._cube_record(cube)
+            with self.lock:
+                cube_record["layers"] += 1
+                for field in LAYER_FIELDS:
+                    cube_record[field] += record[field]
+                if peak is not None:
+                    cube_record["peak-bytes"] = max(cube_record["peak-bytes"] or 0, peak)
+
+            if self.emit is not None:
+                self.emit({
+                    "type": "PROFILE",
+                    "cube-id": cube.id,
+                    "cube-execution-id": str(cube_execution_layer.execution_id),
+                    "layer": cube_execution_layer.layer,
+                    **record,
+                    "peak-bytes": peak,
+                    "time": time.time()
+                })
+
+    def report(self):
+        """Flow wide figures and one entry per cube that ran, slowest (by wall time) first"""
+        with self.lock:
+            cubes = sorted((dict(r) for r in self.cubes.values()), key=lambda r: r["cube-wall-seconds"], reverse=True)
+            end = self.finished if self.finished is not None else time.perf_counter()
+            return {
+                "wall-seconds": end - self.started if self.started is not None else 0.0,
+                "scheduler-seconds": self.scheduler_seconds,
+                "scheduler-calls": self.scheduler_calls,
+                "cubes": cubes
+            }
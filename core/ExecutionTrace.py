@@ -0,0 +1,176 @@
+import json
+import time
+import threading
+from contextlib import contextmanager
+
+_local = threading.local() # stack of (recorder, span id) open on this thread
+
+class TraceRecorder:
+    """
+    Spans of a flow execution: the flow, each run of a cube and each layer, with the span they
+    ran under. In process subflows created while a span is open on the thread (a FLOW cube's
+    layer, rbxm.call) record into the same recorder, their flow span a child of that layer.
+
+    From the spans of one flow execution it works out the measured critical path, the chain of
+    cube runs that bounded its end to end time, and each cube's slack, how much later it could
+    have finished without delaying the end. chrome_trace() exports everything in the Chrome
+    trace event format, which chrome://tracing and Perfetto open.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.origin = time.perf_counter()
+        self.spans = []
+        self.open_cube_spans = {} # (flow execution id, cube id) -> span id of its running cube span
+
+    def __getstate__(self):
+        # A restored execution starts a fresh trace
+        return {}
+
+    def __setstate__(self, state):
+        self.__init__()
+
+    @staticmethod
+    def active():
+        """(recorder, span id) of the innermost span open on this thread, or (None, None)"""
+        stack = getattr(_local, "stack", None)
+        return stack[-1] if stack else (None, None)
+
+    @contextmanager
+    def span(self, kind, name, parent=None, **args):
+        """Record the time spent in the block as a span, yields its id"""
+        with self.lock:
+            span_id = len(self.spans)
+            span = {"id": span_id, "parent": parent, "kind": kind, "name": name, "thread": threading.get_ident(),
+                    "start": time.perf_counter() - self.origin, "end": None, **args}
+            self.spans.append(span)
+        stack = getattr(_local, "stack", None)
+        if stack is None:
+            stack = _local.stack = []
+        stack.append((self, span_id))
+        try:
+            yield span_id
+        finally:
+            stack.pop()
+            span["end"] = time.perf_counter() - self.origin
+
+    @contextmanager
+    def cube_span(self, flow, cube, parent):
+        """A run of `cube`, with the cubes it takes inputs from so the critical path can follow them"""
+        upstream = sorted({edge.start for edge in flow.incoming_edges.get(cube.id, [])})
+        with self.span("cube", cube.name, parent, **{"cube-id": cube.id, "execution-id": flow.execution_id,
+                                                    "global-execution-count": cube.global_execution_count,
+                                                    "upstream": upstream}) as span_id:
+            key = (flow.execution_id, cube.id)
+            with self.lock:
+                self.open_cube_spans[key] = span_id
+            try:
+                yield span_id
+            finally:
+                with self.lock:
+                    self.open_cube_spans.pop(key, None)
+
+    def cube_span_id(self, flow, cube):
+        with self.lock:
+            return self.open_cube_spans.get((flow.execution_id, cube.id))
+
+    def _cube_spans(self, execution_id):
+        with self.lock:
+            return [dict(s) for s in self.spans if s["kind"] == "cube" and s["execution-id"] == execution_id and s["end"] is not None]
+
+    def _dependencies(self, spans):
+        # A cube run depends on the last run of each cube it takes inputs from that ended before it started
+        by_cube = {}
+        for span in spans:
+            by_cube.setdefault(span["cube-id"], []).append(span)
+        predecessors = {}
+        for span in spans:
+            predecessors[span["id"]] = []
+            for upstream in span["upstream"]:
+                finished = [s for s in by_cube.get(upstream, []) if s["end"] <= span["start"] and s["id"] != span["id"]]
+                if finished:
+                    predecessors[span["id"]].append(max(finished, key=lambda s: s["end"]))
+        return predecessors
+
+    def root_execution_id(self):
+        with self.lock:
+            for span in self.spans:
+                if span["kind"] == "flow" and span["parent"] is None:
+                    return span["execution-id"]
+        return None
+
+    def critical_path(self, execution_id=None):
+        """
+        The cube runs of one flow execution (the outermost one by default) that bounded its end,
+        first to last. Each carries "wait-seconds", the time between its predecessor on the path
+        ending and it starting, time lost to scheduling rather than to the cubes.
+        """
+        execution_id = execution_id or self.root_execution_id()
+        spans = self._cube_spans(execution_id)
+        if not spans:
+            return []
+        predecessors = self._dependencies(spans)
+        path = [max(spans, key=lambda s: s["end"])]
+        while predecessors[path[-1]["id"]]:
+            path.append(max(predecessors[path[-1]["id"]], key=lambda s: s["end"]))
+        path.reverse()
+        previous_end = self._flow_start(execution_id)
+        for span in path:
+            span["duration-seconds"] = span["end"] - span["start"]
+            span["wait-seconds"] = max(0.0, span["start"] - previous_end)
+            previous_end = span["end"]
+        return path
+
+    def _flow_start(self, execution_id):
+        with self.lock:
+            starts = [s["start"] for s in self.spans if s["kind"] == "flow" and s.get("execution-id") == execution_id]
+        return min(starts) if starts else 0.0
+
+    def slack(self, execution_id=None):
+        """cube id -> seconds the cube could have finished later without delaying the flow's last cube"""
+        execution_id = execution_id or self.root_execution_id()
+        spans = self._cube_spans(execution_id)
+        if not spans:
+            return {}
+        predecessors = self._dependencies(spans)
+        successors = {s["id"]: [] for s in spans}
+        for span in spans:
+            for predecessor in predecessors[span["id"]]:
+                successors[predecessor["id"]].append(span)
+
+        # Latest finish, from the last cube backwards: a run must end before its successors'
+        # latest start, the runs nothing depends on before the end of the flow
+        flow_end = max(s["end"] for s in spans)
+        latest_finish = {}
+        for span in sorted(spans, key=lambda s: s["end"], reverse=True):
+            latest_finish[span["id"]] = min(
+                [latest_finish[s["id"]] - (s["end"] - s["start"]) for s in successors[span["id"]]] or [flow_end])
+
+        slack = {}
+        for span in spans:
+            seconds = max(0.0, latest_finish[span["id"]] - span["end"])
+            slack[span["cube-id"]] = min(slack.get(span["cube-id"], seconds), seconds)
+        return slack
+
+    def chrome_trace(self):
+        """The spans as Chrome trace events, the critical path of the outermost flow marked "critical" """
+        critical = {s["id"] for s in self.critical_path()}
+        with self.lock:
+            spans = [dict(s) for s in self.spans if s["end"] is not None]
+        events = []
+        for span in spans:
+            args = {k: v for k, v in span.items() if k not in ("name", "start", "end", "thread")}
+            events.append({
+                "name": span["name"],
+                "cat": span["kind"] + (",critical" if span["id"] in critical else ""),
+                "ph": "X",
+                "ts": span["start"] * 1e6,
+                "dur": (span["end"] - span["start"]) * 1e6,
+                "pid": 1,
+                "tid": span["thread"],
+                "args": args
+            })
+        return {"traceEvents": events, "displayTimeUnit": "ms"}
+
+    def write_chrome_trace(self, path):
+        with open(path, "w") as f:
+            json.dump(self.chrome_trace(), f, default=str)
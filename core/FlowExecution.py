@@ -1,12 +1,31 @@
 from .Cube import CubeExecution
-import asyncio
+from .WorkerPool import WorkerPool, TaskGroup, DEFAULT_MAX_WORKERS
+from .ResultCache import disk_result_store, default_result_store
+from .ipynb_exec import default_shell_pool
+from .CheckpointWriter import CheckpointWriter
+from .CheckpointManifest import CheckpointManifest
+from . import oob_buffers
+from .EventDispatcher import EventDispatcher
+from .Preview import PreviewPolicy, ReturnValues
+from .PreparedFlow import prepared_flow_cache
+from .ExecutionProfile import ExecutionProfile, TimedLock
+from .ExecutionTrace import TraceRecorder
+from .GlobalFingerprints import GlobalFingerprints, reached_names
+from contextlib import ExitStack
 import threading
 import time
 import os
 import dill
 
+# Flow level state a delta checkpoint carries, the rest is static or rebuilt on load
+DELTA_FLOW_STATE = ["global_execution_count", "results", "result_label", "args", "edge_fresh"]
+
+def cube_state(cube):
+    # What a delta checkpoint keeps of a cube, everything but the back reference to the flow and the plan's edges
+    return {k: v for k, v in cube.__dict__.items() if k not in ("flow", "process_pool", "start_edges")}
+
 class FlowExecution:
-    def __init__(self, riverbox_flow_full, current_exec_metadata, callback_function, execution_type, cube_id, debug_state: 'FlowExecution', dump_state_folder=None, flow_registry=None):
+    def __init__(self, riverbox_flow_full, current_exec_metadata, callback_function, execution_type, cube_id, debug_state: 'FlowExecution', dump_state_folder=None, flow_registry=None, worker_pool: WorkerPool=None, max_workers=None, result_store=None, shell_pool=None, subflow_dispatcher=None, prepared=None):
         """
         riverbox_flow_full: Full riverbox flow dict with metadata and env
         current_exec_metadata: dict with execution-id, flow-id, invocation-id, parent-cube-execution-id
@@ -17,6 +36,17 @@ class FlowExecution:
         debug_state: If in debug mode, the prior FlowExecution state to use for global vars and cube states
         dump_state_folder: If provided, folder to dump execution state after each global execution count
         flow_registry: Optional dict of flow_name to riverbox_flow_full dicts for subflow calls in code
+        worker_pool: Optional WorkerPool to run cubes and layers on, e.g. WorkerPool.shared() to use one
+                     pool per process. By default every FlowExecution gets its own pool, in process
+                     subflows get their caller's
+        max_workers: Size of the FlowExecution's own pool, defaults to metadata "max-workers" or DEFAULT_MAX_WORKERS
+        result_store: Optional ResultStore for the results of cubes with "deterministic" metadata. Defaults to
+                      the shared DiskResultStore of metadata "result-cache-dir" if set, else the in-memory default_result_store
+        shell_pool: Optional ShellPool for the "ipython" language, defaults to default_shell_pool
+        subflow_dispatcher: Optional SubflowDispatcher running the subflows that are not "run-on-same" on
+                            remote workers. Without one they are handed to the callback as TRACK_EXTERNAL_SUBFLOW
+        prepared: Optional PreparedFlow of `riverbox_flow_full`, e.g. a subflow's from its FLOW cube. By
+                  default it is looked up in prepared_flow_cache by the flow's version
         """
 
         self.current_execution_metadata = current_exec_metadata
@@ -34,10 +64,89 @@ class FlowExecution:
         self.dump_state_folder = dump_state_folder
         self.num_running_cubes = 0
 
+        # Checkpoints are deltas of the global vars changed and cubes touched since the last one,
+        # with a full snapshot every "checkpoint-full-every" checkpoints, see _dump_state
+        self.global_fingerprints = GlobalFingerprints()
+        # Global vars layers wrote or could have changed in place since the last checkpoint. With
+        # "checkpoint-fingerprint-all" every global var is fingerprinted instead, see GlobalFingerprints
+        self.reached_global_names = set()
+        self.fingerprint_all_globals = self.riverbox_metadata.get("checkpoint-fingerprint-all", False)
+        self.dirty_cube_ids = set()
+        self.last_checkpoint = None
+        self.checkpoints_since_full = 0
+        self.full_checkpoint_every = self.riverbox_metadata.get("checkpoint-full-every", 10)
+        self.checkpoint_buffer_threshold = self.riverbox_metadata.get("checkpoint-buffer-threshold", 1024 * 1024)
+        # "write": large buffers are written to their files before the next cubes run, "copy": they
+        # are copied in memory and written by the writer thread, faster but twice their size at peak
+        self.checkpoint_buffers = self.riverbox_metadata.get("checkpoint-buffers", "write")
+        self.checkpoint_writer = CheckpointWriter(self.update_manager, self.riverbox_metadata.get("checkpoint-queue-size", 4))
+        self.checkpoint_manifest = None
+        if dump_state_folder is not None:
+            self.checkpoint_manifest = CheckpointManifest(
+                dump_state_folder, f"flow_id_{self.flow_id}_execution_id_{self.execution_id}",
+                keep_last=self.riverbox_metadata.get("checkpoint-keep-last"),
+                keep_every=self.riverbox_metadata.get("checkpoint-keep-every"))
+
+        # Cubes and their layers run on one bounded pool, cube level work is one task group.
+        # In process subflows get their caller's pool, "max-running-cubes" is a flow's share of it
+        self.owns_worker_pool = worker_pool is None
+        if worker_pool is None:
+            worker_pool = WorkerPool(max_workers or self.riverbox_metadata.get("max-workers", DEFAULT_MAX_WORKERS))
+        self.worker_pool = worker_pool
+        self.cube_group = TaskGroup(self.worker_pool, self.riverbox_metadata.get("max-running-cubes"))
+
+        if result_store is None:
+            if self.riverbox_metadata.get("result-cache-dir"):
+                result_store = disk_result_store(self.riverbox_metadata["result-cache-dir"])
+            else:
+                result_store = default_result_store
+        self.result_store = result_store
+
+        # "ipython" layers borrow warm shells, "ipython-warm-shells" are built ahead of the first layer
+        self.shell_pool = shell_pool if shell_pool is not None else default_shell_pool
+        self.subflow_dispatcher = subflow_dispatcher
+        if self.riverbox_metadata.get("language") == "ipython":
+            self.shell_pool.warm(self.riverbox_metadata.get("ipython-warm-shells", 2))
+
         self.execution_type = execution_type
         assert self.execution_type in ["FULL", "ONLY", "UPTO", "DEBUG_ONLY", "DEBUG_UPTO", "DEBUG_NEXT", "DEBUG_START"]
 
         self.callback_function = callback_function
+        self.preview_policy = PreviewPolicy(
+            max_length=self.riverbox_metadata.get("preview-max-length", 1000),
+            max_items=self.riverbox_metadata.get("preview-max-items", 20),
+            marker=self.riverbox_metadata.get("preview-marker", "... [truncated]"))
+        # Full return values of the last "return-values-keep" cube executions, messages only carry previews
+        self.return_values = ReturnValues(self.riverbox_metadata.get("return-values-keep", 1000))
+
+        # With "event-dispatch": "queued" messages are delivered by a dispatcher thread, see EventDispatcher
+        self.event_dispatcher = None
+        if self.riverbox_metadata.get("event-dispatch") == "queued":
+            self.event_dispatcher = EventDispatcher(
+                callback_function,
+                max_queued=self.riverbox_metadata.get("event-queue-size", 10000),
+                flush_interval=self.riverbox_metadata.get("event-flush-interval", 0.05),
+                batch_size=self.riverbox_metadata.get("event-batch-size", 500))
+
+        # With "profile" set, where the time went is measured per cube and layer, see ExecutionProfile.
+        # "profile-events" adds a PROFILE message per layer, "profile-memory" tracemalloc peaks
+        self.profile = None
+        if self.riverbox_metadata.get("profile"):
+            self.profile = ExecutionProfile(memory=self.riverbox_metadata.get("profile-memory", False),
+                                            emit=self.update_manager if self.riverbox_metadata.get("profile-events") else None)
+
+        # With "trace" or "trace-file" set, flow, cube and layer spans are recorded, see TraceRecorder.
+        # A subflow started inside a traced layer records into its caller's trace, under that layer
+        self.trace, self.trace_parent = TraceRecorder.active()
+        if self.trace is None and (self.riverbox_metadata.get("trace") or self.riverbox_metadata.get("trace-file")):
+            self.trace = TraceRecorder()
+        self.trace_span = None
+
+        # Parsed and compiled once per flow version, subflows called once per layer reuse it. The
+        # run keeps its state in arrays indexed by the plan, the plan's edges are shared
+        if prepared is None:
+            prepared = prepared_flow_cache.get(riverbox_flow_full)
+        self.plan = prepared
 
         if debug_state is not None:
             print("Initializing FlowExecution in debug mode with prior execution state at global execution count", debug_state.global_execution_count)
@@ -45,14 +154,26 @@ class FlowExecution:
                 self.prior_debug_execution_object = debug_state
                 self.global_vars = debug_state.global_vars
                 self.global_vars_lock = debug_state.global_vars_lock
+                # Shared with the prior state until the first commit, see commit_global_vars
+                self.global_vars_shared = True
             print("Global vars at start of debug:", self.global_vars)
 
             self.cubes: list[CubeExecution] = []
-            for c in riverbox_flow["cubes"]:
+            for c, prepared_cube in zip(riverbox_flow["cubes"], prepared.cubes):
                 if c["id"] in debug_state.latest_cubes_lookup:
-                    self.cubes.append(debug_state.latest_cubes_lookup[c['id']].clone_for_new_debug_execution(c, self))
+                    self.cubes.append(debug_state.latest_cubes_lookup[c['id']].clone_for_new_debug_execution(c, self, prepared_cube))
                 else:
-                    self.cubes.append(CubeExecution(c, self))
+                    self.cubes.append(CubeExecution(c, self, prepared=prepared_cube))
+
+            # Reused cubes may come from another version of the flow, their edges are this plan's now
+            for cube, edges in zip(self.cubes, prepared.outgoing):
+                cube.start_edges = edges
+            # Edges of reused cubes stay as fresh as they were, those of changed cubes start out stale
+            self.edge_fresh = bytearray(len(prepared.edges))
+            for edge in prepared.edges:
+                prior = debug_state.plan.edge_index.get(edge.id)
+                if prior is not None and self.cubes[edge.start_index] is debug_state.latest_cubes_lookup.get(edge.start):
+                    self.edge_fresh[edge.index] = debug_state.edge_fresh[prior]
 
             self.global_execution_count = debug_state.global_execution_count
             self.env = debug_state.env
@@ -64,12 +185,22 @@ class FlowExecution:
 
             self.global_vars = {}
             self.global_vars_lock = threading.Lock()
+            self.global_vars_shared = False
             self.prior_debug_execution_object = None
 
-            self.cubes = [CubeExecution(c, self) for c in riverbox_flow["cubes"]]
+            self.cubes = [CubeExecution(c, self, prepared=prepared_cube) for c, prepared_cube in zip(riverbox_flow["cubes"], prepared.cubes)]
+            self.edge_fresh = bytearray(len(prepared.edges)) # per plan edge index, 1 if fresh
             self.global_execution_count = 0
+
+        if self.profile is not None:
+            lock = self.global_vars_lock.lock if isinstance(self.global_vars_lock, TimedLock) else self.global_vars_lock
+            self.global_vars_lock = TimedLock(lock, self.profile)
         
         self.latest_cubes_lookup = {c.id: c for c in self.cubes} # latest_cubes_lookup only has latest executions for quick lookup
+        self.incoming_edges = prepared.incoming # cube id -> Edges ending at it
+
+        self.scheduler_lock = threading.RLock()
+        self.callback_lock = threading.Lock()
 
         self.execution_main_cube_id = cube_id
         if self.execution_type == "UPTO" or self.execution_type == "DEBUG_UPTO":
@@ -82,189 +213,332 @@ class FlowExecution:
                 cube.done = False
                 cube.started = False
                 cube.dont_run = False
-        
-        self.scheduler_lock = threading.Lock()
-        self.callback_lock = threading.Lock()
+
+        self.init_ready_queue(new_run=debug_state is None)
     
+    def __getstate__ (self):
+        # Checkpoints are taken while the scheduler lock is held, a held lock can not be restored
+        # on another thread. get_flow_from_checkpoint_filename creates new locks. The plan is
+        # the process's, it is looked up again on load
+        return {k: v for k, v in self.__dict__.items() if k not in ("global_vars_lock", "scheduler_lock", "callback_lock", "plan", "incoming_edges")}
+
+    def __setstate__ (self, state):
+        self.__dict__.update(state)
+        self.plan = prepared_flow_cache.get(self.riverbox_flow_full)
+        self.incoming_edges = self.plan.incoming
+
     def is_debug (self):
         return self.execution_type in ["DEBUG_START", "DEBUG_ONLY", "DEBUG_UPTO", "DEBUG_NEXT"]
 
     def calculate_critical_path_upto (self, cube_id):
-        all_nodes_ids = set()
-        def go_deep(start_cube, target_cube_id, visited=set()):
-            nonlocal all_nodes_ids
-            """
-            Keep going to the next node until you:
-              - Hit the target node: return set of nodes on path
-              - Come back to the same node: return None
-              - Reach a node where there is no next node: return empty set but try again from the previous
-
-            """
-            print("in go deep, start", start_cube.id, "target", target_cube_id)
-            if start_cube.id in visited:
-                return
-            visited = visited.union({start_cube.id})
-            
-            if start_cube.id == target_cube_id:
-                all_nodes_ids = all_nodes_ids.union(visited)
-                return
-            
-            if start_cube.start_edges == []:
+        # Every cube with a path to cube_id, in flow order. A cycle on the way is taken whole,
+        # the cubes feeding the loop back run too. O(edges), walked on the plan
+        return {self.cubes[i].id: self.cubes[i] for i in sorted(self.plan.upstream(cube_id))}
+
+    def init_ready_queue(self, new_run=False):
+        """
+        Build the incremental scheduler state, arrays indexed by the plan. For every cube that
+        can be scheduled in this execution, fresh_input_counts keeps the number of fresh incoming
+        edges per input arg key (in the key's input slot) and pending_input_counts, per cube
+        index, the number of arg keys still waiting for a fresh edge. A cube goes on the ready
+        queue when that number hits zero, or straight away if it has no incoming edges and is
+        not done. Only edges between schedulable cubes are counted, like the full rescan used to do.
+        new_run: A new run of the whole flow, with no edge fresh and no cube done yet. It takes
+                 its counts from the plan's input arg keys without looking at the edges
+        """
+        plan = self.plan
+        if self.execution_type in ["ONLY", "DEBUG_ONLY"]:
+            self.scheduled_cubes = {}
+        elif self.execution_type in ["UPTO", "DEBUG_UPTO"]:
+            self.scheduled_cubes = self.critical_path_upto
+        else:
+            self.scheduled_cubes = self.latest_cubes_lookup
+
+        self.fresh_input_counts = [0] * plan.num_inputs
+        self.pending_input_counts = [len(keys) for keys in plan.input_arg_keys]
+        self.ready_cubes = {}
+        self.running_cube_ids = set()
+
+        if new_run and self.scheduled_cubes is self.latest_cubes_lookup:
+            for cube, keys in zip(self.cubes, plan.input_arg_keys):
+                if not keys:
+                    self.ready_cubes[cube.id] = cube
+            return
+
+        counted = bytearray(plan.num_inputs) # input slots with an edge from a schedulable cube
+        for cube in self.scheduled_cubes.values():
+            for edge in cube.start_edges:
+                if edge.end in self.scheduled_cubes:
+                    counted[edge.input_slot] = 1
+                    self.fresh_input_counts[edge.input_slot] += self.edge_fresh[edge.index]
+
+        for id, cube in self.scheduled_cubes.items():
+            i = plan.index[id]
+            slots = [slot for slot in range(plan.input_offsets[i], plan.input_offsets[i] + len(plan.input_arg_keys[i])) if counted[slot]]
+            if slots:
+                pending = sum(1 for slot in slots if self.fresh_input_counts[slot] == 0)
+                self.pending_input_counts[i] = pending
+                if pending == 0:
+                    self.ready_cubes[id] = cube
+            elif not cube.done:
+                self.ready_cubes[id] = cube
+
+    def set_edge_fresh(self, edge, fresh):
+        # All changes to edge_fresh go through here so the ready queue is updated in O(1)
+        with self.scheduler_lock:
+            # Propagating along the edge may have changed the args of its end cube either way
+            self.dirty_cube_ids.add(edge.start)
+            self.dirty_cube_ids.add(edge.end)
+            if self.edge_fresh[edge.index] == fresh:
                 return
-            
-            for edge in start_cube.start_edges:
-                go_deep(self.latest_cubes_lookup[edge.end], target_cube_id, visited)
-                
-        cube_set = set(self.latest_cubes_lookup.keys())
-        for cube in self.cubes:
-            try:
-                for edge in cube.start_edges:
-                    cube_set.remove(edge.end)
-            except KeyError:
-                pass
+            self.edge_fresh[edge.index] = fresh
 
-        for id in cube_set:
-            go_deep(self.latest_cubes_lookup[id], cube_id)
+            if edge.start not in self.scheduled_cubes or edge.end not in self.scheduled_cubes:
+                return
 
-        return {id: self.latest_cubes_lookup[id] for id in all_nodes_ids}
+            count = self.fresh_input_counts[edge.input_slot]
+            self.fresh_input_counts[edge.input_slot] = count + 1 if fresh else count - 1
+
+            end = edge.end_index
+            if fresh and count == 0:
+                self.pending_input_counts[end] -= 1
+                if self.pending_input_counts[end] == 0:
+                    self.ready_cubes[edge.end] = self.latest_cubes_lookup[edge.end]
+                    if self.profile is not None:
+                        self.profile.cube_ready(edge.end)
+            elif not fresh and count == 1:
+                self.pending_input_counts[end] += 1
+                if self.pending_input_counts[end] == 1:
+                    self.ready_cubes.pop(edge.end, None)
 
     def find_executables(self):
-        executables = {}
         with self.scheduler_lock:
             if self.execution_type in ["ONLY", "DEBUG_ONLY"]:
                 return {self.execution_main_cube_id: self.latest_cubes_lookup[self.execution_main_cube_id]}
 
-            if self.execution_type in ["FULL", "DEBUG_NEXT"]:
-                executables = {**self.latest_cubes_lookup}
-            elif self.execution_type in ["UPTO", "DEBUG_UPTO"]:
-                executables = {**self.critical_path_upto}
-            
             # If debug, try to repropogate as much as possible
             # If a node has an incoming edge from a node that has executed, but the edge was not fresh,
             # then repropogate the return value along that edge
 
             if self.is_debug():
-                for cube in executables.values():
+                for cube in list(self.scheduled_cubes.values()):
                     if cube.done:
                         for edge in cube.start_edges:
-                            if edge.end not in executables:
+                            if edge.end not in self.scheduled_cubes:
                                 continue
-                            dest = executables[edge.end]
-                            if not dest.started and not dest.done and not edge.fresh:
-                                executables[edge.end].propagate_return_value_along_edge(edge)
-
-            # Find nodes with no incoming edges, start_nodes that are not done, along with 
-            # nodes with all fresh incoming edges, fresh_nodes
-
-            start_nodes = {id: cube for id, cube in executables.items() if not cube.done}
-            fresh_node_inputs = {} # keep track of input arg keys and whether at least one fresh edge points to it
-            
-            for cube_id in executables:
-                cube = self.latest_cubes_lookup[cube_id]
-
-                for edge in cube.start_edges:
-                    if edge.end in start_nodes:
-                        del start_nodes[edge.end]
-                    
-                    if edge.end not in executables:
-                        continue
-
-                    if edge.end not in fresh_node_inputs:
-                        fresh_node_inputs[edge.end] = {}
-                    
-                    inputs = fresh_node_inputs[edge.end]
-
-                    if edge.fresh:
-                        inputs[edge.end_arg_key] = True
-                    elif edge.end_arg_key not in inputs:
-                        inputs[edge.end_arg_key] = False
-
-            fresh_nodes = {}
-            for id, inputs in fresh_node_inputs.items():
-                all_fresh = True
-                for k, v in inputs.items():
-                    if not v:
-                        all_fresh = False
-                        break
-                if all_fresh:
-                    fresh_nodes[id] = self.latest_cubes_lookup[id]
-
-            potential_executables = {**start_nodes, **fresh_nodes}
-            #print("Executables step 1", executables, "start_nodes", start_nodes, "fresh_nodes", fresh_nodes, "fresh_node_inputs", fresh_node_inputs)
-
-            for id in list(potential_executables.keys()):
+                            dest = self.scheduled_cubes[edge.end]
+                            if not dest.started and not dest.done and not self.edge_fresh[edge.index]:
+                                cube.propagate_return_value_along_edge(edge)
+
+            # Ready cubes start in the plan's topological order
+            executables = {}
+            for id in sorted(self.ready_cubes, key=self.plan.rank.__getitem__):
+                cube = self.ready_cubes[id]
                 # Either the cube is to not run due to a None in input
-                # Or the cube is to not because it has already started
-                if potential_executables[id].dont_run or (potential_executables[id].started and not potential_executables[id].done):
-                    del potential_executables[id]
+                # Or the cube is to not because it is still running
+                if cube.dont_run:
+                    del self.ready_cubes[id]
+                elif id not in self.running_cube_ids and not (cube.started and not cube.done):
+                    del self.ready_cubes[id]
+                    self.running_cube_ids.add(id)
+                    executables[id] = cube
 
-        #print("Returning Executables", potential_executables)
-        return potential_executables
+        return executables
+
+    def commit_global_vars(self, writes):
+        """
+        Merge the keys a layer wrote into the global vars. The lock is held for O(len(writes)).
+        In debug mode the dict starts out shared with the prior execution state, it is copied
+        once on the first commit so that state is left as it was.
+        """
+        with self.global_vars_lock:
+            if self.global_vars_shared:
+                self.global_vars = {**self.global_vars, **writes}
+                self.global_vars_shared = False
+            else:
+                self.global_vars.update(writes)
+            if self.dump_state_folder is not None:
+                self.reached_global_names.update(writes)
+
+    def reach_global_vars(self, reads):
+        """
+        Note the global vars a layer could have changed in place from what it read (name -> value),
+        only they are fingerprinted again at the next checkpoint. O(names reached)
+        """
+        if self.dump_state_folder is None:
+            return
+        names = reached_names(reads, self.global_vars)
+        with self.global_vars_lock:
+            self.reached_global_names.update(names)
 
     def update_manager(self, message):
-        with self.callback_lock:
-            self.callback_function(message)
-
-    async def run_cube(self, func_id, single):
-        self.num_running_cubes += 1
-        cube = self.latest_cubes_lookup[func_id]
-        cube.global_execution_count = self.global_execution_count
-        await asyncio.to_thread(self.latest_cubes_lookup[func_id].execute, self)
+        started = time.perf_counter() if self.profile is not None else None
+        if self.event_dispatcher is not None:
+            self.event_dispatcher.put(message)
+        else:
+            with self.callback_lock:
+                self.callback_function(message)
+        if started is not None:
+            self.profile.add("callback-seconds", time.perf_counter() - started)
+
+    def run_cube(self, func_id, single):
+        try:
+            cube = self.latest_cubes_lookup[func_id]
+            with ExitStack() as measuring:
+                if self.profile is not None:
+                    measuring.enter_context(self.profile.cube(cube))
+                if self.trace is not None:
+                    measuring.enter_context(self.trace.cube_span(self, cube, self.trace_span))
+                cube.execute(self)
+        finally:
+            with self.scheduler_lock:
+                self.dirty_cube_ids.add(func_id)
+                self.running_cube_ids.discard(func_id)
+                self.num_running_cubes -= 1
         if not single:
-            await self.run_all_possible(False)
-        self.num_running_cubes -= 1
+            self.run_all_possible(False)
 
-    def _dump_file_name (self, counter):
+    def _dump_file_name (self, counter, delta=False):
         if self.dump_state_folder is None:
             return None
-        if not os.path.exists(self.dump_state_folder):
-            os.makedirs(self.dump_state_folder)
-        return os.path.join(self.dump_state_folder, f"flow_id_{self.flow_id}_execution_id_{self.execution_id}_global_vars_after_{counter}.dill")
+        return self.checkpoint_manifest.path(self.checkpoint_manifest.file_name(counter, "delta" if delta else "full"))
 
     def _dump_state (self, counter):
+        """
+        Checkpoint the execution at `counter`. The first checkpoint and every
+        full_checkpoint_every-th one after it dill the whole FlowExecution. The others only hold
+        the global vars changed and cubes touched since the previous checkpoint, and that
+        checkpoint's count as their base, so their size follows what changed. Changed global vars
+        are found by value among those layers reached since the previous checkpoint, see
+        GlobalFingerprints. get_flow_from_checkpoint replays the chain.
+
+        Only the in-memory dill runs here, with no cube of this flow running so the snapshot is
+        consistent. Writing and fsyncing happen on the checkpoint writer thread while the
+        next cubes run. Buffers of "checkpoint-buffer-threshold" bytes or more (NumPy arrays, ...)
+        go to files of their own and are memory-mapped on restore. They are written here, before
+        the next cubes can change them, and fsynced by the writer thread. With "checkpoint-buffers"
+        set to "copy" they are copied in memory instead and written by the writer thread too, which
+        holds the scheduler for a memory copy only but needs their size again until written.
+        """
+        started = time.perf_counter()
+        # Creates the dump folder on the first checkpoint only
+        self.checkpoint_manifest.prepare()
         with self.global_vars_lock:
-            # use dill to dump self.global_vars to file
-            with open(self._dump_file_name(counter), "wb") as f:    # write‑binary mode
-                dill.dump(self, f)
+            base = self.last_checkpoint
+            reached = None if self.fingerprint_all_globals else self.reached_global_names
+            self.reached_global_names = set()
+            # A second checkpoint at the same count replaces the first, it can not be a delta of it
+            if self.last_checkpoint in (None, counter) or self.checkpoints_since_full + 1 >= self.full_checkpoint_every:
+                kind = "full"
+                blob, buffers = oob_buffers.dumps_out_of_band(self, self.checkpoint_buffer_threshold)
+                path = self._dump_file_name(counter)
+                # A delta left at this count by an earlier chain would shadow the snapshot
+                stale_path = self._dump_file_name(counter, delta=True)
+                base = None
+                self.checkpoints_since_full = 0
+                self.global_fingerprints.update(self.global_vars, reached)
+            else:
+                kind = "delta"
+                changed = self.global_fingerprints.update(self.global_vars, reached)
+                delta = {
+                    "base": self.last_checkpoint,
+                    "global-vars": {k: self.global_vars[k] for k in changed},
+                    "cubes": {id: cube_state(self.latest_cubes_lookup[id]) for id in self.dirty_cube_ids if id in self.latest_cubes_lookup},
+                    "flow": {k: getattr(self, k) for k in DELTA_FLOW_STATE if hasattr(self, k)},
+                }
+                blob, buffers = oob_buffers.dumps_out_of_band(delta, self.checkpoint_buffer_threshold)
+                path = self._dump_file_name(counter, delta=True)
+                stale_path = None
+                self.checkpoints_since_full += 1
+
+            self.last_checkpoint = counter
+            self.dirty_cube_ids.clear()
+
+        buffer_names = oob_buffers.buffer_names(path, len(buffers))
+        buffer_bytes = sum(view.nbytes for view in buffers)
+        if self.checkpoint_buffers == "copy":
+            buffers = oob_buffers.detach(buffers)
+        else:
+            oob_buffers.write_buffers(path, buffer_names, buffers)
+            buffers = None
+        blob = oob_buffers.wrap(blob, buffer_names)
+        self.checkpoint_writer.submit(path, blob, {
+            "flow-execution-id": self.execution_id,
+            "global-execution-count": counter,
+            "checkpoint-kind": kind,
+            "buffer-bytes": buffer_bytes,
+            "snapshot-seconds": time.perf_counter() - started,
+        }, stale_path, lambda size: self.checkpoint_manifest.add(counter, kind, base, size + buffer_bytes, buffer_names),
+        buffer_names, buffers)
+
+    def apply_delta (self, delta):
+        self.global_vars.update(delta["global-vars"])
+        for id, state in delta["cubes"].items():
+            # In place, so everything holding the cube (lookup, critical path, ...) sees the new state
+            self.latest_cubes_lookup[id].__dict__.update(state)
+        for k, v in delta["flow"].items():
+            setattr(self, k, v)
+        self.init_ready_queue()
 
     @staticmethod
     def get_flow_from_checkpoint_filename (filename) -> "FlowExecution":
-        with open(filename, "rb") as f:    # read‑binary mode
-            flow_exec: FlowExecution = dill.load(f)
-            flow_exec.global_vars_lock = threading.Lock()
-            flow_exec.scheduler_lock = threading.Lock()
-            flow_exec.callback_lock = threading.Lock()
-            print("Loaded flow execution from file", filename, "with exec count", flow_exec.global_execution_count, "and cubes", [c.id for c in flow_exec.cubes])
-            return flow_exec
+        flow_exec: FlowExecution = oob_buffers.load(filename)
+        flow_exec.global_vars_lock = threading.Lock()
+        flow_exec.scheduler_lock = threading.RLock()
+        flow_exec.callback_lock = threading.Lock()
+        # Checkpoints of the restored execution start a new chain
+        flow_exec.last_checkpoint = None
+        print("Loaded flow execution from file", filename, "with exec count", flow_exec.global_execution_count, "and cubes", [c.id for c in flow_exec.cubes])
+        return flow_exec
+
+    def _load_checkpoint (self, entry):
+        # Walk delta bases back to a full snapshot, then replay the deltas forward
+        chain = []
+        while entry["kind"] == "delta":
+            delta = oob_buffers.load(self.checkpoint_manifest.path(entry["file"]))
+            chain.append(delta)
+            entry = self.checkpoint_manifest.get(delta["base"])
+
+        flow_exec = FlowExecution.get_flow_from_checkpoint_filename(self.checkpoint_manifest.path(entry["file"]))
+        for delta in reversed(chain):
+            flow_exec.apply_delta(delta)
+        return flow_exec
+
+    def list_checkpoints (self):
+        """Manifest entries (count, kind, base, file, bytes, time) of this execution's checkpoints"""
+        if self.dump_state_folder is None:
+            return []
+        self.checkpoint_writer.flush()
+        return self.checkpoint_manifest.list()
 
     def get_flow_from_checkpoint (self, exec_count, allow_closest_lower=True) -> "FlowExecution":
-        if self.dump_state_folder is None:
+        if self.dump_state_folder is None or exec_count < 0:
             return None
+        # Checkpoints still queued are part of the chain
+        self.checkpoint_writer.flush()
         print("Getting flow from checkpoint at exec count", exec_count, "in folder", self.dump_state_folder)
-        file_name = None
-        while file_name is None:
-            file_name = self._dump_file_name(exec_count)
-            print("file name", file_name, "exists?", os.path.exists(file_name))
-            if (exec_count < 0) or (not os.path.exists(file_name) and not allow_closest_lower):
-                return None
-            
-            if not os.path.exists(file_name):
-                file_name = None
-                exec_count -= 1
-
-        return FlowExecution.get_flow_from_checkpoint_filename(file_name)
-
-    async def run_all_possible(self, single):
-        executables = self.find_executables()
-        if executables:
-            if self.dump_state_folder is not None and self.num_running_cubes == 0:
-                self._dump_state(self.global_execution_count)
-            self.global_execution_count += 1
-        tasks = []
-        for starter in executables:
-            tasks.append(asyncio.create_task(self.run_cube(starter, single)))
-        for task in tasks:
-            await task
+        entry = self.checkpoint_manifest.nearest(exec_count, allow_closest_lower)
+        if entry is None:
+            return None
+        return self._load_checkpoint(entry)
+
+    def run_all_possible(self, single):
+        # Called from whichever thread finished a cube, the lock keeps one batch per count
+        with self.scheduler_lock:
+            if self.profile is None:
+                executables = self.find_executables()
+            else:
+                started = time.perf_counter()
+                executables = self.find_executables()
+                self.profile.scheduled(time.perf_counter() - started)
+            if executables:
+                if self.dump_state_folder is not None and self.num_running_cubes == 0:
+                    self._dump_state(self.global_execution_count)
+                self.global_execution_count += 1
+            for starter, cube in executables.items():
+                cube.global_execution_count = self.global_execution_count
+                self.num_running_cubes += 1
+                self.cube_group.submit(self.run_cube, starter, single)
 
     def init_results(self):
         self.results = {}
@@ -286,16 +560,35 @@ class FlowExecution:
     def add_result(self, cube, result):
         label = self.result_label[cube.id]
         self.results[label] = result
+        # Only the label that changed, as a preview, get_result has the full value
         self.update_manager({
             "type": "RESULT_UPDATE",
             "flow-execution-id": self.execution_id,
             "cube-id": cube.id,
             "label": label,
-            "time": time.time(),
-            "results": self.results
+            **self.preview_policy.fields(result, "result"),
+            "time": time.time()
         })
 
+    def get_result(self, label):
+        return self.results[label]
+
+    def get_return_value(self, cube_execution_id):
+        """
+        Full return value of a cube execution (layer) whose message carried a preview. Only the
+        last "return-values-keep" (default 1000) are kept, raises KeyError for older ones
+        """
+        return self.return_values.get(cube_execution_id)
+
     def execute(self, args, worker_assigned=False, parent_cubeexecution_id=None, flow_version_id=None):
+        try:
+            return self._execute(args, worker_assigned, parent_cubeexecution_id, flow_version_id)
+        finally:
+            if self.event_dispatcher is not None:
+                # Every message is delivered once execute returns, callback errors are raised here
+                self.event_dispatcher.close()
+
+    def _execute(self, args, worker_assigned, parent_cubeexecution_id, flow_version_id):
         # Get riverbox name from metadata or attribute
         riverbox_name = self.riverbox_metadata.get("flow-name") or getattr(self, "flow_name", None)
 
@@ -316,9 +609,45 @@ class FlowExecution:
 
         self.init_results()
         self.args = args
+        if self.profile is not None:
+            self.profile.start()
+
+        with ExitStack() as tracing:
+            if self.trace is not None:
+                self.trace_span = tracing.enter_context(self.trace.span(
+                    "flow", riverbox_name or str(self.flow_id), self.trace_parent,
+                    **{"execution-id": self.execution_id, "flow-id": self.flow_id}))
+
+            if self.execution_type != "DEBUG_START":
+                try:
+                    self.run_all_possible(self.execution_type in ["ONLY", "DEBUG_ONLY", "DEBUG_NEXT"])
+                    self.cube_group.join()
+                finally:
+                    if self.owns_worker_pool:
+                        self.worker_pool.shutdown()
+                    # Checkpoints are on disk once execute returns
+                    self.checkpoint_writer.close()
+
+        if self.profile is not None:
+            self.profile.stop()
+            self.update_manager({
+                "type": "PROFILE_REPORT",
+                "execution-id": self.execution_id,
+                "report": self.profile.report(),
+                "time": time.time()
+            })
 
-        if self.execution_type != "DEBUG_START":
-            asyncio.run(self.run_all_possible(self.execution_type in ["ONLY", "DEBUG_ONLY", "DEBUG_NEXT"]))
+        if self.trace is not None:
+            self.update_manager({
+                "type": "TRACE_REPORT",
+                "execution-id": self.execution_id,
+                "critical-path": [{k: span[k] for k in ("cube-id", "name", "start", "end", "duration-seconds", "wait-seconds")}
+                                  for span in self.trace.critical_path(self.execution_id)],
+                "slack": self.trace.slack(self.execution_id),
+                "time": time.time()
+            })
+            if self.trace_parent is None and self.riverbox_metadata.get("trace-file"):
+                self.trace.write_chrome_trace(self.riverbox_metadata["trace-file"])
 
         if self.execution_type not in ["DEBUG_ONLY", "DEBUG_NEXT", "DEBUG_UPTO", "DEBUG_START"]:
             self.update_manager({
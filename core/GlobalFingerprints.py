@@ -0,0 +1,180 @@
+import io
+import types
+import pickle
+import hashlib
+import dill
+
+# Values that can only change by being rebound. Functions, classes and modules count too, what
+# they change in place are other global vars, which are fingerprinted themselves
+REBOUND_ONLY_TYPES = (int, float, complex, str, bytes, bool, type(None), frozenset, range,
+                      types.ModuleType, types.FunctionType, types.BuiltinFunctionType, type)
+
+def _code_names(code, names):
+    names.update(code.co_names)
+    for const in code.co_consts:
+        if isinstance(const, types.CodeType):
+            _code_names(const, names)
+
+def _referred_names(value):
+    # Global names the code behind `value` can look up: a function's, the methods of a class,
+    # and those of the class of an instance of a class defined in the flow
+    names = set()
+    if isinstance(value, types.FunctionType):
+        _code_names(value.__code__, names)
+        return names
+    if not isinstance(value, type):
+        value = type(value)
+        if value.__module__ != "__main__":
+            return names
+    for klass in value.__mro__:
+        if klass.__module__ != "__main__":
+            continue
+        for attribute in vars(klass).values():
+            for function in (attribute, getattr(attribute, "__func__", None), getattr(attribute, "fget", None), getattr(attribute, "fset", None)):
+                if isinstance(function, types.FunctionType):
+                    _code_names(function.__code__, names)
+    return names
+
+def reached_names(reads, global_vars):
+    """
+    Names of the global vars a layer could have changed in place, from `reads` (name -> value it
+    read): the names it read, and those the functions it read (or classes, instances of flow
+    classes) refer to, followed through the global vars they name. O(names reached)
+    """
+    reached = set()
+    todo = [(name, value) for name, value in reads.items() if name in global_vars]
+    while todo:
+        name, value = todo.pop()
+        if name in reached:
+            continue
+        reached.add(name)
+        for referred in _referred_names(value):
+            if referred not in reached and referred in global_vars:
+                todo.append((referred, global_vars.get(referred)))
+    return reached
+
+class GlobalFingerprints:
+    """
+    What each flow global var was at the last checkpoint, so a delta checkpoint finds the ones
+    changed since by their value. Which names a layer read or wrote is not enough on its own: a
+    helper function of an earlier cube, or an alias, changes a list in place without its name
+    being read.
+
+    The first update fingerprints every global var. The next ones only the keys they are given,
+    the global vars layers could have reached since (writes, reads, see reached_names), plus:
+    - global vars found inside one of those (an alias, a list in a dict, ...), they are reachable
+      through it
+    - global vars holding a changed one, so objects shared between global vars are still shared
+      once the delta is loaded
+    Values of REBOUND_ONLY_TYPES are compared by identity, the others by a digest of their
+    protocol 5 pickle, large buffers (NumPy arrays, ...) hashed where they are. The C pickler
+    is tried first, it is many times faster than dill for plain data. A value that can not be
+    pickled is always changed.
+
+    Cost: a pickle of every reached mutable global var per checkpoint, with a Python call per
+    object pickled to find the global vars inside it. Global vars no layer reached cost nothing
+    after the first update. update(global_vars) without keys, as with "checkpoint-fingerprint-all",
+    pickles all of them every time, for code changing global vars some other way (threads it
+    started, ...).
+    """
+    def __init__(self):
+        self.fingerprints = {}
+        self.complete = False # every global var fingerprinted once
+        self.owners = {} # id of a mutable value -> names of the global vars bound to it
+        self.owned = {} # name -> id of its value in owners
+        self.holders = {} # name -> names of the global vars found holding its value
+        self.held = {} # name -> names of the global vars found in its value
+
+    def __getstate__(self):
+        # A restored execution starts with a full checkpoint, which records them again
+        return {}
+
+    def __setstate__(self, state):
+        self.__init__()
+
+    @staticmethod
+    def fingerprint(value, owners=None, found=None):
+        """
+        (value, None) for values of REBOUND_ONLY_TYPES, else (None, digest). With `owners` (id of
+        a value -> names), the names of the objects met pickling `value` are added to `found`
+        """
+        if isinstance(value, REBOUND_ONLY_TYPES):
+            return value, None
+        digest = hashlib.blake2b(digest_size=16)
+
+        def buffer_callback(buffer):
+            digest.update(buffer.raw())
+            return False
+
+        def dumps(pickler_class):
+            file = io.BytesIO()
+            pickler = pickler_class(file, protocol=5, buffer_callback=buffer_callback)
+            if owners is not None:
+                def persistent_id(obj):
+                    names = owners.get(id(obj))
+                    if names:
+                        found.update(names)
+                    return None
+                pickler.persistent_id = persistent_id
+            pickler.dump(value)
+            return file.getbuffer()
+
+        try:
+            try:
+                blob = dumps(pickle.Pickler)
+            except Exception:
+                digest = hashlib.blake2b(digest_size=16)
+                blob = dumps(dill.Pickler)
+            digest.update(blob)
+        except Exception:
+            return None, object() # equal to no other digest
+        return None, digest.digest()
+
+    def _own(self, key, value):
+        # Index the value bound to key by identity, so pickling other global vars finds it
+        old = self.owned.pop(key, None)
+        if old is not None:
+            self.owners[old].discard(key)
+            if not self.owners[old]:
+                del self.owners[old]
+        if not isinstance(value, REBOUND_ONLY_TYPES):
+            self.owned[key] = id(value)
+            self.owners.setdefault(id(value), set()).add(key)
+
+    def update(self, global_vars, keys=None):
+        """
+        Record the fingerprints of `keys` of `global_vars` (all of them if None or on the first
+        update) and of the global vars they lead to, returns the keys whose value changed since
+        the last update
+        """
+        if keys is None or not self.complete:
+            keys = global_vars.keys()
+            self.complete = True
+        keys = [key for key in keys if key in global_vars]
+        for key in keys:
+            self._own(key, global_vars[key])
+
+        changed = set()
+        done = set()
+        todo = list(keys)
+        while todo:
+            key = todo.pop()
+            if key in done or key not in global_vars:
+                continue
+            done.add(key)
+            found = set()
+            new = GlobalFingerprints.fingerprint(global_vars[key], self.owners, found)
+            found.discard(key)
+            for name in self.held.get(key, ()):
+                self.holders[name].discard(key)
+            for name in found:
+                self.holders.setdefault(name, set()).add(key)
+            self.held[key] = found
+            todo.extend(found)
+
+            old = self.fingerprints.get(key)
+            self.fingerprints[key] = new
+            if old is None or old[0] is not new[0] or old[1] != new[1]:
+                changed.add(key)
+                todo.extend(holder for holder in self.holders.get(key, ()) if holder not in done)
+        return changed
@@ -0,0 +1,81 @@
+import builtins
+
+class LayeredNamespace(dict):
+    """
+    Globals handed to exec for one layer, without copying the flow global vars.
+
+    The dict itself is the write overlay. A lookup that misses it falls through `layers`
+    in order (e.g. the layer args, then the flow global vars) and then to builtins.
+    Values found that way are kept in the overlay so the next lookup of the same name
+    stays a plain dict hit, and are remembered so `writes` can tell them from real writes.
+
+    `in`, get, iteration, keys and len see the layers too, as they would a merged dict
+    (`if "x" not in globals()`, dir(), dict(globals())). Builtins are not part of them.
+    Iterating builds the merged view, O(names in the layers). items() and values() stay the
+    overlay's: dill saves the globals of a function through items(), a function defined in a
+    layer must not carry every flow global var into a checkpoint. Pickled, the namespace is a
+    plain dict of the overlay for the same reason.
+    """
+    def __init__(self, *layers):
+        super().__init__()
+        self.layers = layers
+        self.read_through = {}
+        self.builtin_reads = set()
+
+    def __reduce_ex__(self, protocol):
+        return dict, (), None, None, iter(dict.items(self))
+
+    def __missing__(self, key):
+        for layer in self.layers:
+            try:
+                value = layer[key]
+                break
+            except KeyError:
+                pass
+        else:
+            try:
+                value = builtins.__dict__[key]
+            except KeyError:
+                raise KeyError(key) from None
+            self.builtin_reads.add(key)
+        dict.__setitem__(self, key, value)
+        self.read_through[key] = value
+        return value
+
+    def seed(self, key, value):
+        # Injected names (rbx, rbxm, ...) are visible to the code but are not writes
+        dict.__setitem__(self, key, value)
+        self.read_through[key] = value
+
+    def _is_builtin_read(self, key):
+        # Builtins cached in the overlay, not bound by the layer
+        return key in self.builtin_reads and dict.get(self, key) is self.read_through[key]
+
+    def __contains__(self, key):
+        if dict.__contains__(self, key):
+            return not self._is_builtin_read(key)
+        return any(key in layer for layer in self.layers)
+
+    def get(self, key, default=None):
+        return self[key] if key in self else default
+
+    def _merged(self):
+        merged = {}
+        for layer in reversed(self.layers):
+            merged.update(layer)
+        merged.update((k, v) for k, v in dict.items(self) if not self._is_builtin_read(k))
+        return merged
+
+    def __iter__(self):
+        return iter(self._merged())
+
+    def __len__(self):
+        return len(self._merged())
+
+    def keys(self):
+        return self._merged().keys()
+
+    def writes(self):
+        """Keys the layer actually (re)bound, O(names touched by the layer)"""
+        read_through = self.read_through
+        return {k: v for k, v in dict.items(self) if k not in read_through or read_through[k] is not v}
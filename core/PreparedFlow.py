@@ -0,0 +1,282 @@
+import ast
+import json
+import hashlib
+import threading
+import traceback
+from collections import OrderedDict, namedtuple
+from concurrent.futures import Future
+from .CodeCache import compiled_code_cache
+
+class PreparedCube:
+    """
+    What a CubeExecution needs from its cube body that does not change between runs: the compiled
+    code (or the error compiling it), the outgoing edge bodies and, once its PreparedFlow is
+    built, their Edges. A FLOW cube also holds the plan of its subflow, see subflow.
+    Read only, one PreparedCube serves every CubeExecution of the same cube in the same language.
+    """
+    def __init__(self, body, language):
+        self.body = body
+        self.id = body["id"]
+        self.kind = body["kind"]
+        self.start_edges = ()
+        self.prepared_subflow = None
+        self.subflow_lock = threading.Lock() if self.kind == "FLOW" else None
+
+        self.compiled_code = None
+        self.function_name = None
+        self.pre_execution_error = ""
+        try:
+            if self.kind == "REGULAR":
+                self.compiled_code, self.function_name = PreparedCube.compile(body["code"], language)
+        except:
+            self.pre_execution_error = "\n\nERROR:\n" + traceback.format_exc() + "\n"
+
+        self.edge_bodies = tuple(body["start-edges"]) if self.kind != "RESULT" else ()
+
+    def subflow(self):
+        """
+        The PreparedFlow of a FLOW cube's subflow, prepared on first use. Its content is part of
+        the flow this cube belongs to, so it is a new version whenever the subflow changes and
+        the layers running the subflow skip hashing it. Raises ValueError for an invalid subflow
+        """
+        with self.subflow_lock:
+            if self.prepared_subflow is None:
+                self.prepared_subflow = PreparedFlow({"flow": self.body, "metadata": self.body["metadata"]},
+                                                     self.body["metadata"]["language"])
+            return self.prepared_subflow
+
+    @staticmethod
+    def compile(code, language):
+        """Returns (code object or None, name of the first function defined or None)"""
+        # ipython cells may hold %magics and !commands, they go to run_cell as they are
+        if language != "python":
+            return None, None
+        # Compile once per cube (and once per process for the same code through the cache),
+        # every layer and every debug re-execution then runs the same code object
+        module = ast.parse(code)
+        function_name = None
+        for expr in module.body:
+            if type(expr) == ast.FunctionDef:
+                function_name = expr.name
+                break
+        return compiled_code_cache.get(code, language, tree=module), function_name
+
+class Edge(namedtuple("Edge", ["index", "id", "start", "end", "start_index", "end_index",
+                               "start_arg_key", "end_arg_key", "kind", "input_slot"])):
+    """
+    An edge of a flow's plan, shared by every run. start and end are cube ids, start_index and
+    end_index their cube indices. Whether it is fresh in a run is FlowExecution.edge_fresh[index],
+    input_slot is where its end arg key is counted in FlowExecution.fresh_input_counts.
+    """
+    __slots__ = ()
+
+    def get_client_edge_metadata (self):
+        return {
+            "end": self.end,
+            "end-arg-key": self.end_arg_key,
+            "kind": self.kind,
+            "start-arg-key": self.start_arg_key
+        }
+
+class PreparedFlow:
+    """
+    A parsed and validated flow, frozen into a plan every FlowExecution of it shares, each run
+    only keeps its own CubeExecution state and a few arrays indexed by the plan on top. Built once
+    per flow version and language by PreparedFlowCache.
+
+    cubes: a PreparedCube per cube, in flow order. index maps cube ids to their position, the
+           cube index the rest of the plan uses
+    edges: every Edge, edge_index maps edge ids to their index. outgoing[i] holds the edges of
+           cube i in the order of its body, they are its CubeExecution's start_edges.
+           incoming maps cube ids to the edges ending at them
+    input_arg_keys: per cube, the arg keys edges fill, each must get a fresh edge before it runs.
+                    They are counted in one array of num_inputs slots, cube i's start at input_offsets[i]
+    components: the strongly connected components in topological order, cycles are the
+                components of more than one cube or of a cube with an edge to itself
+    order: the cube indices in topological order, cubes of a cycle together in flow order.
+           rank maps cube ids to their position in it, the order ready cubes are started in
+    cyclic: the indices of the cubes on a cycle, only they can get fresh inputs again once they ran
+    """
+    def __init__(self, riverbox_flow_full, language):
+        self.language = language
+        cubes = tuple(PreparedCube(c, language) for c in riverbox_flow_full["flow"]["cubes"])
+        self.index = {}
+        for i, cube in enumerate(cubes):
+            if cube.id in self.index:
+                raise ValueError(f"Cube id {cube.id} is used by more than one cube")
+            self.index[cube.id] = i
+        self.cubes = cubes
+
+        input_arg_keys = [{} for _ in cubes]
+        for cube in cubes:
+            for body in cube.edge_bodies:
+                end = self.index.get(body["end"])
+                if end is None:
+                    raise ValueError(f"Edge {body['id']} of cube {cube.id} ends at {body['end']}, which is not in the flow")
+                input_arg_keys[end][body["end-arg-key"]] = None
+        self.input_arg_keys = tuple(tuple(keys) for keys in input_arg_keys)
+
+        offsets = []
+        slots = {} # (cube index, arg key) -> input slot
+        for i, keys in enumerate(self.input_arg_keys):
+            offsets.append(len(slots))
+            for key in keys:
+                slots[(i, key)] = len(slots)
+        self.input_offsets = tuple(offsets)
+        self.num_inputs = len(slots)
+
+        edges = []
+        outgoing = []
+        incoming = {cube.id: [] for cube in cubes}
+        for i, cube in enumerate(cubes):
+            out = []
+            for body in cube.edge_bodies:
+                end = self.index[body["end"]]
+                edge = Edge(len(edges), body["id"], cube.id, body["end"], i, end,
+                            body["start-arg-key"], body["end-arg-key"], body["kind"], slots[(end, body["end-arg-key"])])
+                edges.append(edge)
+                out.append(edge)
+                incoming[edge.end].append(edge)
+            outgoing.append(tuple(out))
+            cube.start_edges = outgoing[-1]
+        self.edges = tuple(edges)
+        self.edge_index = {edge.id: edge.index for edge in edges}
+        self.outgoing = tuple(outgoing)
+        self.incoming = {id: tuple(in_edges) for id, in_edges in incoming.items()}
+
+        self.components = self._strongly_connected_components()
+        self.order = tuple(i for component in self.components for i in component)
+        self.rank = {cubes[i].id: position for position, i in enumerate(self.order)}
+        self.cyclic = frozenset(i for component in self.components for i in component
+                                if len(component) > 1 or any(edge.end_index == i for edge in outgoing[i]))
+
+    def _strongly_connected_components(self):
+        # Tarjan's algorithm without recursion, flows can be longer than the recursion limit
+        successors = [[edge.end_index for edge in out] for out in self.outgoing]
+        index, low, on_stack = {}, {}, set()
+        stack, components = [], []
+        for root in range(len(self.cubes)):
+            if root in index:
+                continue
+            work = [(root, 0)]
+            while work:
+                node, next_child = work.pop()
+                if next_child == 0:
+                    index[node] = low[node] = len(index)
+                    stack.append(node)
+                    on_stack.add(node)
+                for child_position in range(next_child, len(successors[node])):
+                    child = successors[node][child_position]
+                    if child not in index:
+                        work.append((node, child_position + 1))
+                        work.append((child, 0))
+                        break
+                    if child in on_stack:
+                        low[node] = min(low[node], index[child])
+                else:
+                    if low[node] == index[node]:
+                        component = []
+                        while True:
+                            member = stack.pop()
+                            on_stack.discard(member)
+                            component.append(member)
+                            if member == node:
+                                break
+                        components.append(tuple(sorted(component)))
+                    if work:
+                        parent = work[-1][0]
+                        low[parent] = min(low[parent], low[node])
+        # Tarjan finds them in reverse topological order
+        return tuple(reversed(components))
+
+    def upstream(self, cube_id):
+        """Indices of the cubes with a path to `cube_id`, itself included"""
+        found = {self.index[cube_id]}
+        todo = [cube_id]
+        while todo:
+            for edge in self.incoming[todo.pop()]:
+                if edge.start_index not in found:
+                    found.add(edge.start_index)
+                    todo.append(edge.start)
+        return found
+
+class PreparedFlowCache:
+    """
+    Process-wide LRU cache of PreparedFlows keyed by (flow version, language). A flow's version
+    is a hash of its content, so a changed flow or a changed registry entry is a new version and
+    an unchanged one is found again however many times its dict is rebuilt (e.g. per rbxm.call).
+    Threads missing on the same version at the same time wait for the one preparing it. The
+    version is hashed on every get, a flow dict changed in place after a run is a new version
+    like any other change. The subflows of FLOW cubes are not looked up here, their layers run
+    with the plan of the flow holding them, see PreparedCube.subflow.
+    """
+    def __init__(self, max_size=128):
+        self.max_size = max_size
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+        self.preparing = {} # key -> Future of the PreparedFlow being prepared
+        self.hits = 0
+        self.misses = 0
+
+    def __getstate__(self):
+        # Reached through module globals when dill pickles a function by value, e.g. in a full
+        # checkpoint. The flows of the whole process have no place there
+        return {"max_size": self.max_size}
+
+    def __setstate__(self, state):
+        self.__init__(**state)
+
+    @staticmethod
+    def version(riverbox_flow_full):
+        text = json.dumps(riverbox_flow_full["flow"], sort_keys=True, default=repr)
+        return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+    def get(self, riverbox_flow_full):
+        """The PreparedFlow of `riverbox_flow_full`, prepared on a miss. Raises ValueError for an invalid flow"""
+        language = riverbox_flow_full["metadata"]["language"]
+        key = (PreparedFlowCache.version(riverbox_flow_full), language)
+        with self.lock:
+            prepared = self.entries.get(key)
+            if prepared is not None:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return prepared
+            preparing = self.preparing.get(key)
+            if preparing is None:
+                self.misses += 1
+                preparing = self.preparing[key] = Future()
+                owner = True
+            else:
+                self.hits += 1
+                owner = False
+
+        if not owner:
+            return preparing.result()
+
+        try:
+            prepared = PreparedFlow(riverbox_flow_full, language)
+        except BaseException as e:
+            with self.lock:
+                del self.preparing[key]
+            preparing.set_exception(e)
+            raise
+
+        with self.lock:
+            del self.preparing[key]
+            self.entries[key] = prepared
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+        preparing.set_result(prepared)
+        return prepared
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+prepared_flow_cache = PreparedFlowCache()
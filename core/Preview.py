@@ -0,0 +1,108 @@
+import reprlib
+import threading
+from array import array
+from collections import deque, OrderedDict
+from itertools import islice
+
+class _Repr(reprlib.Repr):
+    # reprlib sorts dict keys, a preview keeps them in insertion order like str() does
+    def repr_dict(self, x, level):
+        n = len(x)
+        if n == 0:
+            return "{}"
+        if level <= 0:
+            return "{...}"
+        pieces = [f"{self.repr1(k, level - 1)}: {self.repr1(x[k], level - 1)}" for k in islice(x, self.maxdict)]
+        if n > self.maxdict:
+            pieces.append(self.fillvalue)
+        return "{" + ", ".join(pieces) + "}"
+
+class PreviewPolicy:
+    """
+    How values (cube return values, results) are shown in update messages. Small values read
+    exactly like str(value). Containers show at most max_items items per level, and the text
+    is cut at max_length characters with `marker` appended, so the cost of a preview does not
+    grow with the value. Full values are fetched on demand, see FlowExecution.get_return_value.
+    """
+    def __init__(self, max_length=1000, max_items=20, marker="... [truncated]"):
+        self.max_length = max_length
+        self.max_items = max_items
+        self.marker = marker
+
+        self.repr = _Repr()
+        self.repr.maxlevel = 4
+        self.repr.maxtuple = self.repr.maxlist = self.repr.maxarray = self.repr.maxdict = max_items
+        self.repr.maxset = self.repr.maxfrozenset = self.repr.maxdeque = max_items
+        self.repr.maxstring = self.repr.maxother = self.repr.maxlong = max_length
+
+    @staticmethod
+    def type_summary(value):
+        """e.g. "int", "list[10000]", "DataFrame(1000, 5)" """
+        name = type(value).__name__
+        try:
+            shape = getattr(value, "shape", None)
+            if isinstance(shape, tuple):
+                return f"{name}{shape}"
+            return f"{name}[{len(value)}]"
+        except Exception:
+            return name
+
+    def preview(self, value):
+        """Returns (text, truncated)"""
+        truncated = False
+        try:
+            if isinstance(value, str):
+                text = value[:self.max_length + 1]
+            elif isinstance(value, (list, tuple, dict, set, frozenset, deque, array, int)):
+                # Bounded however many items or digits there are
+                text = self.repr.repr(value)
+                truncated = not isinstance(value, int) and len(value) > self.max_items
+            else:
+                # Arrays, frames, ... bound their own str
+                text = str(value)
+        except Exception:
+            # e.g. an int too long to convert
+            text = f"<{PreviewPolicy.type_summary(value)}>"
+            truncated = True
+
+        if len(text) > self.max_length:
+            return text[:self.max_length] + self.marker, True
+        return text, truncated
+
+    def fields(self, value, prefix):
+        """Message fields for `value`: <prefix>, <prefix>-type and <prefix>-truncated"""
+        text, truncated = self.preview(value)
+        return {prefix: text, prefix + "-type": PreviewPolicy.type_summary(value), prefix + "-truncated": truncated}
+
+class ReturnValues:
+    """
+    Full return values of the latest cube executions (layers) by execution id, for
+    FlowExecution.get_return_value. Only the last `max_size` are kept, an older one is gone
+    once its message has long been delivered; its cube keeps what a restore needs.
+    """
+    def __init__(self, max_size=1000):
+        self.max_size = max_size
+        self.lock = threading.Lock()
+        self.values = OrderedDict()
+
+    def __getstate__(self):
+        # They only serve the live execution
+        return {"max_size": self.max_size}
+
+    def __setstate__(self, state):
+        self.__init__(**state)
+
+    def put(self, cube_execution_id, value):
+        with self.lock:
+            self.values[str(cube_execution_id)] = value
+            self.values.move_to_end(str(cube_execution_id))
+            while len(self.values) > self.max_size:
+                self.values.popitem(last=False)
+
+    def get(self, cube_execution_id):
+        """Raises KeyError for an execution that never returned or whose value was dropped"""
+        with self.lock:
+            return self.values[str(cube_execution_id)]
+
+    def __len__(self):
+        return len(self.values)
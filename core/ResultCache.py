@@ -0,0 +1,210 @@
+import os
+import hashlib
+import threading
+from collections import OrderedDict
+import dill
+
+_SCALARS = (type(None), bool, int, float, complex, str, bytes)
+
+def _canonical(value):
+    # A form of `value` whose repr is the same in every process: dicts and sets are ordered by
+    # their contents (set order changes with the hash seed), each value is tagged with its type
+    if isinstance(value, _SCALARS):
+        return (type(value).__name__, value)
+    if isinstance(value, (list, tuple)):
+        return (type(value).__name__, tuple(_canonical(v) for v in value))
+    if isinstance(value, dict):
+        return (type(value).__name__, tuple(sorted(((_canonical(k), _canonical(v)) for k, v in value.items()), key=repr)))
+    if isinstance(value, (set, frozenset)):
+        return (type(value).__name__, tuple(sorted((_canonical(v) for v in value), key=repr)))
+    # Anything else by its pickle, stable for values that pickle the same every time (NumPy
+    # arrays, dataclasses of the types above, ...)
+    return (type(value).__module__ + "." + type(value).__qualname__, dill.dumps(value))
+
+def result_key(code, language, args, env):
+    """
+    Content address of one layer of a deterministic cube: sha256 over the code, the layer args
+    and the flow env. None, bools, numbers, strings, bytes, and lists, tuples, dicts and sets of
+    them key by content whatever their order; other values key by their pickle, so only those
+    that pickle to the same bytes every time hit. Returns None when the args can not be
+    pickled, the layer then just runs.
+    """
+    try:
+        payload = repr(_canonical((code, language, args, env or {})))
+    except Exception:
+        return None
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+class ResultStore:
+    """
+    Base of the result stores. Entries are (return value, console output) pickled into one
+    blob, so a hit hands out a fresh copy and eviction can go by the blob size.
+    Subclasses implement _read(key) -> bytes | None and _write(key, blob).
+    """
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        """Returns (return value, console output) or None on a miss"""
+        blob = self._read(key)
+        with self.lock:
+            if blob is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+        return dill.loads(blob)
+
+    def put(self, key, return_value, console_output):
+        try:
+            blob = dill.dumps((return_value, console_output))
+        except Exception:
+            print("Return value of a deterministic cube can not be cached, skipping it")
+            return
+        if len(blob) > self.max_bytes:
+            return
+        self._write(key, blob)
+
+class MemoryResultStore(ResultStore):
+    """LRU of result blobs in this process, evicts the least recently used once over max_bytes"""
+    def __init__(self, max_bytes=256 * 1024 * 1024):
+        super().__init__(max_bytes)
+        self.entries = OrderedDict()
+        self.size = 0
+
+    def __getstate__(self):
+        # Checkpoints carry the setting, not the cached results
+        return {"max_bytes": self.max_bytes}
+
+    def __setstate__(self, state):
+        self.__init__(state["max_bytes"])
+
+    def _read(self, key):
+        with self.lock:
+            blob = self.entries.get(key)
+            if blob is not None:
+                self.entries.move_to_end(key)
+            return blob
+
+    def _write(self, key, blob):
+        with self.lock:
+            old = self.entries.pop(key, None)
+            if old is not None:
+                self.size -= len(old)
+            self.entries[key] = blob
+            self.size += len(blob)
+            while self.size > self.max_bytes:
+                _, evicted = self.entries.popitem(last=False)
+                self.size -= len(evicted)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.size = 0
+            self.hits = 0
+            self.misses = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+class DiskResultStore(ResultStore):
+    """
+    One file per result in `path`, shared by every process pointed at the same directory.
+    Files are written to a temp name and renamed, so readers never see half a result.
+    A hit touches the file, eviction removes the least recently used files once over max_bytes.
+    """
+    def __init__(self, path, max_bytes=4 * 1024 * 1024 * 1024):
+        super().__init__(max_bytes)
+        self.path = path
+        os.makedirs(path, exist_ok=True)
+
+        # key -> size, least recently used first. Other processes may add files, they are
+        # picked up on the next start
+        self.entries = OrderedDict()
+        self.size = 0
+        files = []
+        for name in os.listdir(path):
+            if name.endswith(".result"):
+                stat = os.stat(os.path.join(path, name))
+                files.append((stat.st_mtime, name[:-len(".result")], stat.st_size))
+        for _, key, size in sorted(files):
+            self.entries[key] = size
+            self.size += size
+
+    def __getstate__(self):
+        return {"path": self.path, "max_bytes": self.max_bytes}
+
+    def __setstate__(self, state):
+        self.__init__(state["path"], state["max_bytes"])
+
+    def file(self, key):
+        return os.path.join(self.path, key + ".result")
+
+    def _read(self, key):
+        try:
+            with open(self.file(key), "rb") as f:
+                blob = f.read()
+            os.utime(self.file(key))
+        except OSError:
+            return None
+        with self.lock:
+            if key in self.entries:
+                self.entries.move_to_end(key)
+        return blob
+
+    def _write(self, key, blob):
+        tmp = self.file(key) + f".{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp, "wb") as f:
+            f.write(blob)
+        os.replace(tmp, self.file(key))
+
+        evicted = []
+        with self.lock:
+            self.size += len(blob) - self.entries.pop(key, 0)
+            self.entries[key] = len(blob)
+            while self.size > self.max_bytes:
+                old_key, size = self.entries.popitem(last=False)
+                self.size -= size
+                evicted.append(old_key)
+
+        for old_key in evicted:
+            try:
+                os.remove(self.file(old_key))
+            except OSError:
+                pass
+
+    def clear(self):
+        with self.lock:
+            keys = list(self.entries)
+            self.entries.clear()
+            self.size = 0
+            self.hits = 0
+            self.misses = 0
+        for key in keys:
+            try:
+                os.remove(self.file(key))
+            except OSError:
+                pass
+
+    def __len__(self):
+        return len(self.entries)
+
+# Used by flows that name no result store, so re-runs in the same process hit
+default_result_store = MemoryResultStore()
+
+_disk_result_stores = {}
+_disk_result_stores_lock = threading.Lock()
+
+def disk_result_store(path):
+    """
+    The DiskResultStore of directory `path` in this process. Flows and subflows naming the same
+    "result-cache-dir" share it, its directory is scanned once
+    """
+    path = os.path.abspath(path)
+    with _disk_result_stores_lock:
+        store = _disk_result_stores.get(path)
+        if store is None:
+            store = _disk_result_stores[path] = DiskResultStore(path)
+        return store
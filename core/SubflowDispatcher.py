@@ -0,0 +1,163 @@
+import queue
+import threading
+import traceback
+from concurrent.futures import Future, TimeoutError as FutureTimeoutError
+import dill
+
+# Work queue subflows are published to and workers consume, see core.subflow_worker
+DEFAULT_SUBFLOW_QUEUE = "riverbox-subflows"
+
+class RemoteSubflowError(Exception):
+    """
+    A subflow could not be run remotely: a worker failed (the message has its traceback), no
+    result came in time, or the broker connection failed
+    """
+
+class SubflowDispatcher:
+    """
+    Runs subflows that are not "run-on-same" on remote workers through a broker (AMQPBroker,
+    InProcessBroker). Every call publishes a work item to `queue_name` with the subflow's own
+    execution id as its correlation id, calls from the same parent layer do not share one. Workers send the subflow's update messages and finally
+    its results back to this dispatcher's reply queue, where they are matched to the waiting
+    call by that id.
+
+    One thread owns the broker connection and does all publishing and consuming, the calls
+    only wait for their result. Work items and replies are dilled, workers must be trusted.
+
+    Every failure of a call is a RemoteSubflowError, which the FLOW cube reports as an error
+    of its layer.
+
+    timeout: optional seconds a call waits for its result
+    """
+    def __init__(self, broker, queue_name=DEFAULT_SUBFLOW_QUEUE, timeout=None, poll_interval=0.05):
+        self.broker = broker
+        self.queue_name = queue_name
+        self.timeout = timeout
+        self.poll_interval = poll_interval
+
+        self.outbox = queue.Queue()
+        self.pending = {} # correlation id -> (Future, callback)
+        self.lock = threading.Lock()
+        self.thread = None
+        self.ready = threading.Event()
+        self.closing = False
+        self.error = None
+
+    def __getstate__(self):
+        return {"broker": self.broker, "queue_name": self.queue_name, "timeout": self.timeout, "poll_interval": self.poll_interval}
+
+    def __setstate__(self, state):
+        self.__init__(**state)
+
+    def _start(self):
+        with self.lock:
+            if self.thread is None:
+                self.closing = False
+                self.error = None
+                self.ready.clear()
+                self.thread = threading.Thread(target=self._work, name="riverbox-subflow-dispatcher", daemon=True)
+                self.thread.start()
+        self.ready.wait()
+        if self.error is not None:
+            raise self.error
+
+    def call(self, riverbox_flow, metadata, callback, args, flow_registry=None):
+        """
+        Run the subflow `riverbox_flow` with execution `metadata` (see call_external_flow.subflow_execution)
+        on a worker and return its results. Its update messages are passed to `callback` as they arrive.
+        Raises RemoteSubflowError if the worker failed to run it, it timed out or the broker failed.
+        """
+        try:
+            self._start()
+        except Exception as e:
+            raise RemoteSubflowError("Could not connect to the broker:\n" + "".join(traceback.format_exception(e))) from e
+        correlation_id = metadata["execution-id"]
+        future = Future()
+        with self.lock:
+            self.pending[correlation_id] = (future, callback)
+        work = {"flow": riverbox_flow, "metadata": metadata, "args": args, "flow-registry": flow_registry or {}}
+        self.outbox.put((dill.dumps(work), correlation_id))
+        try:
+            return future.result(self.timeout)
+        except RemoteSubflowError:
+            raise
+        except FutureTimeoutError as e:
+            raise RemoteSubflowError(f"No result from a worker after {self.timeout} seconds") from e
+        except Exception as e:
+            # The connection failed while waiting, or the update callback raised
+            raise RemoteSubflowError("".join(traceback.format_exception(e))) from e
+        finally:
+            with self.lock:
+                self.pending.pop(correlation_id, None)
+
+    def _work(self):
+        try:
+            connection = self.broker.connect()
+            connection.declare(self.queue_name)
+            reply_queue = connection.declare(exclusive=True)
+        except Exception as e:
+            self.error = e
+            with self.lock:
+                self.thread = None
+            self.ready.set()
+            return
+        self.ready.set()
+
+        try:
+            while not self.closing:
+                while True:
+                    try:
+                        body, correlation_id = self.outbox.get_nowait()
+                    except queue.Empty:
+                        break
+                    connection.publish(self.queue_name, body, correlation_id=correlation_id, reply_to=reply_queue)
+                delivery = connection.get(reply_queue, self.poll_interval)
+                if delivery is not None:
+                    self._reply(delivery)
+                    connection.ack(delivery)
+        except Exception as e:
+            # The connection is gone, nothing pending can get its result any more
+            self._fail_pending(e)
+        finally:
+            connection.close()
+
+    def _reply(self, delivery):
+        with self.lock:
+            waiting = self.pending.get(delivery.correlation_id)
+        if waiting is None:
+            return # a call that timed out, or a duplicate of a redelivered work item
+        future, callback = waiting
+        try:
+            reply = dill.loads(delivery.body)
+        except Exception:
+            if not future.done():
+                future.set_exception(RemoteSubflowError("Could not load the reply of a worker:\n" + traceback.format_exc()))
+            return
+        if reply["kind"] == "update":
+            try:
+                callback(reply["message"])
+            except Exception as e:
+                if not future.done():
+                    future.set_exception(e)
+        elif not future.done():
+            if reply["kind"] == "results":
+                future.set_result(reply["results"])
+            else:
+                future.set_exception(RemoteSubflowError(reply["error"]))
+
+    def _fail_pending(self, error):
+        with self.lock:
+            self.thread = None
+            pending, self.pending = self.pending, {}
+        for future, _ in pending.values():
+            if not future.done():
+                future.set_exception(error)
+
+    def close(self):
+        with self.lock:
+            thread = self.thread
+            self.closing = True
+        if thread is not None:
+            thread.join()
+        with self.lock:
+            self.thread = None
@@ -0,0 +1,159 @@
+import threading
+from collections import deque
+from concurrent.futures import Future
+
+DEFAULT_MAX_WORKERS = 32
+
+class TaskGroup:
+    """
+    A stream of tasks run on a WorkerPool, e.g. the cubes of one flow execution or the layers
+    of one map cube. The pool serves groups round robin, one task per turn, so a cube with
+    thousands of layers cannot starve the others.
+
+    pool: WorkerPool the tasks run on
+    limit: optional cap on the number of tasks of this group running at the same time
+    """
+    def __init__(self, pool, limit=None):
+        self.pool = pool
+        self.limit = limit
+        self.tasks = deque()
+        self.active = 0
+        self.queued = False # whether the group is in the pool's ready ring
+        self.error = None
+
+    def __getstate__(self):
+        return {"pool": self.pool, "limit": self.limit}
+
+    def __setstate__(self, state):
+        self.__init__(state["pool"], state["limit"])
+
+    def submit(self, fn, *args, **kwargs):
+        future = Future()
+        with self.pool.lock:
+            self.tasks.append((future, fn, args, kwargs))
+            self.pool._schedule(self)
+        return future
+
+    def outstanding(self):
+        return len(self.tasks) + self.active
+
+    def _runnable(self):
+        return bool(self.tasks) and (self.limit is None or self.active < self.limit)
+
+    def _take(self):
+        self.active += 1
+        return self.tasks.popleft()
+
+    def _run(self, task):
+        future, fn, args, kwargs = task
+        if future.set_running_or_notify_cancel():
+            try:
+                result = fn(*args, **kwargs)
+            except BaseException as e:
+                future.set_exception(e)
+                if self.error is None:
+                    self.error = e
+            else:
+                future.set_result(result)
+
+        with self.pool.lock:
+            self.active -= 1
+            self.pool._schedule(self)
+            self.pool.task_done.notify_all()
+
+    def wait(self, until):
+        """
+        Block until `until()` holds (checked under the pool lock). While waiting, the calling
+        thread runs this group's own pending tasks instead of idling, so a worker waiting on
+        the tasks it submitted never deadlocks the pool, however small the pool is.
+        """
+        while True:
+            with self.pool.lock:
+                while not until():
+                    if self._runnable():
+                        task = self._take()
+                        break
+                    self.pool.task_done.wait()
+                else:
+                    return
+            self._run(task)
+
+    def join(self):
+        """Wait for every task submitted so far, then raise the first error one of them raised"""
+        self.wait(lambda: not self.tasks and self.active == 0)
+        if self.error is not None:
+            raise self.error
+
+class WorkerPool:
+    """
+    Bounded pool of worker threads shared by cube and layer execution. Threads are started
+    lazily up to max_workers; threads waiting in TaskGroup.wait help instead of blocking,
+    so the number of threads never grows past max_workers plus the callers.
+    """
+    _shared = None
+    _shared_lock = threading.Lock()
+
+    def __init__(self, max_workers=DEFAULT_MAX_WORKERS):
+        assert max_workers > 0
+        self.max_workers = max_workers
+        self.lock = threading.Lock()
+        self.work_available = threading.Condition(self.lock)
+        self.task_done = threading.Condition(self.lock)
+        self.ready = deque()
+        self.num_threads = 0
+        self.idle = 0
+        self.shutting_down = False
+
+    @classmethod
+    def shared(cls, max_workers=DEFAULT_MAX_WORKERS):
+        # Optional process wide pool, for workers running many flows at once
+        with cls._shared_lock:
+            if cls._shared is None:
+                cls._shared = cls(max_workers)
+            return cls._shared
+
+    def __getstate__(self):
+        return {"max_workers": self.max_workers}
+
+    def __setstate__(self, state):
+        self.__init__(state["max_workers"])
+
+    def _schedule(self, group):
+        # Called with self.lock held
+        if group.queued or not group._runnable():
+            return
+        group.queued = True
+        self.ready.append(group)
+        self.shutting_down = False
+        if self.idle > 0:
+            self.idle -= 1
+            self.work_available.notify()
+        elif self.num_threads < self.max_workers:
+            self.num_threads += 1
+            threading.Thread(target=self._work, name=f"riverbox-worker-{self.num_threads}", daemon=True).start()
+
+    def _work(self):
+        while True:
+            with self.lock:
+                while not self.ready:
+                    if self.shutting_down:
+                        self.num_threads -= 1
+                        return
+                    self.idle += 1
+                    self.work_available.wait()
+
+                group = self.ready.popleft()
+                group.queued = False
+                if not group._runnable():
+                    continue
+                task = group._take()
+                # Back of the ring, so other groups get the next turn
+                self._schedule(group)
+            group._run(task)
+
+    def shutdown(self):
+        """Let idle threads exit. The pool stays usable, new work starts threads again"""
+        with self.lock:
+            self.shutting_down = True
+            self.idle = 0
+            self.work_available.notify_all()
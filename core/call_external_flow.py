@@ -9,28 +9,47 @@ def get_uuid ():
 
     return uuid_str
 
-def call_external_flow (body_flow, parent_metadata: dict, callback, args, global_execution_count=None, layer=None, env=None, parent_cubeexecution_id=None, flow_registry=None):
+def subflow_execution (body_flow, parent_metadata: dict, parent_cubeexecution_id=None):
+    """The (riverbox flow, execution metadata) pair a subflow runs with, here or on a worker"""
+    parent_metadata_for_child = parent_metadata.copy()
+    parent_metadata_for_child["execution-id"] = get_uuid()
+    parent_metadata_for_child["flow-id"] = body_flow["sub-flow-version-id"]
+    parent_metadata_for_child["parent-cube-execution-id"] = str(parent_cubeexecution_id) if parent_cubeexecution_id else None
+    body = {}
+    body["flow"] = body_flow
+    body["metadata"] = body_flow["metadata"]
+    body["env"] = body_flow["env"]
+    body["tags"] = body_flow["tags"]
+    body["tag-stack"] = body_flow["tag-stack"]
+    return body, parent_metadata_for_child
+
+def call_external_flow (body_flow, parent_metadata: dict, callback, args, global_execution_count=None, layer=None, env=None, parent_cubeexecution_id=None, flow_registry=None, worker_pool=None, dispatcher=None, prepared=None):
+    """
+    Run the subflow `body_flow` in this process ("run-on-same"), on a remote worker through
+    `dispatcher`, or hand it to the cluster manager.
+    worker_pool: The calling flow's WorkerPool. In process subflows run their cubes on it, so nested
+                 and mapped subflows share the caller's threads instead of starting pools of their own
+    dispatcher: Optional SubflowDispatcher for subflows that are not "run-on-same"
+    prepared: Optional PreparedFlow of `body_flow` for "run-on-same", looked up by its version without one
+    """
     from .FlowExecution import FlowExecution
 
     if body_flow["run-on-same"]:
-        parent_metadata_for_child = parent_metadata.copy()
-        parent_metadata_for_child["execution-id"] = get_uuid()
-        parent_metadata_for_child["flow-id"] = body_flow["sub-flow-version-id"]
-        body = {}
-        body["flow"] = body_flow
-        body["metadata"] = body_flow["metadata"]
-        body["env"] = body_flow["env"]
-        body["tags"] = body_flow["tags"]
-        body["tag-stack"] = body_flow["tag-stack"]
+        body, parent_metadata_for_child = subflow_execution(body_flow, parent_metadata, parent_cubeexecution_id)
 
         # Pass flow_registry to enable speculation/caching in nested calls
-        sub_flow = FlowExecution(body, parent_metadata_for_child, callback, "FULL", None, None, flow_registry=flow_registry)
+        sub_flow = FlowExecution(body, parent_metadata_for_child, callback, "FULL", None, None, flow_registry=flow_registry,
+                                 worker_pool=worker_pool, subflow_dispatcher=dispatcher, prepared=prepared)
 
         # Set riverbox name from metadata if available
         if "flow-name" in body["metadata"]:
             sub_flow.flow_name = body["metadata"]["flow-name"]
 
-        return sub_flow.execute(args, worker_assigned=True, parent_cubeexecution_id=parent_cubeexecution_id, flow_version_id=body_flow["sub-flow-version-id"])
+        return sub_flow.execute(args, worker_assigned=True, parent_cubeexecution_id=parent_metadata_for_child["parent-cube-execution-id"], flow_version_id=body_flow["sub-flow-version-id"])
+
+    if dispatcher is not None:
+        body, parent_metadata_for_child = subflow_execution(body_flow, parent_metadata, parent_cubeexecution_id)
+        return dispatcher.call(body, parent_metadata_for_child, callback, args, flow_registry=flow_registry)
 
     # Send it out to cluster manager
     # For now, wait till execution is complete
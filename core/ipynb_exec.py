@@ -1,10 +1,20 @@
-from IPython.core.interactiveshell import InteractiveShell
+from IPython.core.interactiveshell import InteractiveShell, DummyMod
+from traitlets.config import Config
+import re
+import sys
+import builtins
+import threading
 import traceback
+from .LayeredNamespace import LayeredNamespace
 
 class RiverboxIPythonShell (InteractiveShell):
     def __init__ (self, *args, **kwargs):
         self.error_message = ""
-        super().__init__(colors="NoColor", *args, **kwargs)
+        # No SQLite history: its connection belongs to the thread that built the shell, and
+        # pooled shells run cells on other threads
+        config = Config()
+        config.HistoryManager.enabled = False
+        super().__init__(colors="NoColor", config=config, *args, **kwargs)
         self.enable_matplotlib("inline")
     
     def enable_gui(self, gui=...):
@@ -18,6 +28,95 @@ class RiverboxIPythonShell (InteractiveShell):
         except UnicodeEncodeError:
             self.error_message += val.encode("utf-8", "backslashreplace").decode()
 
+# Building shells is not thread safe (enable_matplotlib registers the inline backend), they
+# are built one at a time
+_build_lock = threading.Lock()
+
+def new_shell():
+    with _build_lock:
+        return RiverboxIPythonShell()
+
+class ShellPool:
+    """
+    Warm RiverboxIPythonShells for the "ipython" language. Building a shell (and its inline
+    matplotlib backend) takes hundreds of milliseconds, so layers borrow one and give it back
+    to be reset instead of building their own. At most max_idle shells are kept, when more
+    layers run at once the extra shells are built on demand and dropped after. A shell that
+    can not be built stops the warming, the layer that builds one on demand reports the error.
+
+    pyplot figures are process wide, not per shell. Those left open are closed once no shell
+    is borrowed, so no layer loses a figure it is still drawing.
+    """
+    def __init__(self, max_idle=4):
+        self.max_idle = max_idle
+        self.idle = []
+        self.in_use = 0
+        self.lock = threading.Lock()
+        self.warming = None
+        self.error = None # why the last warming stopped early
+
+    def __getstate__(self):
+        return {"max_idle": self.max_idle}
+
+    def __setstate__(self, state):
+        self.__init__(state["max_idle"])
+
+    def warm(self, count):
+        """Build shells on a background thread until `count` are idle"""
+        with self.lock:
+            self.max_idle = max(self.max_idle, count)
+            if self.warming is not None and self.warming.is_alive():
+                return
+            self.warming = threading.Thread(target=self._warm, args=(count,), name="riverbox-shell-warmer", daemon=True)
+            self.warming.start()
+
+    def _warm(self, count):
+        while True:
+            with self.lock:
+                if len(self.idle) >= count:
+                    return
+            try:
+                shell = new_shell()
+            except Exception as e:
+                self.error = e
+                return
+            with self.lock:
+                self.idle.append(shell)
+
+    def acquire(self):
+        with self.lock:
+            self.in_use += 1
+            if self.idle:
+                return self.idle.pop()
+        try:
+            return new_shell()
+        except BaseException:
+            with self.lock:
+                self.in_use -= 1
+            raise
+
+    def release(self, shell):
+        # Clears the user namespace and the In/Out history, as if the shell was new
+        try:
+            shell.reset(new_session=False)
+            shell.error_message = ""
+            reusable = True
+        except Exception:
+            reusable = False # a shell that can not be reset is not reused
+        with self.lock:
+            self.in_use -= 1
+            last = self.in_use == 0
+            if reusable and len(self.idle) < self.max_idle:
+                self.idle.append(shell)
+        pyplot = sys.modules.get("matplotlib.pyplot")
+        if last and pyplot is not None:
+            pyplot.close("all")
+
+default_shell_pool = ShellPool()
+
+# Names the shell binds for its output history (_, __, _i, _i3, _3, ...), never global vars
+_OUTPUT_HISTORY_NAME = re.compile(r"_{1,3}|_i{1,3}|_i?\d+")
+
 def print_override(console_output_file):
     def print_function(*args, **kwargs):
         if "file" in kwargs:
@@ -27,47 +126,79 @@ def print_override(console_output_file):
     return print_function
 
 def execute_code (cube_execution_layer, global_vars, flow):
-    import riverbox_frontend
-
-    flow.global_vars_lock.acquire()
     try:
-        local_global_vars = {**global_vars, **cube_execution_layer.args}
-    except:
-        local_global_vars = {**global_vars}
-    flow.global_vars_lock.release()
+        from .. import riverbox_frontend
+    except ImportError:
+        import riverbox_frontend
+
+    # The cell runs in a LayeredNamespace over args and global vars, nothing is copied and no
+    # lock is needed. It stands in for the shell's own namespace while the cell runs, the way
+    # IPython's embedded shells swap theirs
+    args = cube_execution_layer.args if isinstance(cube_execution_layer.args, dict) else {}
+    local_global_vars = LayeredNamespace(args, global_vars)
+
+    rbxm = riverbox_frontend.RiverboxCubeManager(cube_execution_layer.args,
+                                                 cube_execution_layer.get_client_box_metadata(),
+                                                 flow.get_client_riverbox_metadata(),
+                                                 flow_registry=flow.flow_registry,
+                                                 main_callback = flow.update_manager,
+                                                 worker_pool = flow.worker_pool,
+                                                 subflow_dispatcher = flow.subflow_dispatcher)
+    local_global_vars.seed("__name__", "__main__")
+    local_global_vars.seed("__builtin__", builtins)
+    local_global_vars.seed("__builtins__", builtins)
+    local_global_vars.seed("rbx", riverbox_frontend)
+    local_global_vars.seed("print", print_override(cube_execution_layer.console_output))
+    local_global_vars.seed("rbxm", rbxm)
 
-    rbxm = riverbox_frontend.RiverboxCubeManager(cube_execution_layer.args)
-    local_global_vars["rbx"] = riverbox_frontend
-    local_global_vars["print"] = print_override(cube_execution_layer.console_output)
-    local_global_vars["rbxm"] = rbxm
-
-    shell = RiverboxIPythonShell()
-    old_keys = list(shell.user_ns.keys())
-    shell.user_ns.update(local_global_vars)
     try:
-        res = shell.run_cell(cube_execution_layer.cube.code)
-        rbxm = local_global_vars["rbxm"]
-        rbxm.finish()
-    except:
+        shell = flow.shell_pool.acquire()
+    except Exception:
         cube_execution_layer.errored = True
         contents = cube_execution_layer.console_output.getvalue()
         cube_execution_layer.console_output.close()
         cube_execution_layer.error(str(cube_execution_layer.execution_id), flow, "\n\nERROR:\n" + traceback.format_exc() + "\n", contents)
+        return
 
-    flow.global_vars_lock.acquire()
-    flow.global_vars = {**flow.global_vars, **{
-        k: shell.user_ns[k] for k in shell.user_ns if k not in old_keys
-    }}
-    flow.global_vars_lock.release()
-
-    if res.error_before_exec or res.error_in_exec:
-        cube_execution_layer.errored = True
-        contents = cube_execution_layer.console_output.getvalue()
+    module = DummyMod()
+    module.__dict__ = local_global_vars
+    own_module, own_ns, own_ns_table = shell.user_module, shell.user_ns, dict(shell.ns_table)
+    try:
+        shell.user_module, shell.user_ns = module, local_global_vars
+        shell.ns_table["user_global"] = shell.ns_table["user_local"] = local_global_vars
+        # _ih, In, Out, get_ipython, ... are the shell's, not the cell's
+        shell.init_user_ns()
+        try:
+            res = shell.run_cell(cube_execution_layer.cube.code)
+            rbxm = local_global_vars["rbxm"]
+            rbxm.finish()
+        except:
+            cube_execution_layer.errored = True
+            contents = cube_execution_layer.console_output.getvalue()
+            cube_execution_layer.console_output.close()
+            cube_execution_layer.error(str(cube_execution_layer.execution_id), flow, "\n\nERROR:\n" + traceback.format_exc() + "\n", contents)
+            return
+
+        # Names the cell bound, O(names the cell touched)
+        flow.commit_global_vars({
+            k: v for k, v in local_global_vars.writes().items()
+            if k not in shell.user_ns_hidden and not _OUTPUT_HISTORY_NAME.fullmatch(k)
+        })
+
+        if res.error_before_exec or res.error_in_exec:
+            cube_execution_layer.errored = True
+            contents = cube_execution_layer.console_output.getvalue()
+
+            cube_execution_layer.console_output.close()
+            cube_execution_layer.error(str(cube_execution_layer.execution_id), flow, shell.error_message, contents)
+            return
+    finally:
+        shell.user_module, shell.user_ns = own_module, own_ns
+        shell.ns_table.update(own_ns_table)
+        flow.shell_pool.release(shell)
+        # Failed or not, the cell may have changed what it read in place
+        flow.reach_global_vars(local_global_vars.read_through)
 
-        cube_execution_layer.console_output.close()
-        cube_execution_layer.error(str(cube_execution_layer.execution_id), flow, shell.error_message, contents)
-    
-    print(res)
     if res.result is not None:
         print(res.result, file=cube_execution_layer.console_output)
 
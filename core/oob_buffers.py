@@ -0,0 +1,81 @@
+import os
+import mmap
+import uuid
+from collections import namedtuple
+import dill
+
+# A checkpoint file whose large buffers live in files of their own. pickle is the protocol 5
+# pickle of the state, buffers the names of the buffer files next to the checkpoint, in order
+OutOfBandPickle = namedtuple("OutOfBandPickle", ["pickle", "buffers"])
+
+def dumps_out_of_band(obj, threshold):
+    """
+    dill `obj` with pickle protocol 5. Buffers of at least `threshold` bytes that objects hand
+    out as PickleBuffers (NumPy arrays, pandas frames through their arrays, ...) are not copied
+    into the pickle, they are returned as memoryviews of the live objects instead.
+    Returns (pickle, [memoryview])
+    """
+    buffers = []
+
+    def buffer_callback(buffer):
+        view = buffer.raw()
+        if view.nbytes < threshold:
+            return True # in band
+        buffers.append(view)
+        return False
+
+    return dill.dumps(obj, protocol=5, buffer_callback=buffer_callback), buffers
+
+def buffer_names(path, count):
+    """
+    Names of the files next to checkpoint `path` its `count` buffers go to. Unique per call, so
+    rewriting a checkpoint never clobbers the buffers of the one it replaces.
+    """
+    token = uuid.uuid4().hex[:8]
+    return [f"{os.path.basename(path)}.{token}.{i}.buf" for i in range(count)]
+
+def detach(buffers):
+    """
+    Copies of the buffers in memory, so they can be written after the objects they came from
+    change. Buffers of bytes objects can not change and are kept as they are
+    """
+    return [view if isinstance(view.obj, bytes) else bytes(view) for view in buffers]
+
+def write_buffers(path, names, buffers):
+    """Write each buffer to its file next to checkpoint `path`. Not fsynced, see fsync_files"""
+    for name, data in zip(names, buffers):
+        with open(os.path.join(os.path.dirname(path), name), "wb") as f:
+            f.write(data)
+
+def fsync_files(paths):
+    for path in paths:
+        fd = os.open(path, os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+def wrap(blob, buffer_names):
+    # Checkpoints without out of band buffers keep the plain dill format
+    if not buffer_names:
+        return blob
+    return dill.dumps(OutOfBandPickle(blob, buffer_names))
+
+def _map_read_only(path):
+    with open(path, "rb") as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return memoryview(b"")
+        # The map outlives the file handle, and lives as long as some object uses its memory
+        return memoryview(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ))
+
+def load(path):
+    """
+    Load a checkpoint file. Out of band buffers are memory-mapped read-only, nothing of them
+    is read until the restored objects touch their pages.
+    """
+    with open(path, "rb") as f:
+        obj = dill.load(f)
+    if not isinstance(obj, OutOfBandPickle):
+        return obj
+    folder = os.path.dirname(path)
+    return dill.loads(obj.pickle, buffers=[_map_read_only(os.path.join(folder, name)) for name in obj.buffers])
@@ -3,6 +3,8 @@ import io
 from contextlib import redirect_stdout
 import threading
 import sys
+import builtins
+from .LayeredNamespace import LayeredNamespace
 
 
 # Create a thread-local object to hold per-thread stdout
@@ -67,32 +69,31 @@ def execute_code (cube_execution_layer, global_vars, flow):
     except ImportError:
         import riverbox_frontend
 
-    try:
-        flow.global_vars_lock.acquire()
-        try:
-            local_global_vars = {**global_vars, **cube_execution_layer.args}
-        except:
-            local_global_vars = {**global_vars}
-        flow.global_vars_lock.release()
+    # Reads fall through args then global vars, nothing is copied and no lock is needed
+    args = cube_execution_layer.args if isinstance(cube_execution_layer.args, dict) else {}
+    local_global_vars = LayeredNamespace(args, global_vars)
 
+    try:
         rbxm = riverbox_frontend.RiverboxCubeManager(cube_execution_layer.args, 
                                                      cube_execution_layer.get_client_box_metadata(),
                                                      flow.get_client_riverbox_metadata(), 
                                                      flow_registry=flow.flow_registry,
-                                                     main_callback = flow.callback_function)
-        local_global_vars["rbx"] = riverbox_frontend
-        local_global_vars["rbxm"] = rbxm
-        local_global_vars["__name__"] = "__main__"
+                                                     main_callback = flow.update_manager,
+                                                     worker_pool = flow.worker_pool,
+                                                     subflow_dispatcher = flow.subflow_dispatcher)
+        local_global_vars.seed("__builtins__", builtins.__dict__)
+        local_global_vars.seed("rbx", riverbox_frontend)
+        local_global_vars.seed("rbxm", rbxm)
+        local_global_vars.seed("__name__", "__main__")
 
         with ThreadStdoutRedirect(cube_execution_layer.console_output):
-            exec(cube_execution_layer.cube.code, local_global_vars)
+            code = cube_execution_layer.cube.compiled_code
+            exec(code if code is not None else cube_execution_layer.cube.code, local_global_vars)
 
             rbxm = local_global_vars["rbxm"]
             rbxm.finish()
 
-        flow.global_vars_lock.acquire()
-        flow.global_vars = {**flow.global_vars, **local_global_vars}
-        flow.global_vars_lock.release()
+        flow.commit_global_vars(local_global_vars.writes())
 
         cube_execution_layer.return_value = rbxm.output
 
@@ -101,3 +102,6 @@ def execute_code (cube_execution_layer, global_vars, flow):
         contents = cube_execution_layer.console_output.getvalue()
         cube_execution_layer.console_output.close()
         cube_execution_layer.error(str(cube_execution_layer.execution_id), flow, "\n\nERROR:\n" + traceback.format_exc() + "\n", contents)
+    finally:
+        # Failed or not, the layer may have changed what it read in place
+        flow.reach_global_vars(local_global_vars.read_through)
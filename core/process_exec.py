@@ -0,0 +1,129 @@
+import io
+import builtins
+import os
+import types
+import traceback
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+import dill
+
+from .LayeredNamespace import LayeredNamespace
+from .CodeCache import compiled_code_cache
+from .plain_python_exec import ThreadStdoutRedirect
+
+# Global vars of the cube being mapped, loaded once per worker process by _init_worker
+_worker_global_vars = {}
+
+def _mp_context():
+    # forkserver children fork from a clean single threaded server that already imported this
+    # module, so workers start fast and do not inherit the parent's running threads
+    if "forkserver" in multiprocessing.get_all_start_methods():
+        ctx = multiprocessing.get_context("forkserver")
+        ctx.set_forkserver_preload([__name__])
+        return ctx
+    return multiprocessing.get_context("spawn")
+
+def serialize_global_vars(global_vars, lock):
+    """
+    dill every global var on its own so one unpicklable value (a lock, a connection, ...)
+    only drops that key instead of the whole snapshot.
+    """
+    with lock:
+        items = list(global_vars.items())
+
+    serialized = {}
+    for k, v in items:
+        if isinstance(k, str) and k.startswith("__"):
+            continue
+        try:
+            serialized[k] = dill.dumps(v)
+        except Exception:
+            print("Global var", k, "can not be sent to worker processes, skipping it")
+    return dill.dumps(serialized)
+
+def _init_worker(global_vars_blob):
+    global _worker_global_vars
+    _worker_global_vars = {k: dill.loads(v) for k, v in dill.loads(global_vars_blob).items()}
+
+def _picklable_writes(writes):
+    picklable = {}
+    for k, v in writes.items():
+        if isinstance(v, (types.ModuleType, types.FunctionType, type)):
+            continue
+        try:
+            dill.dumps(v)
+        except Exception:
+            continue
+        picklable[k] = v
+    return picklable
+
+def _run_layer(code, language, args_blob, box_metadata, riverbox_metadata):
+    try:
+        from .. import riverbox_frontend
+    except ImportError:
+        import riverbox_frontend
+
+    console_output = io.StringIO()
+    result = {}
+    try:
+        args = dill.loads(args_blob)
+        local_global_vars = LayeredNamespace(args if isinstance(args, dict) else {}, _worker_global_vars)
+        # No callback in a worker process, subflows called from code run without events
+        rbxm = riverbox_frontend.RiverboxCubeManager(args, box_metadata, riverbox_metadata)
+        local_global_vars.seed("rbx", riverbox_frontend)
+        local_global_vars.seed("rbxm", rbxm)
+        local_global_vars.seed("__name__", "__main__")
+        local_global_vars.seed("__builtins__", builtins.__dict__)
+
+        with ThreadStdoutRedirect(console_output):
+            exec(compiled_code_cache.get(code, language), local_global_vars)
+            rbxm = local_global_vars["rbxm"]
+            rbxm.finish()
+
+        result["return-value"] = rbxm.output
+        result["writes"] = _picklable_writes(local_global_vars.writes())
+        result["console-output"] = console_output.getvalue()
+        return dill.dumps(result)
+    except Exception:
+        # Also covers a return value that can not be sent back
+        return dill.dumps({"error": "\n\nERROR:\n" + traceback.format_exc() + "\n", "console-output": console_output.getvalue()})
+
+class ProcessLayerPool:
+    """
+    Worker processes for the layers of one map cube. The global vars at the start of the cube
+    are shipped once per worker through the pool initializer, layers only ship their args.
+    """
+    def __init__(self, global_vars, global_vars_lock, max_workers=None):
+        self.max_workers = max_workers or os.cpu_count() or 1
+        self.executor = ProcessPoolExecutor(
+            self.max_workers,
+            mp_context=_mp_context(),
+            initializer=_init_worker,
+            initargs=(serialize_global_vars(global_vars, global_vars_lock),))
+
+    def submit(self, code, language, args, box_metadata, riverbox_metadata):
+        return self.executor.submit(_run_layer, code, language, dill.dumps(args), box_metadata, riverbox_metadata)
+
+    def shutdown(self):
+        self.executor.shutdown(wait=True)
+
+def execute_code (cube_execution_layer, global_vars, flow):
+    cube = cube_execution_layer.cube
+    try:
+        future = cube.process_pool.submit(cube.code, flow.riverbox_metadata["language"], cube_execution_layer.args,
+                                          cube_execution_layer.get_client_box_metadata(),
+                                          flow.get_client_riverbox_metadata())
+        result = dill.loads(future.result())
+    except Exception:
+        result = {"error": "\n\nERROR:\n" + traceback.format_exc() + "\n", "console-output": ""}
+
+    cube_execution_layer.console_output.write(result["console-output"])
+
+    if "error" in result:
+        contents = cube_execution_layer.console_output.getvalue()
+        cube_execution_layer.console_output.close()
+        cube_execution_layer.error(str(cube_execution_layer.execution_id), flow, result["error"], contents)
+        return
+
+    flow.commit_global_vars(result["writes"])
+    cube_execution_layer.return_value = result["return-value"]
@@ -101,7 +101,8 @@ class Cube:
         Create an edge from self → target.
         - `end_arg_key`: which argument on the target this edge feeds into.
         - `start_arg_key`: which output key on self is being sent (or None).
-        - `kind`: e.g. "REGULAR", "MAP", etc.
+        - `kind`: "REGULAR", "MAP" (layers over the product of map inputs) or "ZIP"
+          (layers over the map inputs paired element-wise, they must have the same length).
         """
         eid = edge_id or _new_id()
         edge = {
@@ -1,7 +1,7 @@
 from core.call_external_flow import call_external_flow
 
 class RiverboxCubeManager ():
-  def __init__(self, inputs: dict, box_metadata: dict=None, riverbox_metadata: dict=None, flow_registry: dict=None, main_callback=None):
+  def __init__(self, inputs: dict, box_metadata: dict=None, riverbox_metadata: dict=None, flow_registry: dict=None, main_callback=None, worker_pool=None, subflow_dispatcher=None):
     self.input = inputs
     self.output = None
     self.next_function = None
@@ -12,6 +12,19 @@ class RiverboxCubeManager ():
     self.riverbox_metadata = riverbox_metadata
     self.flow_registry = flow_registry if flow_registry is not None else {}
     self.main_callback = main_callback
+    self.worker_pool = worker_pool
+    self.subflow_dispatcher = subflow_dispatcher
+
+  def __getstate__ (self):
+    # Checkpoints can reach a cube manager through a global function's globals. The callback and
+    # pool belong to the live execution, and the callback would drag the whole flow along
+    return {k: v for k, v in self.__dict__.items() if k not in ("main_callback", "worker_pool", "subflow_dispatcher")}
+
+  def __setstate__ (self, state):
+    self.__dict__.update(state)
+    self.main_callback = None
+    self.worker_pool = None
+    self.subflow_dispatcher = None
 
   def get_next (self):
     return (self.output, self.next_function)
@@ -49,6 +62,10 @@ class RiverboxCubeManager ():
     callback = self.main_callback if self.main_callback is not None else lambda x: x
 
     # Pass flow_registry to enable speculation/caching in nested calls
-    result = call_external_flow(body, {**self.riverbox_metadata, "invocation-id": None}, callback, args, flow_registry=self.flow_registry)
+    # Events of the subflow point back at the calling layer, and it runs on the caller's pool
+    parent_cubeexecution_id = (self.box_metadata or {}).get("cube-execution-id")
+    result = call_external_flow(body, {**self.riverbox_metadata, "invocation-id": None}, callback, args,
+                                parent_cubeexecution_id=parent_cubeexecution_id, flow_registry=self.flow_registry,
+                                worker_pool=self.worker_pool, dispatcher=self.subflow_dispatcher)
     return result
 
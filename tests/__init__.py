@@ -1,4 +1,8 @@
 import inspect
+import threading
+from uuid import uuid4
+from core.FlowExecution import FlowExecution
+from riverbox_builder import Flow
 
 def multi_language(*languages):
     def decorator(f):
@@ -29,3 +33,47 @@ def multi_language(*languages):
                 f(**{rbx_kwarg_key:riverbox})
         return wrapper
     return decorator
+
+def new_metadata():
+    """Execution metadata with fresh ids"""
+    return {"execution-id": str(uuid4()), "flow-id": str(uuid4()), "invocation-id": str(uuid4())}
+
+def new_execution(flow, callback=None, **kwargs):
+    """A FULL FlowExecution of the builder Flow `flow`, messages go to `callback`"""
+    return FlowExecution(flow.to_dict(), new_metadata(), callback or (lambda m: None), "FULL", None, None, **kwargs)
+
+def get_map_flow(items, cube_metadata=None, **flow_metadata):
+    """Squares range(items) over a MAP edge into result "squares" """
+    flow = Flow(name="Map", language="python", version="3.12")
+    flow.metadata.update(flow_metadata)
+    count = flow.add_cube({"kind": "PARAM", "name": "Count", "arg-key": "count", "default-value": str(items)})
+    square = flow.add_cube({
+        "kind": "REGULAR",
+        "name": "Square",
+        "code": "@rbxm.main_handler\ndef square(i):\n  return i * i",
+        "metadata": cube_metadata or {},
+    })
+    result = flow.add_cube({"kind": "RESULT", "name": "Result", "arg-key": "squares"})
+    # An int on a MAP edge maps over range(int)
+    count.add_edge_to(square, end_arg_key="i", kind="MAP")
+    square.add_edge_to(result)
+    return flow
+
+def get_mapped_flow(sub, items):
+    """Maps list(range(items)) into the FLOW cube `sub`, its results go to result "results" """
+    flow = Flow(name="Main", language="python", version="3.12")
+    source = flow.add_cube({"kind": "REGULAR", "name": "Items", "code": f"rbxm.output = list(range({items}))"})
+    call = flow.add_cube(sub)
+    result = flow.add_cube({"kind": "RESULT", "name": "Result", "arg-key": "results"})
+    source.add_edge_to(call, end_arg_key="x", kind="MAP")
+    call.add_edge_to(result)
+    return flow
+
+def collect_messages():
+    """(list, callback appending to it), safe to call from the threads of the pool"""
+    messages = []
+    lock = threading.Lock()
+    def callback(message):
+        with lock:
+            messages.append(message)
+    return messages, callback
@@ -0,0 +1,21 @@
+import pytest
+from benchmarks.engine import BENCHMARKS, run_benchmark, run_isolated, compare
+
+@pytest.mark.parametrize("name", list(BENCHMARKS))
+def test_benchmarks_run(name):
+    result = run_benchmark(name, size=4, repeat=1)
+    assert result["cube-executions"] >= 4
+    assert result["cubes-per-second"] > 0 and result["peak-rss-bytes"] > 0
+    assert (result["checkpoint-bytes"] > 0) == BENCHMARKS[name][2]
+
+def test_isolated_run_and_baseline_comparison():
+    result = run_isolated("chain", size=10, repeat=1)
+    assert result["benchmark"] == "chain" and result["cube-executions"] == 10
+
+    baseline = {"results": [result]}
+    slower = dict(result, **{"cubes-per-second": result["cubes-per-second"] / 2, "wall-seconds": result["wall-seconds"] * 2})
+    changes = {c["metric"]: c for c in compare({"results": [slower]}, baseline)}
+    assert changes["cubes-per-second"]["regression"] and changes["wall-seconds"]["regression"]
+    assert not changes["peak-rss-bytes"]["regression"]
+    # A faster run is no regression
+    assert not any(c["regression"] for c in compare(baseline, {"results": [slower]}))
@@ -0,0 +1,41 @@
+import os
+from core.CheckpointManifest import CheckpointManifest
+
+def write(manifest, counter, kind, base):
+    with open(manifest.path(manifest.file_name(counter, kind)), "wb") as f:
+        f.write(b"x")
+    manifest.add(counter, kind, base, 1)
+
+def test_nearest_lower_lookup_and_reload(tmp_path):
+    manifest = CheckpointManifest(str(tmp_path), "flow_id_f_execution_id_e")
+    write(manifest, 0, "full", None)
+    write(manifest, 40, "delta", 0)
+    write(manifest, 1000, "delta", 40)
+
+    assert manifest.nearest(39)["count"] == 0
+    assert manifest.nearest(999)["count"] == 40
+    assert manifest.nearest(5000)["count"] == 1000
+    assert manifest.nearest(39, allow_closest_lower=False) is None
+    assert manifest.nearest(-1) is None
+
+    # A new manifest reads the saved one instead of looking at the dumps
+    reloaded = CheckpointManifest(str(tmp_path), "flow_id_f_execution_id_e")
+    assert [(e["count"], e["kind"], e["base"]) for e in reloaded.list()] == [(0, "full", None), (40, "delta", 0), (1000, "delta", 40)]
+
+def test_dumps_without_a_manifest_are_indexed(tmp_path):
+    for name in ["flow_id_f_execution_id_e_global_vars_after_0.dill", "flow_id_f_execution_id_e_delta_after_3.dill",
+                 "flow_id_f_execution_id_other_global_vars_after_1.dill"]:
+        (tmp_path / name).write_bytes(b"x")
+
+    manifest = CheckpointManifest(str(tmp_path), "flow_id_f_execution_id_e")
+    assert [(e["count"], e["kind"], e["base"]) for e in manifest.list()] == [(0, "full", None), (3, "delta", 0)]
+
+def test_retention_keeps_the_chains_of_kept_deltas(tmp_path):
+    manifest = CheckpointManifest(str(tmp_path), "p", keep_last=2, keep_every=10)
+    # A full snapshot every 4 checkpoints, deltas in between
+    for counter in range(13):
+        write(manifest, counter, "full" if counter % 4 == 0 else "delta", None if counter % 4 == 0 else counter - 1)
+
+    # 11 and 12 are the last two, 10 is a multiple of 10, 8 and 9 are what 10 and 11 replay from
+    assert [e["count"] for e in manifest.list()] == [0, 8, 9, 10, 11, 12]
+    assert sorted(os.listdir(tmp_path)) == sorted([manifest.file_name(c, "full" if c % 4 == 0 else "delta") for c in [0, 8, 9, 10, 11, 12]] + ["p_manifest.json"])
@@ -0,0 +1,46 @@
+import os
+import threading
+from core.CheckpointWriter import CheckpointWriter
+
+def test_writer_writes_in_order_and_applies_backpressure(tmp_path):
+    release = threading.Event()
+    messages = []
+
+    def update_manager(m):
+        # Holds the writer thread on the first checkpoint
+        release.wait()
+        messages.append(m)
+
+    writer = CheckpointWriter(update_manager, max_queued=1)
+    writer.submit(str(tmp_path / "0"), b"a", {"global-execution-count": 0})
+    writer.submit(str(tmp_path / "1"), b"bb", {"global-execution-count": 1})
+
+    # The writer is stuck on 0 and 1 fills the queue, so 2 has to wait
+    third_metrics = {"global-execution-count": 2}
+    third = threading.Thread(target=writer.submit, args=(str(tmp_path / "2"), b"ccc", third_metrics, str(tmp_path / "0")))
+    third.start()
+    third.join(0.2)
+    assert third.is_alive()
+
+    release.set()
+    third.join()
+    writer.close()
+
+    assert [m["global-execution-count"] for m in messages] == [0, 1, 2]
+    assert [m["bytes"] for m in messages] == [1, 2, 3]
+    assert all(m["type"] == "CHECKPOINT_WRITTEN" and m["latency-seconds"] >= m["write-seconds"] for m in messages)
+    # The wait is in the message, the caller's dict is left alone
+    assert messages[2]["backpressure-seconds"] >= 0.2 and messages[0]["backpressure-seconds"] < 0.2
+    assert third_metrics == {"global-execution-count": 2}
+    # 2 named 0 as stale
+    assert sorted(os.listdir(tmp_path)) == ["1", "2"]
+
+def test_writer_errors_surface_on_flush(tmp_path):
+    writer = CheckpointWriter(lambda m: None)
+    writer.submit(str(tmp_path / "missing" / "0"), b"a", {})
+    try:
+        writer.flush()
+        assert False, "flush should raise"
+    except FileNotFoundError:
+        pass
+    writer.close()
@@ -0,0 +1,50 @@
+from core.CodeCache import CompiledCodeCache, compiled_code_cache
+from riverbox_builder import Flow
+from . import new_execution
+
+def test_lru_eviction():
+    cache = CompiledCodeCache(max_size=2)
+    a = cache.get("a = 1", "python")
+    cache.get("b = 1", "python")
+    assert cache.get("a = 1", "python") is a
+    cache.get("c = 1", "python")
+    assert len(cache) == 2
+    assert CompiledCodeCache.key("b = 1", "python", "<string>") not in cache.entries
+    assert cache.get("a = 1", "python") is a
+
+def test_map_layers_share_compiled_code():
+    code = "@rbxm.main_handler\ndef double(x):\n  return x * 2\n# test_map_layers_share_compiled_code"
+    flow = Flow(name="Map", language="python", version="3.12")
+    param = flow.add_cube({"kind": "PARAM", "name": "Items", "arg-key": "items", "default-value": "[1, 2, 3]"})
+    double = flow.add_cube({"kind": "REGULAR", "name": "Double", "code": code})
+    result = flow.add_cube({"kind": "RESULT", "name": "Result", "arg-key": "doubled"})
+    param.add_edge_to(double, end_arg_key="x", kind="MAP")
+    double.add_edge_to(result)
+
+    misses = compiled_code_cache.misses
+    first = new_execution(flow)
+    second = new_execution(flow)
+    assert compiled_code_cache.misses == misses + 1
+    assert first.latest_cubes_lookup[double.id].compiled_code is second.latest_cubes_lookup[double.id].compiled_code
+
+    assert first.execute({}) == {"doubled": [2, 4, 6]}
+
+def test_syntax_error_is_pre_execution_error():
+    flow = Flow(name="Broken", language="python", version="3.12")
+    broken = flow.add_cube({"kind": "REGULAR", "name": "Broken", "code": "def broken(:\n  pass"})
+    errors = []
+
+    def callback(m):
+        if m["type"] == "CUBE_EXECUTION_ERROR":
+            errors.append(m["error-message"])
+
+    flow_exec = new_execution(flow, callback)
+    assert "SyntaxError" in flow_exec.latest_cubes_lookup[broken.id].pre_execution_error
+    flow_exec.execute({})
+    assert len(errors) == 1 and "SyntaxError" in errors[0]
+
+def test_ipython_cells_are_not_compiled():
+    flow = Flow(name="Magic", language="ipython", version="3.12")
+    magic = flow.add_cube({"kind": "REGULAR", "name": "Magic", "code": "%time x = 1\n!echo hi"})
+    cube = new_execution(flow).latest_cubes_lookup[magic.id]
+    assert not cube.pre_execution_error and cube.compiled_code is None
@@ -0,0 +1,101 @@
+import time
+import threading
+from core.ConsoleStream import ConsoleStream
+from riverbox_builder import Flow
+from . import new_execution
+
+def run_printing_cube(code, **settings):
+    flow = Flow(name="Chatty", language="python", version="3.12")
+    for key, value in settings.items():
+        flow.metadata[key] = value
+    flow.add_cube({"kind": "REGULAR", "name": "Chatty", "code": code})
+
+    messages = []
+    flow_exec = new_execution(flow, messages.append)
+    flow_exec.execute({})
+    return messages
+
+def test_long_output_is_streamed_in_order_with_a_bounded_tail():
+    messages = run_printing_cube("import time\nfor i in range(2000):\n    print(f'line {i:05}')\ntime.sleep(0.3)",
+                                 **{"console-chunk-size": 1000, "console-tail-size": 500})
+
+    chunks = [m for m in messages if m["type"] == "CUBE_CONSOLE_OUTPUT"]
+    [success] = [m for m in messages if m["type"] == "SUCCESSFUL_CUBE_EXECUTION"]
+    assert len(chunks) > 1
+    assert all(len(c["output"]) <= 1000 for c in chunks)
+    assert [c["sequence"] for c in chunks] == list(range(1, len(chunks) + 1))
+    assert messages.index(chunks[-1]) < messages.index(success)
+    assert "".join(c["output"] for c in chunks) == "".join(f"line {i:05}\n" for i in range(2000))
+
+    assert success["console-output"].startswith("[... ")
+    assert success["console-output"].endswith("line 01999\n")
+    assert len(success["console-output"].split("\n", 1)[1]) == 500
+
+def test_quiet_output_is_flushed_after_the_interval():
+    messages = run_printing_cube("import time\nprint('started')\ntime.sleep(0.6)\nprint('done')",
+                                 **{"console-flush-interval": 0.2})
+
+    chunks = [m for m in messages if m["type"] == "CUBE_CONSOLE_OUTPUT"]
+    [success] = [m for m in messages if m["type"] == "SUCCESSFUL_CUBE_EXECUTION"]
+    assert [c["output"] for c in chunks] == ["started\n", "done\n"]
+    assert success["console-output"] == "started\ndone\n"
+
+def test_short_output_only_goes_out_with_the_result():
+    messages = run_printing_cube("print('hi')")
+
+    assert not [m for m in messages if m["type"] == "CUBE_CONSOLE_OUTPUT"]
+    [success] = [m for m in messages if m["type"] == "SUCCESSFUL_CUBE_EXECUTION"]
+    assert success["console-output"] == "hi\n"
+
+def test_stream_without_overflow_keeps_everything():
+    chunks = []
+    stream = ConsoleStream(lambda chunk, sequence: chunks.append(chunk), chunk_size=10, tail_size=100)
+    stream.write("a" * 25)
+    stream.close()
+    assert chunks == [] and stream.getvalue() == "a" * 25
+
+class Group:
+    pass
+
+def test_slow_callback_caps_pending_output():
+    chunks = []
+    def slow_emit(chunk, sequence):
+        time.sleep(0.05)
+        chunks.append(chunk)
+
+    # Waiting long enough, the writer keeps pace with the callback and nothing is lost
+    stream = ConsoleStream(slow_emit, chunk_size=100, max_pending_chunks=2, block_seconds=5, tail_size=100000, group=Group())
+    for i in range(40):
+        stream.write(f"{i:049}\n")
+        assert stream.pending_size <= 200
+    stream.close()
+    assert "".join(chunks) == "".join(f"{i:049}\n" for i in range(40))
+
+    # Not waiting, what does not fit is only in the tail
+    chunks.clear()
+    stream = ConsoleStream(slow_emit, chunk_size=100, max_pending_chunks=2, block_seconds=0.01, tail_size=100000, group=Group())
+    for i in range(40):
+        stream.write(f"{i:049}\n")
+        assert stream.pending_size <= 200
+    stream.close()
+    streamed = "".join(chunks)
+    assert "characters not streamed" in streamed and streamed.endswith(f"{39:049}\n")
+    assert stream.getvalue() == "".join(f"{i:049}\n" for i in range(40))
+
+def test_slow_callback_only_holds_up_its_own_flow():
+    stuck = threading.Event()
+    def stuck_emit(chunk, sequence):
+        stuck.wait(5)
+    arrived = threading.Event()
+
+    slow = ConsoleStream(stuck_emit, chunk_size=10, group=Group())
+    fast = ConsoleStream(lambda chunk, sequence: arrived.set(), chunk_size=10, group=Group())
+    slow.write("a" * 10)
+    time.sleep(0.3)
+    fast.write("b" * 10)
+    try:
+        assert arrived.wait(1)
+    finally:
+        stuck.set()
+        slow.close()
+        fast.close()
@@ -0,0 +1,66 @@
+import time
+import threading
+import pytest
+from core.EventDispatcher import EventDispatcher
+from . import new_execution, get_map_flow
+
+class BatchingCallback:
+    def __init__(self, delay):
+        self.delay = delay
+        self.batches = []
+
+    def __call__(self, message):
+        raise AssertionError("batch callbacks get lists")
+
+    def batch(self, messages):
+        time.sleep(self.delay)
+        self.batches.append(messages)
+
+def test_slow_batch_callback_gets_every_message_in_order():
+    callback = BatchingCallback(0.02)
+    results = new_execution(get_map_flow(500, **{"event-dispatch": "queued"}), callback).execute({})
+
+    assert results["squares"] == [i * i for i in range(500)]
+    messages = [m for batch in callback.batches for m in batch]
+    # Everything is delivered by the time execute returns
+    assert messages[0]["type"] == "NEW_EXECUTION" and messages[-1]["type"] == "EXECUTION_DONE"
+    assert sum(m["type"] == "SUCCESSFUL_CUBE_EXECUTION" for m in messages) == 501
+    # 1000+ messages at 20ms each would take 20s
+    assert len(callback.batches) < 100
+
+    # Per layer, START comes before SUCCESSFUL
+    started = set()
+    for m in messages:
+        if m["type"] == "START_CUBE_EXECUTION":
+            started.add(m["cube-execution-id"])
+        elif m["type"] == "SUCCESSFUL_CUBE_EXECUTION":
+            assert m["cube-execution-id"] in started
+
+def test_callback_errors_are_raised_at_the_end_of_execute():
+    seen = []
+
+    def callback(m):
+        seen.append(m["type"])
+        if m["type"] == "START_CUBE_EXECUTION":
+            raise ValueError("callback failed")
+
+    with pytest.raises(ValueError, match="callback failed"):
+        new_execution(get_map_flow(3, **{"event-dispatch": "queued"}), callback).execute({})
+    # The execution ran to the end anyway
+    assert seen[-1] == "EXECUTION_DONE"
+
+def test_full_queue_blocks_put():
+    release = threading.Event()
+    dispatcher = EventDispatcher(lambda m: release.wait(), max_queued=2)
+    for i in range(3):
+        # 0 is being delivered, 1 and 2 fill the queue
+        dispatcher.put(i)
+
+    blocked = threading.Thread(target=dispatcher.put, args=(3,))
+    blocked.start()
+    blocked.join(0.2)
+    assert blocked.is_alive()
+
+    release.set()
+    blocked.join()
+    dispatcher.close()
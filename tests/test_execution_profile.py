@@ -0,0 +1,66 @@
+import threading
+import time
+from riverbox_builder import Flow
+from . import new_execution
+
+def test_profile_report_and_events():
+    flow = Flow(name="Profiled", language="python", version="3.12")
+    flow.metadata["profile"] = True
+    flow.metadata["profile-events"] = True
+    flow.metadata["profile-memory"] = True
+    items = flow.add_cube({"kind": "REGULAR", "name": "Items", "code": "rbxm.output = [1, 2, 3]"})
+    busy = flow.add_cube({"kind": "REGULAR", "name": "Busy", "code": (
+        "import time\n"
+        "started = time.thread_time()\n"
+        "while time.thread_time() - started < 0.05:\n"
+        "    pass\n"
+        "rbxm.output = x")})
+    allocate = flow.add_cube({"kind": "REGULAR", "name": "Allocate", "code": "block = bytearray(5 * 1024 * 1024)\nrbxm.output = len(block)"})
+    items.add_edge_to(busy, end_arg_key="x", kind="MAP")
+    busy.add_edge_to(allocate, end_arg_key="x")
+
+    messages = []
+    flow_exec = new_execution(flow, messages.append)
+    flow_exec.execute({})
+
+    profiles = [m for m in messages if m["type"] == "PROFILE"]
+    assert len(profiles) == 5 # 1 + 3 layers + 1
+    [report] = [m["report"] for m in messages if m["type"] == "PROFILE_REPORT"]
+    types = [m["type"] for m in messages]
+    assert types.index("PROFILE_REPORT") < types.index("EXECUTION_DONE")
+
+    cubes = {c["name"]: c for c in report["cubes"]}
+    assert report["cubes"][0]["name"] == "Busy"
+    assert cubes["Busy"]["layers"] == 3 and cubes["Busy"]["runs"] == 1
+    assert cubes["Busy"]["cpu-seconds"] >= 0.15
+    assert cubes["Items"]["cpu-seconds"] < 0.05
+    assert cubes["Allocate"]["peak-bytes"] >= 5 * 1024 * 1024
+    # Every cube and layer sends at least its start and end messages
+    assert all(c["callback-seconds"] > 0 for c in report["cubes"])
+    assert report["scheduler-calls"] >= 3 and report["wall-seconds"] >= cubes["Busy"]["cube-wall-seconds"]
+
+def test_lock_wait_is_measured():
+    flow = Flow(name="Locked", language="python", version="3.12")
+    flow.metadata["profile"] = True
+    flow.add_cube({"kind": "REGULAR", "name": "Writer", "code": "value = 1"})
+
+    flow_exec = new_execution(flow)
+    flow_exec.global_vars_lock.acquire()
+    runner = threading.Thread(target=flow_exec.execute, args=({},))
+    runner.start()
+    time.sleep(0.2)
+    flow_exec.global_vars_lock.release()
+    runner.join()
+
+    [writer] = flow_exec.profile.report()["cubes"]
+    assert writer["lock-wait-seconds"] >= 0.15
+    assert flow_exec.global_vars["value"] == 1
+
+def test_no_profile_by_default():
+    flow = Flow(name="Plain", language="python", version="3.12")
+    flow.add_cube({"kind": "REGULAR", "name": "Cube", "code": "rbxm.output = 1"})
+    messages = []
+    flow_exec = new_execution(flow, messages.append)
+    flow_exec.execute({})
+    assert flow_exec.profile is None
+    assert not [m for m in messages if m["type"] in ["PROFILE", "PROFILE_REPORT"]]
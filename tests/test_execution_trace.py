@@ -0,0 +1,57 @@
+import json
+from riverbox_builder import Flow
+from . import new_execution, get_mapped_flow
+
+def test_critical_path_and_slack():
+    flow = Flow(name="Traced", language="python", version="3.12")
+    flow.metadata["trace"] = True
+    start = flow.add_cube({"kind": "REGULAR", "name": "Start", "code": "rbxm.output = 1"})
+    slow = flow.add_cube({"kind": "REGULAR", "name": "Slow", "code": "import time\ntime.sleep(0.2)\nrbxm.output = x"})
+    fast = flow.add_cube({"kind": "REGULAR", "name": "Fast", "code": "rbxm.output = x"})
+    join = flow.add_cube({"kind": "REGULAR", "name": "Join", "code": "rbxm.output = a + b"})
+    start.add_edge_to(slow, end_arg_key="x")
+    start.add_edge_to(fast, end_arg_key="x")
+    slow.add_edge_to(join, end_arg_key="a")
+    fast.add_edge_to(join, end_arg_key="b")
+
+    messages = []
+    flow_exec = new_execution(flow, messages.append)
+    flow_exec.execute({})
+
+    [report] = [m for m in messages if m["type"] == "TRACE_REPORT"]
+    assert [span["name"] for span in report["critical-path"]] == ["Start", "Slow", "Join"]
+    assert report["critical-path"][1]["duration-seconds"] >= 0.2
+    assert report["slack"][fast.id] >= 0.15
+    assert all(report["slack"][cube.id] < 0.05 for cube in [start, slow, join])
+
+    # Every layer span hangs off the span of its cube run, every cube span off the flow span
+    spans = {span["id"]: span for span in flow_exec.trace.spans}
+    assert all(spans[s["parent"]]["kind"] == "cube" for s in spans.values() if s["kind"] == "layer")
+    assert all(spans[s["parent"]]["kind"] == "flow" for s in spans.values() if s["kind"] == "cube")
+
+def test_subflow_spans_and_chrome_export(tmp_path):
+    sub = Flow(name="Sub", run_on_same=True, language="python", version="3.12", tags=["sub"])
+    x = sub.add_cube({"kind": "PARAM", "name": "X", "arg-key": "x", "default-value": "0"})
+    double = sub.add_cube({"kind": "REGULAR", "name": "Double", "code": "rbxm.output = x * 2"})
+    result = sub.add_cube({"kind": "RESULT", "name": "Result", "arg-key": "doubled"})
+    x.add_edge_to(double, end_arg_key="x")
+    double.add_edge_to(result)
+
+    trace_file = tmp_path / "trace.json"
+    flow = get_mapped_flow(sub, 2)
+    flow.metadata["trace-file"] = str(trace_file)
+
+    flow_exec = new_execution(flow)
+    flow_exec.execute({})
+
+    [call] = [c for c in flow_exec.cubes if c.kind == "FLOW"]
+    spans = {span["id"]: span for span in flow_exec.trace.spans}
+    sub_flows = [s for s in spans.values() if s["kind"] == "flow" and s["parent"] is not None]
+    assert len(sub_flows) == 2
+    assert all(spans[s["parent"]]["kind"] == "layer" and spans[s["parent"]]["cube-id"] == call.id for s in sub_flows)
+    assert all(spans[s["parent"]]["start"] <= s["start"] and s["end"] <= spans[s["parent"]]["end"] for s in sub_flows)
+
+    events = json.loads(trace_file.read_text())["traceEvents"]
+    assert len(events) == len(spans)
+    assert all(e["ph"] == "X" and e["dur"] >= 0 for e in events)
+    assert {e["name"] for e in events if "critical" in e["cat"]} == {"Items", "Sub", "Result"}
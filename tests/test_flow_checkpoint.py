@@ -267,3 +267,125 @@ def test_debug_execution_with_checkpoint():
             # Verify that the cubes are properly restored
             assert len(restored_flow.cubes) == 3
             assert restored_flow.cubes[2].code == "result = result * 2"
+
+def get_chain_flow(length):
+    from riverbox_builder import Flow
+    flow = Flow(name="Chain", language="python", version="3.12")
+    flow.metadata["checkpoint-full-every"] = 4
+    first = flow.add_cube({
+        "kind": "REGULAR",
+        "name": "Setup",
+        "code": "big = list(range(200000))\nseen = []\nstep = 0\nrbxm.output = 0",
+    })
+    previous = first
+    for i in range(length):
+        cube = flow.add_cube({
+            "kind": "REGULAR",
+            "name": f"Step {i}",
+            # step is rebound, seen is only changed in place
+            "code": "@rbxm.main_handler\ndef step_once(n):\n  global step\n  step = n + 1\n  seen.append(n)\n  return n + 1",
+        })
+        previous.add_edge_to(cube, end_arg_key="n")
+        previous = cube
+    return flow
+
+def test_delta_checkpoints_replay_to_every_count():
+    with tempfile.TemporaryDirectory() as temp_dir:
+        flow = get_chain_flow(8)
+        messages = []
+        flow_exec = FlowExecution(
+            flow.to_dict(),
+            {"execution-id": str(uuid4()), "flow-id": str(uuid4()), "invocation-id": str(uuid4())},
+            messages.append, "FULL", None, None, temp_dir)
+        flow_exec.execute({})
+
+        # Written by the background writer, all of them done by the time execute returns
+        written = [m for m in messages if m["type"] == "CHECKPOINT_WRITTEN"]
+        assert [m["global-execution-count"] for m in written] == list(range(9))
+        assert [m["checkpoint-kind"] for m in written].count("full") == 3
+        assert [e["count"] for e in flow_exec.list_checkpoints()] == list(range(9))
+
+        files = os.listdir(temp_dir)
+        full = [f for f in files if "_global_vars_after_" in f]
+        deltas = [f for f in files if "_delta_after_" in f]
+        # One count per cube, a full snapshot every 4 checkpoints
+        assert len(full) + len(deltas) == 9
+        assert len(full) == 3
+
+        # Only the delta right after Setup carries the big list, no later cube touches it
+        big_size = max(os.path.getsize(os.path.join(temp_dir, f)) for f in files)
+        small = [f for f in deltas if os.path.getsize(os.path.join(temp_dir, f)) < big_size / 10]
+        assert len(small) == len(deltas) - 1
+
+        for count in range(1, 9):
+            restored = flow_exec.get_flow_from_checkpoint(count)
+            assert restored.global_execution_count == count
+            assert restored.global_vars["step"] == count - 1
+            assert restored.global_vars["seen"] == list(range(count - 1))
+            assert len(restored.global_vars["big"]) == 200000
+            assert [c.done for c in restored.cubes] == [i < count for i in range(9)]
+
+def test_checkpoint_retention_prunes_without_breaking_replay():
+    with tempfile.TemporaryDirectory() as temp_dir:
+        flow = get_chain_flow(8)
+        flow.metadata["checkpoint-keep-last"] = 1
+        flow_exec = FlowExecution(
+            flow.to_dict(),
+            {"execution-id": str(uuid4()), "flow-id": str(uuid4()), "invocation-id": str(uuid4())},
+            lambda x: None, "FULL", None, None, temp_dir)
+        flow_exec.execute({})
+
+        # Full snapshots at 0, 4 and 8, keeping the last leaves only 8
+        assert [e["count"] for e in flow_exec.list_checkpoints()] == [8]
+        assert flow_exec.get_flow_from_checkpoint(8).global_vars["step"] == 7
+        assert flow_exec.get_flow_from_checkpoint(7) is None
+
+def test_deltas_catch_changes_through_helpers_and_aliases():
+    from riverbox_builder import Flow
+    flow = Flow(name="Helpers", language="python", version="3.12")
+    previous = flow.add_cube({
+        "kind": "REGULAR",
+        "name": "Setup",
+        "code": "seen = []\nboxes = {'seen': seen}\ndef record(n):\n  seen.append(n)\nrbxm.output = 0",
+    })
+    for i in range(4):
+        # Neither cube names seen
+        code = "record(n)\nrbxm.output = n + 1" if i % 2 == 0 else "alias = boxes['seen']\nalias.append(n)\nrbxm.output = n + 1"
+        cube = flow.add_cube({"kind": "REGULAR", "name": f"Step {i}", "code": code})
+        previous.add_edge_to(cube, end_arg_key="n")
+        previous = cube
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        flow_exec = FlowExecution(
+            flow.to_dict(),
+            {"execution-id": str(uuid4()), "flow-id": str(uuid4()), "invocation-id": str(uuid4())},
+            lambda m: None, "FULL", None, None, temp_dir)
+        flow_exec.execute({})
+        assert flow_exec.global_vars["seen"] == [0, 1, 2, 3]
+        assert [e["kind"] for e in flow_exec.list_checkpoints()] == ["full"] + ["delta"] * 4
+        restored = flow_exec.get_flow_from_checkpoint(4)
+        assert restored.global_vars["seen"] == [0, 1, 2]
+        # Still one list, as in the live flow
+        assert restored.global_vars["boxes"]["seen"] is restored.global_vars["seen"]
+
+def test_only_reached_global_vars_are_fingerprinted(monkeypatch):
+    from core.GlobalFingerprints import GlobalFingerprints
+    fingerprinted = []
+    fingerprint = GlobalFingerprints.fingerprint
+    def counting(value, *args):
+        fingerprinted.append(value)
+        return fingerprint(value, *args)
+    monkeypatch.setattr(GlobalFingerprints, "fingerprint", staticmethod(counting))
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        flow = get_chain_flow(8)
+        flow_exec = FlowExecution(
+            flow.to_dict(),
+            {"execution-id": str(uuid4()), "flow-id": str(uuid4()), "invocation-id": str(uuid4())},
+            lambda m: None, "FULL", None, None, temp_dir)
+        flow_exec.execute({})
+
+        # big once, when Setup wrote it. seen at every checkpoint after a step appended to it
+        assert sum(1 for value in fingerprinted if isinstance(value, list) and len(value) == 200000) == 1
+        assert sum(1 for value in fingerprinted if value is flow_exec.global_vars["seen"]) == 8
+        assert flow_exec.get_flow_from_checkpoint(8).global_vars["seen"] == list(range(7))
@@ -0,0 +1,112 @@
+import time
+import threading
+import importlib.util
+import pytest
+from riverbox_builder import Flow
+import core.ipynb_exec
+from core.ipynb_exec import ShellPool
+from . import new_execution
+
+# RiverboxIPythonShell enables the inline backend
+needs_matplotlib = pytest.mark.skipif(importlib.util.find_spec("matplotlib") is None, reason="matplotlib is not installed")
+
+def run(flow, shell_pool):
+    messages = []
+    flow_exec = new_execution(flow, messages.append, shell_pool=shell_pool)
+    flow_exec.execute({})
+    return flow_exec, messages
+
+@needs_matplotlib
+def test_layers_reuse_reset_shells():
+    flow = Flow(name="IPython Map", language="ipython", version="3.12")
+    items = flow.add_cube({"kind": "REGULAR", "name": "Items", "code": "rbxm.output = list(range(20))"})
+    square = flow.add_cube({"kind": "REGULAR", "name": "Square", "code": (
+        "leftover = x\n"
+        "print('square of', x)\n"
+        "rbxm.output = x * x")})
+    result = flow.add_cube({"kind": "RESULT", "name": "Result", "arg-key": "squares"})
+    items.add_edge_to(square, end_arg_key="x", kind="MAP")
+    square.add_edge_to(result)
+
+    pool = ShellPool(max_idle=2)
+    flow_exec, messages = run(flow, pool)
+
+    assert not [m for m in messages if m["type"] == "CUBE_EXECUTION_ERROR"]
+    assert flow_exec.get_result("squares") == [x * x for x in range(20)]
+    outputs = sorted(m["console-output"] for m in messages if m["type"] == "SUCCESSFUL_CUBE_EXECUTION" and "square" in m["console-output"])
+    assert outputs == sorted(f"square of {x}\n" for x in range(20))
+    assert 1 <= len(pool.idle) <= 2 # "ipython-warm-shells" defaults to 2
+    assert all("leftover" not in shell.user_ns for shell in pool.idle)
+
+@needs_matplotlib
+def test_cell_errors_are_reported_and_the_shell_is_reused():
+    flow = Flow(name="IPython Error", language="ipython", version="3.12")
+    flow.add_cube({"kind": "REGULAR", "name": "Boom", "code": "print('before')\n1 / 0"})
+
+    pool = ShellPool(max_idle=1)
+    _, messages = run(flow, pool)
+
+    [error] = [m for m in messages if m["type"] == "CUBE_EXECUTION_ERROR"]
+    assert "ZeroDivisionError" in error["error-message"]
+    assert error["console-output"] == "before\n"
+    assert pool.idle and all(shell.error_message == "" for shell in pool.idle)
+
+@needs_matplotlib
+def test_magics_globals_and_figures():
+    flow = Flow(name="IPython Magic", language="ipython", version="3.12")
+    setup = flow.add_cube({"kind": "REGULAR", "name": "Setup", "code": "base = 10\nrbxm.output = 1"})
+    plot = flow.add_cube({"kind": "REGULAR", "name": "Plot", "code": (
+        "import matplotlib.pyplot as plt\n"
+        "plt.figure()\n"
+        "%time y = base + x\n"
+        "rbxm.output = y")})
+    setup.add_edge_to(plot, end_arg_key="x")
+
+    pool = ShellPool(max_idle=1)
+    flow_exec, messages = run(flow, pool)
+
+    assert not [m for m in messages if m["type"] == "CUBE_EXECUTION_ERROR"]
+    assert flow_exec.latest_cubes_lookup[plot.id].return_value == 11
+    assert {"base", "y", "plt"} <= set(flow_exec.global_vars)
+    assert not {"x", "rbxm", "In", "get_ipython", "__builtins__"} & set(flow_exec.global_vars)
+    # No shell is borrowed any more, the figure was closed
+    import matplotlib.pyplot as plt
+    assert plt.get_fignums() == []
+
+def test_shells_are_built_one_at_a_time(monkeypatch):
+    building = []
+    overlaps = []
+
+    class Shell:
+        def __init__(self):
+            building.append(self)
+            overlaps.append(len(building))
+            time.sleep(0.02)
+            building.remove(self)
+
+    monkeypatch.setattr(core.ipynb_exec, "RiverboxIPythonShell", Shell)
+    pool = ShellPool(max_idle=0)
+    pool.warm(3)
+    threads = [threading.Thread(target=pool.acquire) for _ in range(5)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    pool.warming.join()
+    assert len(overlaps) == 8 and max(overlaps) == 1
+
+def test_shell_that_can_not_be_built_is_a_cube_error(monkeypatch):
+    def broken():
+        raise RuntimeError("no shell")
+
+    monkeypatch.setattr(core.ipynb_exec, "RiverboxIPythonShell", broken)
+    flow = Flow(name="No Shell", language="ipython", version="3.12")
+    flow.add_cube({"kind": "REGULAR", "name": "Cell", "code": "x = 1"})
+    pool = ShellPool(max_idle=1)
+    _, messages = run(flow, pool)
+
+    [error] = [m for m in messages if m["type"] == "CUBE_EXECUTION_ERROR"]
+    assert "no shell" in error["error-message"]
+    assert [m for m in messages if m["type"] == "EXECUTION_DONE"]
+    pool.warming.join()
+    assert isinstance(pool.error, RuntimeError) and pool.in_use == 0
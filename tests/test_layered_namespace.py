@@ -0,0 +1,65 @@
+import dill
+from core.LayeredNamespace import LayeredNamespace
+from core.FlowExecution import FlowExecution
+from riverbox_builder import Flow
+from . import new_metadata, new_execution
+
+def test_only_writes_are_reported():
+    global_vars = {"big": list(range(10)), "x": 1}
+    ns = LayeredNamespace({"x": 2}, global_vars)
+    ns.seed("rbx", object())
+    exec("y = x + len(big)\ndef f():\n  global z\n  z = y\nf()", ns)
+
+    writes = ns.writes()
+    assert writes["y"] == 12
+    assert writes["z"] == 12
+    assert "f" in writes
+    assert not {"x", "big", "len", "rbx"} & set(writes)
+
+def get_flow():
+    flow = Flow(name="Globals", language="python", version="3.12")
+    first = flow.add_cube({"kind": "REGULAR", "name": "First", "code": "a = 1\nb = 2\nrbxm.output = 0"})
+    second = flow.add_cube({"kind": "REGULAR", "name": "Second", "code": "c = a + b + arg"})
+    first.add_edge_to(second, end_arg_key="arg")
+    return flow
+
+def test_flow_global_vars_get_only_written_keys():
+    flow_exec = new_execution(get_flow())
+    flow_exec.execute({})
+    assert {k: flow_exec.global_vars[k] for k in "abc"} == {"a": 1, "b": 2, "c": 3}
+    assert not {"arg", "rbxm", "rbx"} & set(flow_exec.global_vars)
+
+def test_debug_step_leaves_prior_global_vars_untouched():
+    flow_dict = get_flow().to_dict()
+    first_id, second_id = [c["id"] for c in flow_dict["flow"]["cubes"]]
+    s1 = FlowExecution(flow_dict, new_metadata(), lambda m: None, "DEBUG_ONLY", first_id, None)
+    s1.execute({})
+    s2 = FlowExecution(flow_dict, new_metadata(), lambda m: None, "DEBUG_ONLY", second_id, s1)
+    s2.execute({})
+
+    assert "c" in s2.global_vars
+    assert "c" not in s1.global_vars
+    assert s1.global_vars["a"] == 1
+
+def test_membership_and_iteration_see_the_layers():
+    global_vars = {"model": "loaded", "x": 1}
+    ns = LayeredNamespace({"x": 2, "arg": 3}, global_vars)
+    ns.seed("rbx", None)
+    exec(
+        "found = ('model' in globals(), globals().get('model'), globals().get('missing', 0), 'len' in globals())\n"
+        "if 'model' not in globals():\n"
+        "  model = 'reloaded'\n"
+        "names = sorted(k for k in globals() if k != '__builtins__')\n"
+        "merged = dict(globals())\n", ns)
+
+    assert ns["found"] == (True, "loaded", 0, False)
+    assert ns["names"] == ["arg", "found", "model", "rbx", "x"]
+    assert ns["merged"]["x"] == 2 and ns["merged"]["model"] == "loaded"
+    assert "model" not in ns.writes()
+    assert set(ns.writes()) == {"found", "names", "merged", "__builtins__"}
+
+def test_functions_pickle_without_the_layers():
+    ns = LayeredNamespace({}, {"big": list(range(100000))})
+    exec("def f(n):\n  return n", ns)
+    assert len(dill.dumps(ns["f"])) < 10000
+    assert len(dill.dumps(ns)) < 10000
@@ -0,0 +1,98 @@
+import threading
+from riverbox_builder import Flow
+from . import new_execution, get_map_flow
+
+def test_map_runs_every_layer_within_the_window():
+    in_flight = 0
+    peak = 0
+    lock = threading.Lock()
+
+    def callback(m):
+        nonlocal in_flight, peak
+        with lock:
+            if m["type"] == "START_CUBE_EXECUTION":
+                in_flight += 1
+                peak = max(peak, in_flight)
+            elif m["type"] == "SUCCESSFUL_CUBE_EXECUTION":
+                in_flight -= 1
+
+    flow = get_map_flow(2500, {"map-window": 8})
+    results = new_execution(flow, callback).execute({})
+
+    assert results["squares"] == [i * i for i in range(2500)]
+    # + 1 for the PARAM cube
+    assert peak <= 8 + 1
+
+def test_two_map_inputs_expand_lazily_in_nested_loop_order():
+    flow = Flow(name="Grid", language="python", version="3.12")
+    size = flow.add_cube({"kind": "PARAM", "name": "Size", "arg-key": "size", "default-value": "{}"})
+    # One source cube, so the edges always propagate (and fill the args) in the same order
+    split = flow.add_cube({
+        "kind": "REGULAR",
+        "name": "Split",
+        "code": "@rbxm.main_handler\ndef split(size):\n  return {'rows': size['rows'], 'cols': size['cols']}",
+    })
+    cell = flow.add_cube({
+        "kind": "REGULAR",
+        "name": "Cell",
+        "code": "@rbxm.main_handler\ndef cell(row, col):\n  return (row, col)",
+    })
+    result = flow.add_cube({"kind": "RESULT", "name": "Result", "arg-key": "cells"})
+    size.add_edge_to(split, end_arg_key="size")
+    split.add_edge_to(cell, start_arg_key="rows", end_arg_key="row", kind="MAP")
+    split.add_edge_to(cell, start_arg_key="cols", end_arg_key="col", kind="MAP")
+    cell.add_edge_to(result)
+
+    flow_exec = new_execution(flow)
+    results = flow_exec.execute({"size": {"rows": 3, "cols": 2}})
+
+    # The later map arg key varies slowest
+    assert results["cells"] == [(0, 0), (1, 0), (2, 0), (0, 1), (1, 1), (2, 1)]
+    assert flow_exec.latest_cubes_lookup[cell.id].num_layers == 6
+
+def get_zip_flow():
+    flow = Flow(name="Zip", language="python", version="3.12")
+    lists = flow.add_cube({"kind": "PARAM", "name": "Lists", "arg-key": "lists", "default-value": "{}"})
+    split = flow.add_cube({
+        "kind": "REGULAR",
+        "name": "Split",
+        "code": "@rbxm.main_handler\ndef split(lists):\n  return lists",
+    })
+    add = flow.add_cube({
+        "kind": "REGULAR",
+        "name": "Add",
+        "code": "@rbxm.main_handler\ndef add(x, y, scale):\n  return (x + y) * scale",
+    })
+    result = flow.add_cube({"kind": "RESULT", "name": "Result", "arg-key": "sums"})
+    lists.add_edge_to(split, end_arg_key="lists")
+    split.add_edge_to(add, start_arg_key="xs", end_arg_key="x", kind="ZIP")
+    split.add_edge_to(add, start_arg_key="ys", end_arg_key="y", kind="ZIP")
+    split.add_edge_to(add, start_arg_key="scale", end_arg_key="scale")
+    add.add_edge_to(result)
+    return flow, add
+
+def test_zip_edges_pair_inputs_element_wise():
+    flow, add = get_zip_flow()
+    flow_exec = new_execution(flow)
+    results = flow_exec.execute({"lists": {"xs": list(range(10000)), "ys": list(range(10000)), "scale": 2}})
+
+    assert results["sums"] == [4 * i for i in range(10000)]
+    assert flow_exec.latest_cubes_lookup[add.id].num_layers == 10000
+
+def test_zip_edges_of_different_lengths_fail_the_cube():
+    flow, add = get_zip_flow()
+    errors = []
+
+    def callback(m):
+        if m["type"] == "CUBE_EXECUTION_ERROR":
+            errors.append(m)
+
+    flow_exec = new_execution(flow, callback)
+    results = flow_exec.execute({"lists": {"xs": [1, 2, 3], "ys": [1, 2], "scale": 1}})
+
+    assert results["sums"] is None
+    # The error was the layer's, the cube runs again (in a cycle, a debug clone) without it
+    assert flow_exec.latest_cubes_lookup[add.id].pre_execution_error == ""
+    assert len(errors) == 1
+    assert "ZIP inputs must have the same length" in errors[0]["error-message"]
+    assert "x: 3, y: 2" in errors[0]["error-message"]
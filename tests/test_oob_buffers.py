@@ -0,0 +1,91 @@
+import os
+import pickle
+import tempfile
+import threading
+from uuid import uuid4
+from core.FlowExecution import FlowExecution
+from core import oob_buffers
+
+class Frame:
+    """Stands in for a NumPy array: hands its memory to pickle 5 as a PickleBuffer"""
+    def __init__(self, data):
+        self.data = data
+
+    def __reduce_ex__(self, protocol):
+        if protocol >= 5:
+            return Frame, (pickle.PickleBuffer(self.data),)
+        return Frame, (bytes(self.data),)
+
+def get_flow_exec(temp_dir, **metadata):
+    riverbox_flow = {
+        "metadata": {"language": "python", "version": "3.11", "checkpoint-buffer-threshold": 1024, **metadata},
+        "flow": {"cubes": []},
+        "env": {},
+        "tags": [],
+        "tag-stack": [[]]
+    }
+    metadata = {"execution-id": str(uuid4()), "flow-id": str(uuid4()), "invocation-id": str(uuid4())}
+    return FlowExecution(riverbox_flow, metadata, lambda x: None, "FULL", None, None, temp_dir)
+
+def test_large_buffers_are_written_apart_and_mapped_on_restore():
+    with tempfile.TemporaryDirectory() as temp_dir:
+        flow_exec = get_flow_exec(temp_dir)
+        flow_exec.global_vars = {"big": Frame(bytearray(b"a" * 100000)), "small": Frame(bytearray(b"b" * 10))}
+        flow_exec._dump_state(0)
+
+        # Changing a buffer after the snapshot does not reach the checkpoint
+        flow_exec.global_vars["big"].data[0:1] = b"z"
+        # As a layer reading big would
+        flow_exec.reach_global_vars({"big": flow_exec.global_vars["big"]})
+        flow_exec.commit_global_vars({"other": Frame(bytearray(b"c" * 5000))})
+        flow_exec._dump_state(1)
+
+        [full, delta] = flow_exec.list_checkpoints()
+        # big was changed in place, the delta has it again
+        assert len(full["buffers"]) == 1 and len(delta["buffers"]) == 2
+        assert full["bytes"] > 100000
+        assert os.path.getsize(os.path.join(temp_dir, full["file"])) < 100000
+
+        restored = flow_exec.get_flow_from_checkpoint(1)
+        big = restored.global_vars["big"].data
+        assert isinstance(big, memoryview) and big.readonly
+        assert bytes(big[:2]) == b"za" and big.nbytes == 100000
+        assert bytes(flow_exec.get_flow_from_checkpoint(0).global_vars["big"].data[:2]) == b"aa"
+        # Small buffers stay in the pickle
+        assert isinstance(restored.global_vars["small"].data, bytearray)
+        assert bytes(restored.global_vars["other"].data) == b"c" * 5000
+
+def test_buffers_are_written_before_the_next_cubes_run(monkeypatch):
+    def no_copies(buffers):
+        raise AssertionError("copied")
+    monkeypatch.setattr(oob_buffers, "detach", no_copies)
+    with tempfile.TemporaryDirectory() as temp_dir:
+        flow_exec = get_flow_exec(temp_dir)
+        flow_exec.global_vars = {"big": Frame(bytearray(b"a" * 100000))}
+        # The writer thread is held, only the checkpoint file and the fsyncs are left to it
+        release = threading.Event()
+        flow_exec.checkpoint_writer.submit(os.path.join(temp_dir, "held"), b"", {}, on_written=lambda size: release.wait())
+        flow_exec._dump_state(0)
+        [name] = [name for name in os.listdir(temp_dir) if name.endswith(".buf")]
+        assert os.path.getsize(os.path.join(temp_dir, name)) == 100000
+
+        release.set()
+        flow_exec.checkpoint_writer.flush()
+        [full] = flow_exec.list_checkpoints()
+        assert full["buffers"] == [name]
+        assert bytes(flow_exec.get_flow_from_checkpoint(0).global_vars["big"].data[:2]) == b"aa"
+
+def test_copied_buffers_are_written_by_the_checkpoint_writer():
+    with tempfile.TemporaryDirectory() as temp_dir:
+        flow_exec = get_flow_exec(temp_dir, **{"checkpoint-buffers": "copy"})
+        flow_exec.global_vars = {"big": Frame(bytearray(b"a" * 100000))}
+        # Hold the writer thread on a checkpoint of its own
+        release = threading.Event()
+        flow_exec.checkpoint_writer.submit(os.path.join(temp_dir, "held"), b"", {}, on_written=lambda size: release.wait())
+        flow_exec._dump_state(0)
+        assert not [name for name in os.listdir(temp_dir) if name.endswith(".buf")]
+
+        release.set()
+        flow_exec.checkpoint_writer.flush()
+        [full] = flow_exec.list_checkpoints()
+        assert os.path.getsize(os.path.join(temp_dir, full["buffers"][0])) == 100000
@@ -0,0 +1,116 @@
+from core.FlowExecution import FlowExecution
+from core.PreparedFlow import prepared_flow_cache, PreparedFlowCache
+from riverbox_builder import Flow
+from uuid import uuid4
+import pytest
+from . import new_metadata, new_execution, get_mapped_flow
+
+def get_double_flow():
+    flow = Flow(name="Double", language="python", version="3.12")
+    x = flow.add_cube({"kind": "PARAM", "name": "X", "arg-key": "x", "default-value": "0"})
+    double = flow.add_cube({"kind": "REGULAR", "name": "Double", "code": "@rbxm.main_handler\ndef double(x):\n  return x * 2"})
+    result = flow.add_cube({"kind": "RESULT", "name": "Result", "arg-key": "doubled"})
+    x.add_edge_to(double, end_arg_key="x")
+    double.add_edge_to(result)
+    return flow
+
+def test_registry_subflow_is_prepared_once_for_every_layer():
+    flow = Flow(name="Caller", language="python", version="3.12")
+    items = flow.add_cube({"kind": "REGULAR", "name": "Items", "code": "rbxm.output = list(range(50))"})
+    call = flow.add_cube({"kind": "REGULAR", "name": "Call", "code": "rbxm.output = rbxm.call('Double', {'x': x})['doubled']"})
+    result = flow.add_cube({"kind": "RESULT", "name": "Result", "arg-key": "doubled"})
+    items.add_edge_to(call, end_arg_key="x", kind="MAP")
+    call.add_edge_to(result)
+
+    registry = {"Double": get_double_flow().to_dict()}
+    misses = prepared_flow_cache.misses
+    flow_exec = new_execution(flow, flow_registry=registry)
+    assert flow_exec.execute({}) == {"doubled": [x * 2 for x in range(50)]}
+    # The caller and the subflow, once each
+    assert prepared_flow_cache.misses == misses + 2
+
+def test_changed_flow_is_a_new_version():
+    flow = get_double_flow()
+    first = new_execution(flow)
+    same = new_execution(flow)
+    changed = flow.to_dict()
+    [cube] = [c for c in changed["flow"]["cubes"] if c["kind"] == "REGULAR"]
+    cube["code"] = cube["code"].replace("* 2", "* 3")
+    other = FlowExecution(changed, new_metadata(), lambda m: None, "FULL", None, None)
+
+    assert first.cubes[1] is not same.cubes[1] # per run state
+    assert first.cubes[1].compiled_code is same.cubes[1].compiled_code
+    assert first.cubes[1].compiled_code is not other.cubes[1].compiled_code
+    assert other.execute({"x": 2}) == {"doubled": 6}
+
+def test_duplicate_cube_ids_are_rejected():
+    flow = get_double_flow().to_dict()
+    flow["flow"]["cubes"].append(dict(flow["flow"]["cubes"][0]))
+    with pytest.raises(ValueError):
+        FlowExecution(flow, new_metadata(), lambda m: None, "FULL", None, None)
+
+def test_plan_orders_cubes_and_finds_cycles():
+    flow = Flow(name="Loop", language="python", version="3.12")
+    start = flow.add_cube({"kind": "PARAM", "name": "Start", "arg-key": "start", "default-value": "3"})
+    check = flow.add_cube({"kind": "REGULAR", "name": "Check", "code": "rbxm.output = {'done': n, 'again': None} if n == 0 else {'done': None, 'again': n}"})
+    decrement = flow.add_cube({"kind": "REGULAR", "name": "Decrement", "code": "rbxm.output = n - 1"})
+    result = flow.add_cube({"kind": "RESULT", "name": "Result", "arg-key": "done"})
+    start.add_edge_to(check, end_arg_key="n")
+    check.add_edge_to(result, start_arg_key="done")
+    check.add_edge_to(decrement, end_arg_key="n", start_arg_key="again")
+    decrement.add_edge_to(check, end_arg_key="n")
+    # Added last, ordered first
+    first = flow.add_cube({"kind": "REGULAR", "name": "First", "code": "rbxm.output = 1"})
+    first.add_edge_to(start, end_arg_key="unused")
+
+    plan = prepared_flow_cache.get(flow.to_dict())
+    assert [plan.index[c.id] for c in [start, check, decrement, result, first]] == [0, 1, 2, 3, 4]
+    assert plan.components == ((4,), (0,), (1, 2), (3,))
+    assert plan.order == (4, 0, 1, 2, 3)
+    assert [plan.rank[c.id] for c in [first, start, check, decrement, result]] == [0, 1, 2, 3, 4]
+    assert plan.cyclic == {1, 2}
+    # Two edges fill n, it is one input
+    assert plan.input_arg_keys == (("unused",), ("n",), ("n",), (None,), ())
+    assert [edge.start for edge in plan.incoming[check.id]] == [start.id, decrement.id]
+    assert {edge.input_slot for edge in plan.incoming[check.id]} == {plan.input_offsets[1]}
+    assert plan.upstream(result.id) == {0, 1, 2, 3, 4}
+    assert plan.upstream(start.id) == {0, 4}
+
+def test_runs_share_the_plan_edges():
+    flow = get_double_flow()
+    first = new_execution(flow)
+    second = new_execution(flow)
+    assert first.plan is second.plan
+    assert first.cubes[0].start_edges is second.cubes[0].start_edges
+    assert first.edge_fresh is not second.edge_fresh
+    assert first.execute({"x": 2}) == {"doubled": 4}
+    assert not any(second.edge_fresh)
+
+def test_flow_cube_layers_do_not_hash_the_subflow(monkeypatch):
+    sub = Flow(name="Sub", run_on_same=True, language="python", version="3.12", tags=["sub"])
+    x = sub.add_cube({"kind": "PARAM", "name": "X", "arg-key": "x", "default-value": "0"})
+    double = sub.add_cube({"kind": "REGULAR", "name": "Double", "code": "rbxm.output = x * 2"})
+    result = sub.add_cube({"kind": "RESULT", "name": "Result", "arg-key": "doubled"})
+    x.add_edge_to(double, end_arg_key="x")
+    double.add_edge_to(result)
+    flow = get_mapped_flow(sub, 20)
+
+    flow_exec = new_execution(flow)
+    hashed = []
+    version = PreparedFlowCache.version
+    monkeypatch.setattr(PreparedFlowCache, "version", staticmethod(lambda flow: hashed.append(flow) or version(flow)))
+    assert [r["doubled"] for r in flow_exec.execute({})["results"]] == [x * 2 for x in range(20)]
+    assert hashed == []
+
+def test_flow_changed_in_place_is_prepared_again():
+    flow = get_double_flow().to_dict()
+    assert FlowExecution(flow, new_metadata(), lambda m: None, "FULL", None, None).execute({"x": 2}) == {"doubled": 4}
+    [cube] = [c for c in flow["flow"]["cubes"] if c["kind"] == "REGULAR"]
+    cube["code"] = cube["code"].replace("* 2", "* 3")
+    assert FlowExecution(flow, new_metadata(), lambda m: None, "FULL", None, None).execute({"x": 2}) == {"doubled": 6}
+
+def test_edges_to_missing_cubes_are_rejected():
+    flow = get_double_flow().to_dict()
+    flow["flow"]["cubes"][0]["start-edges"][0]["end"] = str(uuid4())
+    with pytest.raises(ValueError):
+        FlowExecution(flow, new_metadata(), lambda m: None, "FULL", None, None)
@@ -0,0 +1,54 @@
+import pytest
+from core.Preview import PreviewPolicy
+from riverbox_builder import Flow
+from . import new_execution
+
+def test_messages_carry_bounded_previews_and_full_values_are_fetched():
+    flow = Flow(name="Big Values", language="python", version="3.12")
+    flow.metadata["preview-max-length"] = 200
+    make = flow.add_cube({"kind": "REGULAR", "name": "Make", "code": "rbxm.output = list(range(1000000))"})
+    result = flow.add_cube({"kind": "RESULT", "name": "Result", "arg-key": "numbers"})
+    make.add_edge_to(result)
+
+    messages = []
+    flow_exec = new_execution(flow, messages.append)
+    flow_exec.execute({})
+
+    [success] = [m for m in messages if m["type"] == "SUCCESSFUL_CUBE_EXECUTION"]
+    assert success["return-value"].startswith("[0, 1, 2")
+    assert len(success["return-value"]) <= 200 + len("... [truncated]")
+    assert success["return-value-type"] == "list[1000000]"
+    assert success["return-value-truncated"]
+    assert flow_exec.get_return_value(success["cube-execution-id"]) == list(range(1000000))
+
+    [update] = [m for m in messages if m["type"] == "RESULT_UPDATE"]
+    assert "results" not in update
+    assert update["label"] == "numbers" and update["result-type"] == "list[1000000]"
+    assert flow_exec.get_result("numbers") == list(range(1000000))
+
+def test_small_values_read_like_str():
+    policy = PreviewPolicy(max_length=50, max_items=3)
+    for value in [3, "Claude", None, {"b": 1, "a": [1, 2]}, (1, "x")]:
+        assert policy.preview(value) == (str(value), False)
+
+    assert policy.preview([1, 2, 3, 4]) == ("[1, 2, 3, ...]", True)
+    assert policy.preview("x" * 60) == ("x" * 50 + "... [truncated]", True)
+    assert policy.preview(10 ** 5000) == ("<int>", True)
+
+def test_only_the_latest_return_values_are_kept():
+    flow = Flow(name="Many Values", language="python", version="3.12")
+    flow.metadata["return-values-keep"] = 5
+    items = flow.add_cube({"kind": "REGULAR", "name": "Items", "code": "rbxm.output = list(range(20))"})
+    square = flow.add_cube({"kind": "REGULAR", "name": "Square", "code": "rbxm.output = x * x"})
+    items.add_edge_to(square, end_arg_key="x", kind="MAP")
+
+    messages = []
+    flow_exec = new_execution(flow, messages.append)
+    flow_exec.execute({})
+
+    successes = [m for m in messages if m["type"] == "SUCCESSFUL_CUBE_EXECUTION"]
+    assert len(successes) == 21 and len(flow_exec.return_values) == 5
+    last = successes[-1]
+    assert flow_exec.get_return_value(last["cube-execution-id"]) == int(last["return-value"])
+    with pytest.raises(KeyError):
+        flow_exec.get_return_value(successes[0]["cube-execution-id"])
@@ -0,0 +1,31 @@
+from riverbox_builder import Flow
+from . import new_execution
+
+def get_flow(backend_metadata):
+    flow = Flow(name="CPU Map", language="python", version="3.12")
+    setup = flow.add_cube({"kind": "REGULAR", "name": "Setup", "code": "offset = 100\nrbxm.output = [1, 2, 3, 0]"})
+    crunch = flow.add_cube({
+        "kind": "REGULAR",
+        "name": "Crunch",
+        "code": "import os\n@rbxm.main_handler\ndef crunch(n):\n  print('pid', os.getpid())\n  squares = sum(i * i for i in range(n * 1000))\n  return offset + 1000 // n\n",
+        "metadata": backend_metadata,
+    })
+    result = flow.add_cube({"kind": "RESULT", "name": "Result", "arg-key": "crunched"})
+    setup.add_edge_to(crunch, end_arg_key="n", kind="MAP")
+    crunch.add_edge_to(result)
+    return flow, crunch
+
+def test_process_backend_streams_layer_events():
+    flow, crunch = get_flow({"execution-backend": "process", "max-processes": 2})
+    messages = []
+    flow_exec = new_execution(flow, messages.append)
+    flow_exec.execute({})
+
+    successes = [m for m in messages if m["type"] == "SUCCESSFUL_CUBE_EXECUTION" and m["console-output"].startswith("pid")]
+    errors = [m for m in messages if m["type"] == "CUBE_EXECUTION_ERROR"]
+    assert sorted(m["return-value"] for m in successes) == ["1100", "433", "600"]
+    # the worker pids are not ours
+    assert all(int(m["console-output"].split()[1]) != __import__("os").getpid() for m in successes)
+    assert len(errors) == 1 and "ZeroDivisionError" in errors[0]["error-message"]
+    assert flow_exec.latest_cubes_lookup[crunch.id].process_pool is None
+    assert "__builtins__" not in flow_exec.global_vars
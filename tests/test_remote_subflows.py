@@ -0,0 +1,119 @@
+import threading
+from core.FlowExecution import FlowExecution
+from core.SubflowBroker import InProcessBroker
+from core.SubflowDispatcher import SubflowDispatcher
+from core.subflow_worker import run_worker
+from core.call_external_flow import subflow_execution
+from riverbox_builder import Flow
+from . import new_metadata, new_execution, get_mapped_flow, collect_messages
+
+def start_workers(broker, concurrency):
+    stop = threading.Event()
+    worker = threading.Thread(target=run_worker, args=(broker,), kwargs={"concurrency": concurrency, "stop": stop, "poll_interval": 0.05}, daemon=True)
+    worker.start()
+    return stop, worker
+
+def run(flow, dispatcher):
+    messages, callback = collect_messages()
+    flow_exec = new_execution(flow, callback, subflow_dispatcher=dispatcher)
+    return flow_exec, flow_exec.execute({}), messages
+
+def test_mapped_flow_cube_runs_on_workers():
+    sub = Flow(name="Square", run_on_same=False, language="python", version="3.12", tags=["sub"])
+    x = sub.add_cube({"kind": "PARAM", "name": "X", "arg-key": "x", "default-value": "0"})
+    square = sub.add_cube({"kind": "REGULAR", "name": "Square", "code": "rbxm.output = x * x"})
+    result = sub.add_cube({"kind": "RESULT", "name": "Result", "arg-key": "square"})
+    x.add_edge_to(square, end_arg_key="x")
+    square.add_edge_to(result)
+
+    broker = InProcessBroker()
+    stop, worker = start_workers(broker, concurrency=3)
+    dispatcher = SubflowDispatcher(broker)
+    try:
+        flow_exec, results, messages = run(get_mapped_flow(sub, 10), dispatcher)
+    finally:
+        dispatcher.close()
+        stop.set()
+        worker.join()
+
+    assert [r["square"] for r in results["results"]] == [x * x for x in range(10)]
+    assert not [m for m in messages if m["type"] in ["CUBE_EXECUTION_ERROR", "TRACK_EXTERNAL_SUBFLOW"]]
+
+    # The workers' messages come back, each subflow execution pointing at its FLOW layer
+    [call] = [c for c in flow_exec.cubes if c.kind == "FLOW"]
+    layer_ids = {m["cube-execution-id"] for m in messages if m["type"] == "START_CUBE_EXECUTION" and m["cube-id"] == call.id}
+    sub_executions = [m for m in messages if m["type"] == "NEW_EXECUTION" and m["execution-id"] != flow_exec.execution_id]
+    assert len(layer_ids) == 10
+    assert sorted(m["parent-cube-execution-id"] for m in sub_executions) == sorted(layer_ids)
+    assert len([m for m in messages if m["type"] == "EXECUTION_DONE"]) == 11
+
+def test_worker_failure_is_a_cube_error():
+    sub = Flow(name="Broken", run_on_same=False, language="python", version="3.12", tags=["sub"])
+    x = sub.add_cube({"kind": "PARAM", "name": "X", "arg-key": "x", "default-value": "0"})
+    flow = get_mapped_flow(sub, 10).to_dict()
+    # The same cube twice, the worker can not prepare the subflow
+    [call] = [c for c in flow["flow"]["cubes"] if c["kind"] == "FLOW"]
+    call["cubes"].append(dict(call["cubes"][0]))
+
+    broker = InProcessBroker()
+    stop, worker = start_workers(broker, concurrency=1)
+    dispatcher = SubflowDispatcher(broker)
+    try:
+        messages = []
+        FlowExecution(flow, new_metadata(), messages.append, "FULL", None, None, subflow_dispatcher=dispatcher).execute({})
+    finally:
+        dispatcher.close()
+        stop.set()
+        worker.join()
+
+    errors = [m for m in messages if m["type"] == "CUBE_EXECUTION_ERROR"]
+    assert len(errors) == 10
+    assert all("ValueError" in e["error-message"] for e in errors)
+
+def test_calls_from_the_same_layer_get_their_own_results():
+    sub = Flow(name="Square", run_on_same=False, language="python", version="3.12", tags=["sub"])
+    x = sub.add_cube({"kind": "PARAM", "name": "X", "arg-key": "x", "default-value": "0"})
+    square = sub.add_cube({"kind": "REGULAR", "name": "Square", "code": "rbxm.output = x * x"})
+    result = sub.add_cube({"kind": "RESULT", "name": "Result", "arg-key": "square"})
+    x.add_edge_to(square, end_arg_key="x")
+    square.add_edge_to(result)
+    [flow_cube] = [c for c in get_mapped_flow(sub, 1).to_dict()["flow"]["cubes"] if c["kind"] == "FLOW"]
+    body, _ = subflow_execution(flow_cube, new_metadata())
+
+    broker = InProcessBroker()
+    stop, worker = start_workers(broker, concurrency=4)
+    dispatcher = SubflowDispatcher(broker, timeout=30)
+    results = {}
+    def call(n):
+        _, call_metadata = subflow_execution(flow_cube, new_metadata(), parent_cubeexecution_id="layer")
+        results[n] = dispatcher.call(body, call_metadata, lambda m: None, {"x": n})["square"]
+    try:
+        threads = [threading.Thread(target=call, args=(n,)) for n in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+    finally:
+        dispatcher.close()
+        stop.set()
+        worker.join()
+
+    assert results == {n: n * n for n in range(4)}
+
+class UnreachableBroker:
+    def connect(self):
+        raise ConnectionError("broker is down")
+
+def test_timeouts_and_broker_failures_are_cube_errors():
+    sub = Flow(name="Square", run_on_same=False, language="python", version="3.12", tags=["sub"])
+    x = sub.add_cube({"kind": "PARAM", "name": "X", "arg-key": "x", "default-value": "0"})
+
+    for dispatcher, expected in [(SubflowDispatcher(InProcessBroker(), timeout=0.3), "No result from a worker"),
+                                 (SubflowDispatcher(UnreachableBroker()), "broker is down")]:
+        try:
+            _, _, messages = run(get_mapped_flow(sub, 2), dispatcher)
+        finally:
+            dispatcher.close()
+        errors = [m for m in messages if m["type"] == "CUBE_EXECUTION_ERROR"]
+        assert len(errors) == 2 and all(expected in e["error-message"] for e in errors)
+        assert len([m for m in messages if m["type"] == "EXECUTION_DONE"]) == 1
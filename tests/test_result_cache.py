@@ -0,0 +1,82 @@
+import os
+import sys
+import subprocess
+from core.ResultCache import MemoryResultStore, DiskResultStore, result_key, disk_result_store
+from riverbox_builder import Flow
+from . import new_execution
+
+def get_flow():
+    flow = Flow(name="Deterministic", language="python", version="3.12")
+    param = flow.add_cube({"kind": "PARAM", "name": "Items", "arg-key": "items", "default-value": "3"})
+    square = flow.add_cube({
+        "kind": "REGULAR",
+        "name": "Square",
+        "code": "@rbxm.main_handler\ndef square(i):\n  print('computing', i)\n  return i * i",
+        "metadata": {"deterministic": True},
+    })
+    result = flow.add_cube({"kind": "RESULT", "name": "Result", "arg-key": "squares"})
+    param.add_edge_to(square, end_arg_key="i", kind="MAP")
+    square.add_edge_to(result)
+    return flow
+
+def run(flow, args, store):
+    messages = []
+    results = new_execution(flow, messages.append, result_store=store).execute(args)
+    return results, [m["type"] for m in messages], messages
+
+def test_rerun_hits_the_cache_for_every_layer():
+    flow = get_flow()
+    store = MemoryResultStore()
+
+    results, types, _ = run(flow, {"items": 3}, store)
+    assert results["squares"] == [0, 1, 4]
+    assert types.count("CACHED_CUBE_EXECUTION") == 0
+
+    results, types, messages = run(flow, {"items": 4}, store)
+    assert results["squares"] == [0, 1, 4, 9]
+    # Layers 0-2 were computed before, only layer 3 runs
+    assert types.count("CACHED_CUBE_EXECUTION") == 3
+    cached = [m for m in messages if m["type"] == "CACHED_CUBE_EXECUTION"]
+    assert sorted(m["console-output"] for m in cached) == ["computing 0\n", "computing 1\n", "computing 2\n"]
+
+def test_memory_store_evicts_least_recently_used_by_size():
+    store = MemoryResultStore(max_bytes=1000)
+    store.put("a", "x" * 400, "")
+    store.put("b", "y" * 400, "")
+    assert store.get("a") == ("x" * 400, "")
+    store.put("c", "z" * 400, "")
+
+    assert store.get("b") is None
+    assert store.get("a") is not None and store.get("c") is not None
+    assert store.size <= 1000
+
+def test_disk_store_survives_a_new_store_and_evicts(tmp_path):
+    store = DiskResultStore(str(tmp_path), max_bytes=1000)
+    key = result_key("code", "python", {"b": 2, "a": 1}, {"ENV": "1"})
+    assert key == result_key("code", "python", {"a": 1, "b": 2}, {"ENV": "1"})
+    assert key != result_key("code", "python", {"a": 1, "b": 2}, {"ENV": "2"})
+
+    store.put(key, {"value": 1}, "out")
+    assert DiskResultStore(str(tmp_path), max_bytes=1000).get(key) == ({"value": 1}, "out")
+
+    store.put("big1", "x" * 600, "")
+    store.put("big2", "y" * 600, "")
+    assert store.get(key) is None
+    assert store.get("big1") is None
+    assert store.get("big2") == ("y" * 600, "")
+    assert sorted(p.name for p in tmp_path.iterdir()) == ["big2.result"]
+
+def test_keys_are_canonical_and_disk_stores_are_shared(tmp_path):
+    assert result_key("code", "python", {"s": {"b", "a", "c"}}, {}) == result_key("code", "python", {"s": {"c", "a", "b"}}, {})
+    assert result_key("code", "python", {"x": 1}, {}) != result_key("code", "python", {"x": True}, {})
+    assert result_key("code", "python", {"x": 1}, {}) != result_key("code", "python", {"x": "1"}, {})
+    # Keys do not depend on the process's hash seed
+    script = "from core.ResultCache import result_key; print(result_key('code', 'python', {'s': set('abcdefgh')}, {}))"
+    keys = {subprocess.run([sys.executable, "-c", script], env={**os.environ, "PYTHONHASHSEED": seed}, capture_output=True, text=True, check=True).stdout
+            for seed in ["1", "2", "3"]}
+    assert len(keys) == 1
+
+    assert disk_result_store(str(tmp_path)) is disk_result_store(str(tmp_path / ".." / tmp_path.name))
+    flow = get_flow()
+    flow.metadata["result-cache-dir"] = str(tmp_path)
+    assert new_execution(flow).result_store is disk_result_store(str(tmp_path))
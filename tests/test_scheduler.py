@@ -0,0 +1,77 @@
+from core.FlowExecution import FlowExecution
+from riverbox_builder import Flow
+from . import new_metadata, new_execution
+
+def get_fan_in_flow(width):
+    flow = Flow(name="Fan In", language="python", version="3.12")
+    param = flow.add_cube({"kind": "PARAM", "name": "Start", "arg-key": "start", "default-value": "1"})
+    total = flow.add_cube({
+        "kind": "REGULAR",
+        "name": "Total",
+        "code": "@rbxm.main_handler\ndef total(**values):\n  return sum(values.values())",
+    })
+    for i in range(width):
+        branch = flow.add_cube({
+            "kind": "REGULAR",
+            "name": f"Branch {i}",
+            "code": f"@rbxm.main_handler\ndef branch(start):\n  return start + {i}",
+        })
+        param.add_edge_to(branch, end_arg_key="start")
+        branch.add_edge_to(total, end_arg_key=f"b{i}")
+    result = flow.add_cube({"kind": "RESULT", "name": "Result", "arg-key": "total"})
+    total.add_edge_to(result)
+    return flow, total
+
+def test_fan_in_waits_for_every_input():
+    flow, total = get_fan_in_flow(20)
+    started = []
+
+    def callback(m):
+        if m["type"] == "START_CUBE_EXECUTION":
+            started.append(m["cube-id"])
+
+    flow_exec = new_execution(flow, callback)
+    results = flow_exec.execute({"start": 1})
+
+    assert results == {"total": sum(1 + i for i in range(20))}
+    assert started.count(total.id) == 1
+    assert started[-1] == total.id
+
+def test_ready_queue_counts_pending_arg_keys():
+    flow, total = get_fan_in_flow(3)
+    flow_exec = new_execution(flow)
+
+    total_index = flow_exec.plan.index[total.id]
+    assert flow_exec.pending_input_counts[total_index] == 3
+    assert list(flow_exec.ready_cubes) == [flow.nodes()[0].id]
+
+    edges_to_total = [e for c in flow_exec.cubes for e in c.start_edges if e.end == total.id]
+    for edge in edges_to_total[:-1]:
+        flow_exec.set_edge_fresh(edge, True)
+    assert total.id not in flow_exec.ready_cubes
+
+    flow_exec.set_edge_fresh(edges_to_total[-1], True)
+    assert total.id in flow_exec.ready_cubes
+
+    flow_exec.set_edge_fresh(edges_to_total[0], False)
+    assert total.id not in flow_exec.ready_cubes
+    assert flow_exec.pending_input_counts[total_index] == 1
+    assert flow_exec.edge_fresh.count(1) == 2
+
+def test_debug_clones_keep_the_freshness_of_unchanged_cubes():
+    flow, total = get_fan_in_flow(4)
+    flow_dict = flow.to_dict()
+    first = FlowExecution(flow_dict, new_metadata(), lambda m: None, "DEBUG_START", None, None)
+    assert len(first.incoming_edges[total.id]) == 4
+    for cube in first.cubes[2:4]:
+        first.set_edge_fresh(cube.start_edges[0], True)
+
+    # Editing a branch replaces its cube execution, its edge to Total is stale again
+    flow_dict["flow"]["cubes"][2] = {**flow_dict["flow"]["cubes"][2], "code": "@rbxm.main_handler\ndef branch(start):\n  return start"}
+    second = FlowExecution(flow_dict, new_metadata(), lambda m: None, "DEBUG_NEXT", None, first)
+    new_branch, kept_branch = second.cubes[2:4]
+    assert new_branch is not first.cubes[2] and kept_branch is first.cubes[3]
+    assert new_branch.start_edges is second.plan.outgoing[2] and kept_branch.start_edges is second.plan.outgoing[3]
+    assert second.incoming_edges is second.plan.incoming
+    assert not second.edge_fresh[new_branch.start_edges[0].index]
+    assert second.edge_fresh[kept_branch.start_edges[0].index]
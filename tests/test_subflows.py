@@ -0,0 +1,52 @@
+from riverbox_builder import Flow
+from . import new_execution, get_mapped_flow, collect_messages
+
+def get_subflow():
+    # Two independent cubes, each records how many pool threads exist while it runs
+    sub = Flow(name="Sub", run_on_same=True, language="python", version="3.12", tags=["sub"])
+    x = sub.add_cube({"kind": "PARAM", "name": "X", "arg-key": "x", "default-value": "0"})
+    code = ("import time, threading\n"
+            "time.sleep(0.02)\n"
+            "rbxm.output = (x, len([t for t in threading.enumerate() if t.name.startswith('riverbox-worker')]))")
+    for name in ["A", "B"]:
+        cube = sub.add_cube({"kind": "REGULAR", "name": name, "code": code})
+        result = sub.add_cube({"kind": "RESULT", "name": "Result " + name, "arg-key": name})
+        x.add_edge_to(cube, end_arg_key="x")
+        cube.add_edge_to(result)
+    return sub
+
+def run_mapped_subflow(sub, max_workers):
+    messages, callback = collect_messages()
+    flow_exec = new_execution(get_mapped_flow(sub, 20), callback, max_workers=max_workers)
+    return flow_exec, flow_exec.execute({}), messages
+
+def test_mapped_subflows_share_the_callers_pool():
+    flow_exec, results, messages = run_mapped_subflow(get_subflow(), max_workers=4)
+
+    assert [r["A"][0] for r in results["results"]] == list(range(20))
+    assert max(r[k][1] for r in results["results"] for k in "AB") <= 4
+    assert not [m for m in messages if m["type"] == "CUBE_EXECUTION_ERROR"]
+
+    # Every subflow execution points at the layer of the FLOW cube that ran it
+    [call] = [c for c in flow_exec.cubes if c.kind == "FLOW"]
+    layer_ids = {m["cube-execution-id"] for m in messages if m["type"] == "START_CUBE_EXECUTION" and m["cube-id"] == call.id}
+    sub_executions = [m for m in messages if m["type"] == "NEW_EXECUTION" and m["execution-id"] != flow_exec.execution_id]
+    assert len(layer_ids) == 20
+    assert sorted(m["parent-cube-execution-id"] for m in sub_executions) == sorted(layer_ids)
+
+def test_max_running_cubes_is_a_quota_per_subflow():
+    sub = get_subflow()
+    sub.metadata["max-running-cubes"] = 1
+    flow_exec, results, messages = run_mapped_subflow(sub, max_workers=8)
+
+    started = {m["cube-execution-id"]: (m["flow-execution-id"], m["time"]) for m in messages if m["type"] == "START_CUBE_EXECUTION"}
+    finished = {m["cube-execution-id"]: m["time"] for m in messages if m["type"] == "SUCCESSFUL_CUBE_EXECUTION"}
+    spans = {}
+    for cube_execution_id, (execution_id, start) in started.items():
+        if execution_id != flow_exec.execution_id:
+            spans.setdefault(execution_id, []).append((start, finished[cube_execution_id]))
+
+    assert len(spans) == 20
+    for execution_spans in spans.values():
+        execution_spans.sort()
+        assert all(end <= next_start for (_, end), (next_start, _) in zip(execution_spans, execution_spans[1:]))
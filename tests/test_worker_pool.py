@@ -0,0 +1,85 @@
+import threading
+import time
+import pytest
+from core.WorkerPool import WorkerPool, TaskGroup
+
+def test_nested_waits_do_not_deadlock_a_single_worker():
+    pool = WorkerPool(1)
+    outer = TaskGroup(pool)
+
+    def cube(i):
+        layers = TaskGroup(pool)
+        futures = [layers.submit(lambda j=j: i * 10 + j) for j in range(5)]
+        layers.join()
+        return [f.result() for f in futures]
+
+    futures = [outer.submit(cube, i) for i in range(4)]
+    outer.join()
+    assert [f.result() for f in futures] == [[i * 10 + j for j in range(5)] for i in range(4)]
+    assert pool.num_threads <= 1
+
+def test_thread_count_is_bounded():
+    pool = WorkerPool(3)
+    group = TaskGroup(pool)
+    running = []
+    peak = 0
+    lock = threading.Lock()
+
+    def task():
+        nonlocal peak
+        with lock:
+            running.append(1)
+            peak = max(peak, len(running))
+        time.sleep(0.01)
+        with lock:
+            running.pop()
+
+    for _ in range(30):
+        group.submit(task)
+    group.join()
+    # three workers plus the joining thread helping
+    assert peak <= 4
+    assert pool.num_threads <= 3
+
+def test_groups_are_served_round_robin():
+    pool = WorkerPool(1)
+    order = []
+    gate = threading.Event()
+    blocker = TaskGroup(pool)
+    blocker.submit(gate.wait)
+
+    first, second = TaskGroup(pool), TaskGroup(pool)
+    for i in range(3):
+        first.submit(order.append, ("first", i))
+    for i in range(3):
+        second.submit(order.append, ("second", i))
+    gate.set()
+    blocker.join()
+    pool_drained = TaskGroup(pool)
+    pool_drained.wait(lambda: first.outstanding() == 0 and second.outstanding() == 0)
+
+    assert [name for name, _ in order] == ["first", "second"] * 3
+
+def test_limit_and_errors():
+    pool = WorkerPool(4)
+    group = TaskGroup(pool, limit=1)
+    running = 0
+    peak = 0
+    lock = threading.Lock()
+
+    def task(fail):
+        nonlocal running, peak
+        with lock:
+            running += 1
+            peak = max(peak, running)
+        time.sleep(0.005)
+        with lock:
+            running -= 1
+        if fail:
+            raise ValueError("layer failed")
+
+    for i in range(6):
+        group.submit(task, i == 3)
+    with pytest.raises(ValueError):
+        group.join()
+    assert peak == 1